@@ -0,0 +1,94 @@
+import time
+import logging
+import importlib
+import threading
+from importlib import metadata
+
+logger = logging.getLogger(__name__)
+
+# Modes shipped with the bot: name -> "module:Class". More can be added in the `backends` config section,
+# or by other packages through the `orderbot.backends` entry point group.
+BUILTIN_BACKENDS = {
+    'default': 'default:Default',
+    'dominos': 'dominos:Dominos',
+}
+ENTRY_POINT_GROUP = 'orderbot.backends'
+
+
+def _entry_points():
+    try:
+        eps = metadata.entry_points()
+    except Exception as e:
+        logger.warning("Could not look up backend entry points: %s", e)
+        return {}
+    if hasattr(eps, 'select'):
+        eps = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        eps = eps.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value for ep in eps}
+
+
+class BackendRegistry:
+    """
+    Knows every mode by name, but only imports and sets up a backend the first time some chat uses it.
+    A backend gets the config section named like its mode (or None) as its only argument, and
+    `refresh_order_message` as an attribute once it's set up.
+    """
+
+    def __init__(self, config, refresh_order_message=None):
+        self.config = config
+        self.refresh_order_message = refresh_order_message
+        self.specs = dict(BUILTIN_BACKENDS)
+        self.specs.update(_entry_points())
+        if 'backends' in config:
+            self.specs.update(config['backends'])
+        # mode -> {'import': seconds, 'init': seconds}
+        self.timings = {}
+        self._classes = {}
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def __getitem__(self, name):
+        if name in self._backends:
+            return self._backends[name]
+        with self._lock:
+            if name not in self._backends:
+                backend_class = self._load_class(name)
+                start = time.perf_counter()
+                backend = backend_class(self.config[name] if name in self.config else None)
+                backend.refresh_order_message = self.refresh_order_message
+                self._backends[name] = backend
+                self.timings[name]['init'] = time.perf_counter() - start
+                logger.info("Set up backend %s: import %.3fs, init %.3fs",
+                            name, self.timings[name]['import'], self.timings[name]['init'])
+            return self._backends[name]
+
+    def keys(self):
+        return self.specs.keys()
+
+    def loaded(self):
+        return list(self._backends.keys())
+
+    def backend_class(self, name):
+        """The backend's class, imported but not set up - enough for its descriptions."""
+        with self._lock:
+            return self._load_class(name)
+
+    def _load_class(self, name):
+        if name not in self._classes:
+            module_name, _, class_name = self.specs[name].partition(':')
+            start = time.perf_counter()
+            module = importlib.import_module(module_name)
+            self._classes[name] = getattr(module, class_name)
+            self.timings[name] = {'import': time.perf_counter() - start, 'init': None}
+        return self._classes[name]
+
+    def report(self):
+        """Logs the available modes and what setting up the loaded ones cost."""
+        logger.info("Available modes: %s", ", ".join(sorted(self.specs.keys())))
+        for name, timing in sorted(self.timings.items()):
+            logger.info("Backend %s: import %.3fs, init %s", name, timing['import'],
+                        "{:.3f}s".format(timing['init']) if timing['init'] is not None else "not yet")
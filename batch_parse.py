@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parses a file of orders, one per line, against a saved Domino's menu - without Telegram or Domino's.
+Writes one JSON object per line with the parsed items (and with --price, the local price estimate),
+and timing stats to stderr. Lines are parsed in several processes.
+
+Usage: python batch_parse.py -m menu.json [-c config.yml] [-o parsed.jsonl] [--price] orders.txt
+"""
+import os
+import sys
+import json
+import time
+import yaml
+import logging
+import multiprocessing
+from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
+
+from menu_parser import parse_menu_file
+
+CHUNK_SIZE = 200  # lines handed to a worker at once
+
+# State of each worker process
+_backend = None
+_menu = None
+
+
+def _init_worker(config, menu_path):
+    global _backend, _menu
+    from dominos import Dominos, Menu
+    logging.getLogger().setLevel(logging.WARNING)
+    _backend = Dominos(config)
+    _menu = Menu(parse_menu_file(menu_path))
+
+
+def _parse_chunk(first, lines, price):
+    results = []
+    for number, line in enumerate(lines, first):
+        start = time.perf_counter()
+        items = _backend.parse_all_orders(line, _menu)
+        result = {
+            'line': number,
+            'order': line,
+            'items': items,
+        }
+        if price:
+            # Deal definitions have to be fetched from Domino's, so deals are left out
+            result['estimate'] = _backend.pricer.estimate([i for i in items if i is not None], _menu, [])
+        result['time'] = time.perf_counter() - start
+        results.append(result)
+    return results
+
+
+def _chunks(lines, size):
+    for i in range(0, len(lines), size):
+        yield i + 1, lines[i:i + size]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = OptionParser(usage="%prog -m menu.json [options] orders.txt")
+    parser.add_option('-m', '--menu', dest='menu', help="Saved Domino's menu (as downloaded from the store)")
+    parser.add_option('-c', '--config', dest='config', default=None,
+                      help="Bot configuration file, whose dominos section is used")
+    parser.add_option('-o', '--output', dest='output', default=None, help="Where to write the results (stdout)")
+    parser.add_option('-p', '--processes', dest='processes', type='int', default=os.cpu_count(),
+                      help="Number of worker processes")
+    parser.add_option('--chunk-size', dest='chunk_size', type='int', default=CHUNK_SIZE)
+    parser.add_option('--price', dest='price', action='store_true', default=False,
+                      help="Also estimate prices from the menu")
+    (opts, args) = parser.parse_args()
+    if not opts.menu or len(args) != 1:
+        parser.error("a menu and a file of orders are required")
+
+    config = {}
+    if opts.config:
+        with open(opts.config, 'r') as configfile:
+            bot_config = yaml.load(configfile, Loader=yaml.BaseLoader)
+        config = bot_config['dominos'] if 'dominos' in bot_config else {}
+    from dominos import parsing_config
+    config = parsing_config(config)
+
+    with open(args[0], 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+
+    out = open(opts.output, 'w', encoding='utf-8') if opts.output else sys.stdout
+    start = time.perf_counter()
+    times = []
+    parsed = 0
+    unmatched = 0
+    try:
+        with ProcessPoolExecutor(
+                max_workers=opts.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(config, opts.menu),
+        ) as executor:
+            futures = [executor.submit(_parse_chunk, first, chunk, opts.price)
+                       for first, chunk in _chunks(lines, opts.chunk_size)]
+            # Results are written in the order of the input
+            for future in futures:
+                for result in future.result():
+                    times.append(result.pop('time'))
+                    parsed += sum(1 for item in result['items'] if item is not None)
+                    unmatched += sum(1 for item in result['items'] if item is None)
+                    out.write(json.dumps(result, ensure_ascii=False))
+                    out.write('\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    duration = time.perf_counter() - start
+
+    sys.stderr.write("{} orders in {:.1f}s ({:.0f}/s) with {} processes: {} items parsed, {} not recognised\n".format(
+        len(lines), duration, len(lines) / duration if duration else 0.0, opts.processes, parsed, unmatched))
+    sys.stderr.write("Per order: p50 {:.2f}ms, p90 {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms\n".format(
+        percentile(times, 0.5) * 1000, percentile(times, 0.9) * 1000, percentile(times, 0.99) * 1000,
+        max(times or [0]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures what caching menus, deals, store information and coordinates costs in each cache tier:
+time per get and set, and how much of it goes into (de)serializing the value.
+
+Usage: python benchmarks/cache_tiers.py [redis://host:port/db]
+Without a Redis URL, only the in-process and SQLite caches are measured.
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cache import LRUCache, SQLiteCache, RedisCache  # noqa: E402
+from menu_parser import parse_menu_chunks  # noqa: E402
+from menu_parsing import synthetic_menu, chunked  # noqa: E402
+
+ROUNDS = 50
+
+
+def values():
+    menu = parse_menu_chunks(chunked(synthetic_menu()))
+    return {
+        'menu': {'menu': menu, 'version': 'bench', 'etag': '"abc"', 'last_modified': None, 'checked': time.time()},
+        'deal': {'deal': {'Code': 'N051', 'Name': 'Double Deal M', 'Price': '39.80',
+                          'ProductGroups': [{'RequiredQty': 2, 'ProductCodes': ['30HTP{}'.format(i)
+                                                                                for i in range(200)]}]},
+                 'checked': time.time()},
+        'store': {'info': {'StoreName': 'Zurich', 'StreetName': 'Street', 'City': 'Zurich',
+                           'Hours': {day: [{'OpenTime': '11:00', 'CloseTime': '23:00'}] for day in 'MTWTFSS'}},
+                  'checked': time.time()},
+        'geocode': [47.37, 8.54],
+    }
+
+
+def measure(cache, kind, value):
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        cache.set('{}:{}'.format(kind, i), value, 60)
+    set_time = (time.perf_counter() - start) / ROUNDS
+    start = time.perf_counter()
+    for i in range(ROUNDS):
+        assert cache.get('{}:{}'.format(kind, i)) is not None
+    return set_time, (time.perf_counter() - start) / ROUNDS
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        caches = [('lru', LRUCache()), ('sqlite', SQLiteCache(os.path.join(directory, 'cache.db')))]
+        if len(sys.argv) > 1:
+            caches.append(('redis', RedisCache(sys.argv[1])))
+
+        print("{:<8} {:<8} {:>10} {:>10} {:>12} {:>12} {:>10}".format(
+            'cache', 'value', 'set (ms)', 'get (ms)', 'encode (ms)', 'decode (ms)', 'size (kB)'))
+        for name, cache in caches:
+            for kind, value in values().items():
+                before = dict(cache.stats)
+                set_time, get_time = measure(cache, kind, value)
+                stats = cache.stats
+                print("{:<8} {:<8} {:>10.3f} {:>10.3f} {:>12.3f} {:>12.3f} {:>10.1f}".format(
+                    name, kind, set_time * 1000, get_time * 1000,
+                    (stats['serialize_time'] - before['serialize_time']) / ROUNDS * 1000,
+                    (stats['deserialize_time'] - before['deserialize_time']) / ROUNDS * 1000,
+                    (stats['bytes_written'] - before['bytes_written']) / ROUNDS / 1024,
+                ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load test: many group chats collecting and placing Domino's orders at the same time.
+
+Runs PollBot in this process, with a fresh database, against a local fake Telegram Bot API and a fake Domino's
+(both served by a single HTTP server on localhost). Every chat goes through /mode, /store, /method, /start,
+a mention (and maybe an edit) per order of each user, /order and the confirm button. Updates arrive at random,
+at `--rate` updates per second in total.
+
+Reports throughput, handler latencies, how long updates waited before being handled, how often Telegram's
+rate limit for the chats was hit, and how long handlers waited for database commits.
+
+Usage: python benchmarks/load_test.py [--chats 50] [--users 8] [--rate 20] [--menu recorded_menu.json]
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import heapq
+import random
+import logging
+import tempfile
+import threading
+from optparse import OptionParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import yaml  # noqa: E402
+from telegram.ext import Updater  # noqa: E402
+from orderbot import PollBot  # noqa: E402
+from throttle import TokenBucket, get_single_flight  # noqa: E402
+import storage  # noqa: E402
+
+TOKEN = '123456789:LoadTestToken'
+BOT_NAME = 'load_test_bot'
+BOT_ID = 123456789
+STORES = 5
+
+ORDERS = [
+    'large hawaii',
+    'small margherita with extra cheese',
+    'hawaii, coke',
+    'medium pepperoni no cheese',
+    'create your own with extra cheese extra mushrooms',
+    'large pepperoni, small hawaii',
+    'coke',
+    'margherita with ham',
+]
+
+HANDLERS = [
+    'start', 'mention', 'button', 'delete', 'set_mode', 'set_backend_specific_setting', 'print_settings',
+    'close_order', 'reopen_order', 'place_order',
+]
+
+
+def synthetic_menu():
+    products = {}
+    variants = {}
+    for code, name, toppings in [
+        ('S_HAW', 'Hawaii', 'X=1,C=1,H=1,A=1'),
+        ('S_MRG', 'Margherita', 'X=1,C=1'),
+        ('S_PEP', 'Pepperoni', 'X=1,C=1,P=1'),
+        ('S_PIZZA', 'Create Your Own', 'X=1,C=1'),
+    ]:
+        short = code[2:]
+        products[code] = {
+            'Code': code, 'Name': name, 'ProductType': 'Pizza', 'DefaultToppings': toppings, 'AvailableSides': '',
+            'Variants': ['{}HT{}'.format(size, short) for size in (25, 30, 35)],
+        }
+        for size, label, price in [(25, 'Small', 15.9), (30, 'Medium', 19.9), (35, 'Large', 24.9)]:
+            variant = '{}HT{}'.format(size, short)
+            variants[variant] = {'Code': variant, 'Name': '{} {}'.format(label, name), 'Price': '{:.2f}'.format(price),
+                                 'ProductCode': code}
+    products['S_COKE'] = {'Code': 'S_COKE', 'Name': 'Coca Cola', 'ProductType': 'Drinks', 'DefaultToppings': '',
+                          'AvailableSides': '', 'Variants': ['COKE05', 'COKE15']}
+    variants['COKE05'] = {'Code': 'COKE05', 'Name': 'Coca Cola 0.5l', 'Price': '3.50', 'ProductCode': 'S_COKE'}
+    variants['COKE15'] = {'Code': 'COKE15', 'Name': 'Coca Cola 1.5l', 'Price': '5.50', 'ProductCode': 'S_COKE'}
+    return {
+        'Products': products,
+        'Variants': variants,
+        'Toppings': {'Pizza': {
+            code: {'Code': code, 'Name': name, 'Tags': {'Sauce': code == 'X'}}
+            for code, name in [('X', 'Tomato Sauce'), ('C', 'Cheese'), ('H', 'Ham'), ('A', 'Pineapple'),
+                               ('P', 'Pepperoni'), ('M', 'Mushrooms')]
+        }},
+        'Sides': {'Pizza': {}},
+        'Coupons': {'N051': {'Code': 'N051', 'Name': 'Double Deal M - 2 medium pizzas', 'Tags': {
+            'Days': ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa', 'Su'], 'ValidServiceMethods': ['Delivery', 'Carryout'],
+        }}},
+    }
+
+
+DEAL = {
+    'Code': 'N051',
+    'Price': '30.00',
+    'ProductGroups': [{'RequiredQty': 2, 'ProductCodes': ['30HTHAW', '30HTMRG', '30HTPEP', '30HTPIZZA']}],
+}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+class FakeApis:
+    """State of the fake Telegram Bot API and the fake Domino's."""
+
+    def __init__(self, menu, send_rate, send_burst, upstream_latency):
+        self.menu_body = json.dumps(menu).encode('utf-8')
+        self.menu_etag = '"{:08x}"'.format(zlib.crc32(self.menu_body))
+        self.prices = {code: float(v['Price']) for code, v in menu['Variants'].items()}
+        self.variant_names = {code: v['Name'] for code, v in menu['Variants'].items()}
+        self.send_rate = send_rate
+        self.send_burst = send_burst
+        self.upstream_latency = upstream_latency
+
+        self.calls = {}
+        self.rate_limited = {}
+        self._updates = []
+        self._updates_cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._message_ids = {}
+        self._buckets = {}
+        # chat -> last message sent with the confirm/cancel buttons
+        self.keyboards = {}
+
+    def count(self, what, counter=None):
+        counter = self.calls if counter is None else counter
+        with self._lock:
+            counter[what] = counter.get(what, 0) + 1
+
+    # Telegram side
+
+    def push_update(self, update):
+        with self._updates_cond:
+            self._updates.append(update)
+            self._updates_cond.notify_all()
+
+    def get_updates(self, params):
+        offset = int(params['offset']) if 'offset' in params and params['offset'] is not None else 0
+        timeout = float(params['timeout']) if 'timeout' in params and params['timeout'] else 0
+        deadline = time.monotonic() + timeout
+        with self._updates_cond:
+            while True:
+                pending = [u for u in self._updates if u['update_id'] >= offset][:100]
+                remaining = deadline - time.monotonic()
+                if pending or remaining <= 0:
+                    return pending
+                self._updates_cond.wait(remaining)
+
+    def _bucket(self, chat_id):
+        with self._lock:
+            if chat_id not in self._buckets:
+                self._buckets[chat_id] = TokenBucket(self.send_rate, self.send_burst)
+            return self._buckets[chat_id]
+
+    def _next_message_id(self, chat_id):
+        with self._lock:
+            self._message_ids[chat_id] = self._message_ids.get(chat_id, 0) + 1
+            return self._message_ids[chat_id]
+
+    def telegram(self, method, params):
+        """Returns (http status, response body)."""
+        self.count(method)
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Load Test',
+                                                'username': BOT_NAME}}
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params['chat_id'])
+            # Like Telegram, only allow so many messages per chat
+            if not self._bucket(chat_id).acquire(timeout=0):
+                self.count(method, self.rate_limited)
+                return 429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1',
+                             'parameters': {'retry_after': 1}}
+            message_id = int(params['message_id']) if method == 'editMessageText' \
+                else self._next_message_id(chat_id)
+            message = {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'group', 'title': 'Load test'},
+                'from': {'id': BOT_ID, 'is_bot': True, 'first_name': 'Load Test', 'username': BOT_NAME},
+                'text': params['text'],
+            }
+            if 'reply_markup' in params and params['reply_markup']:
+                with self._lock:
+                    self.keyboards[chat_id] = message
+            return 200, {'ok': True, 'result': message}
+        if method == 'getMyCommands':
+            return 200, {'ok': True, 'result': []}
+        # deleteWebhook, deleteMessage, answerCallbackQuery...
+        return 200, {'ok': True, 'result': True}
+
+    # Domino's side
+
+    def dominos(self, path, params, body, headers):
+        """Returns (http status, response body, extra headers)."""
+        parts = path.strip('/').split('/')
+        if parts[0] == 'store':
+            self.count('dominos.' + parts[2])
+        elif parts[0] == 'order':
+            self.count('dominos.' + parts[1])
+        else:
+            self.count('dominos.' + parts[0])
+        time.sleep(self.upstream_latency)
+
+        if parts[0] == 'geocode':
+            # The store found later on depends on the location asked for
+            lat = 47.0 + (zlib.crc32(params['location'][0].encode('utf-8')) % STORES) / 100
+            return 200, {'results': [{'locations': [{'latLng': {'lat': lat, 'lng': 8.5}}]}]}, {}
+        if parts[0] == 'locate':
+            store = int(round((float(params['latitude'][0]) - 47.0) * 100))
+            return 200, {'Stores': [{'StoreID': str(9000 + store), 'StoreName': 'Load Test {}'.format(store),
+                                     'StreetName': 'Teststrasse {}'.format(store), 'PostalCode': '8000',
+                                     'City': 'Zürich'}]}, {}
+        if parts[0] == 'store' and parts[2] == 'profile':
+            return 200, {'StoreID': parts[1], 'StoreName': 'Load Test ', 'StreetName': 'Teststrasse ',
+                         'City': 'Zürich '}, {}
+        if parts[0] == 'store' and parts[2] == 'menu':
+            if headers.get('If-None-Match') == self.menu_etag:
+                return 304, None, {'ETag': self.menu_etag}
+            return 200, self.menu_body, {'ETag': self.menu_etag}
+        if parts[0] == 'store' and parts[2] == 'coupon':
+            return 200, DEAL, {}
+
+        order = json.loads(body.decode('cp1252'))
+        if parts[0] == 'order' and parts[1] in ('validate', 'price'):
+            order['Status'] = 0
+            order['Order'].setdefault('Coupons', [])
+            for coupon in order['Order']['Coupons']:
+                coupon['Status'] = 0
+            for product in order['Order']['Products']:
+                product['Status'] = 0
+                if parts[1] == 'price':
+                    product['Price'] = self.prices.get(product['Code'], 10.0)
+                    product['Name'] = self.variant_names.get(product['Code'], product['Code'])
+                    product['CategoryCode'] = 'Pizza'
+            if parts[1] == 'price':
+                order['Order']['Currency'] = 'CHF'
+                order['Order']['Amounts'] = {
+                    'Customer': round(sum(p['Price'] for p in order['Order']['Products']), 2),
+                }
+            return 200, order, {}
+        if parts[0] == 'order' and parts[1] == 'place':
+            order['Status'] = 0
+            order['StatusItems'] = [{'Code': 'Success'}]
+            return 200, order, {}
+        return 404, {'error': path}, {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body, headers=None):
+        if body is None:
+            data = b''
+        elif isinstance(body, bytes):
+            data = body
+        else:
+            data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self):
+        apis = self.server.apis
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+
+        if url.path.startswith('/bot'):
+            method = url.path.rsplit('/', 1)[1]
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if body:
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params.update(json.loads(body.decode('utf-8')))
+                else:
+                    params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()})
+            self._respond(*apis.telegram(method, params))
+        elif url.path.startswith('/dominos/'):
+            status, response, headers = apis.dominos(url.path[len('/dominos'):], parse_qs(url.query), body,
+                                                     self.headers)
+            self._respond(status, response, headers)
+        else:
+            self._respond(404, {'ok': False})
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+def bot_config(base_url, directory, write_window):
+    dominos = base_url + '/dominos'
+    return {
+        'token': TOKEN,
+        'db': os.path.join(directory, 'orders.db'),
+        'bot_name': BOT_NAME,
+        'write_window': str(write_window),
+        'dominos': {
+            'debug': '',
+            'geocode': {'url': dominos + '/geocode?key={key}&location={query}', 'key': 'load-test'},
+            'sourceURI': 'order.dominos.com',
+            'referer': 'https://www.dominos.ch/pages/order/',
+            'regionCode': 'CH',
+            'language': 'en',
+            'market': 'SWITZERLAND',
+            'store': {
+                'find': dominos + '/locate?regionCode={regioncode}&latitude={lat}&longitude={lng}',
+                'info': dominos + '/store/{storeID}/profile',
+                'menu': dominos + '/store/{storeID}/menu?lang={lang}&structured=true',
+                'responseType': 'application/json',
+                'deals': dominos + '/store/{storeID}/coupon/{dealID}?lang={lang}',
+            },
+            'order': {
+                'validate': dominos + '/order/validate',
+                'price': dominos + '/order/price',
+                'place': dominos + '/order/place',
+            },
+        },
+    }
+
+
+class LoadGenerator:
+    """Synthesizes the updates of all chats and hands them to the fake Telegram API on schedule."""
+
+    def __init__(self, apis, chats, users, orders_per_user, edit_ratio, rate, seed):
+        self.apis = apis
+        self.random = random.Random(seed)
+        # update id -> time it was made available to the bot
+        self.sent = {}
+        self._update_id = 0
+        self._message_ids = {}
+        self._events = []
+
+        per_chat_rate = rate / chats
+        for c in range(chats):
+            chat_id = -1000000 - c
+            admin = self._user(c, 0)
+            script = [
+                ('command', admin, '/mode dominos'),
+                ('command', admin, '/store Zürich {}'.format(c % STORES)),
+                ('command', admin, '/method carryout'),
+                ('command', admin, '/start'),
+            ]
+            for _ in range(orders_per_user):
+                for u in range(users):
+                    script.append(('mention', self._user(c, u), self.random.choice(ORDERS)))
+                    if self.random.random() < edit_ratio:
+                        script.append(('edit', self._user(c, u), self.random.choice(ORDERS)))
+            script.append(('command', admin, '/order'))
+            script.append(('confirm', admin, None))
+
+            t = self.random.expovariate(per_chat_rate)
+            for seq, event in enumerate(script):
+                self._events.append((t, chat_id, seq) + event)
+                t += self.random.expovariate(per_chat_rate)
+        heapq.heapify(self._events)
+        self.total = len(self._events)
+        self.skipped = 0
+
+    @staticmethod
+    def _user(chat_index, user_index):
+        return {'id': chat_index * 1000 + user_index + 1, 'is_bot': False,
+                'first_name': 'User{}'.format(user_index)}
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    def _message(self, chat_id, user, text, entity):
+        self._message_ids[chat_id] = self._message_ids.get(chat_id, 10000) + 1
+        return {
+            'message_id': self._message_ids[chat_id],
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'Load test'},
+            'from': user,
+            'text': text,
+            'entities': [entity],
+        }
+
+    def _update(self, chat_id, kind, user, text, last_mentions):
+        update = {'update_id': self._next_id()}
+        if kind == 'command':
+            command = text.split(' ')[0]
+            update['message'] = self._message(chat_id, user, text,
+                                              {'type': 'bot_command', 'offset': 0, 'length': len(command)})
+        elif kind in ('mention', 'edit'):
+            text = '{} @{}'.format(text, BOT_NAME)
+            entity = {'type': 'mention', 'offset': text.index('@'), 'length': len(BOT_NAME) + 1}
+            if kind == 'edit' and (chat_id, user['id']) in last_mentions:
+                message = dict(last_mentions[(chat_id, user['id'])], text=text, entities=[entity],
+                               edit_date=int(time.time()))
+                update['edited_message'] = message
+            else:
+                message = self._message(chat_id, user, text, entity)
+                last_mentions[(chat_id, user['id'])] = message
+                update['message'] = message
+        else:
+            if chat_id not in self.apis.keyboards:
+                return None
+            update['callback_query'] = {
+                'id': str(update['update_id']),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'data': 'confirm',
+                'message': self.apis.keyboards[chat_id],
+            }
+        return update
+
+    def run(self):
+        start = time.perf_counter()
+        last_mentions = {}
+        retries = {}
+        while self._events:
+            t, chat_id, seq, kind, user, text = heapq.heappop(self._events)
+            delay = start + t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            update = self._update(chat_id, kind, user, text, last_mentions)
+            if update is None:
+                # The confirmation message isn't there yet: try again a bit later, for a while
+                retries[chat_id] = retries.get(chat_id, 0) + 1
+                if retries[chat_id] <= 20:
+                    heapq.heappush(self._events, (t + 0.5, chat_id, seq, kind, user, text))
+                else:
+                    self.skipped += 1
+                continue
+            self.sent[update['update_id']] = time.perf_counter()
+            self.apis.push_update(update)
+
+
+class Recorder:
+    """Wraps PollBot's handlers to time them."""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.latencies = {}
+        self.delays = []
+        self.handled = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def wrap(self, name, handler):
+        def timed(*args):
+            update = next((a for a in args if hasattr(a, 'update_id')), None)
+            start = time.perf_counter()
+            try:
+                return handler(*args)
+            finally:
+                end = time.perf_counter()
+                with self._lock:
+                    self.latencies.setdefault(name, []).append(end - start)
+                    self.handled += 1
+                    if update is not None and update.update_id in self.generator.sent:
+                        self.delays.append(start - self.generator.sent[update.update_id])
+        return timed
+
+    def wrap_error(self, handler):
+        def counted(update, context):
+            with self._lock:
+                self.errors += 1
+            return handler(update, context)
+        return counted
+
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option('--chats', type='int', default=50, help="Number of group chats")
+    parser.add_option('--users', type='int', default=8, help="Users ordering in each chat")
+    parser.add_option('--orders', type='int', default=1, help="Orders each user sends")
+    parser.add_option('--edits', type='float', default=0.2, help="Share of orders that get edited afterwards")
+    parser.add_option('--rate', type='float', default=20.0, help="Updates per second, over all chats")
+    parser.add_option('--send-rate', type='float', default=1.0,
+                      help="Messages per second the fake Telegram accepts per chat before answering 429")
+    parser.add_option('--send-burst', type='float', default=5.0, help="Burst of messages allowed per chat")
+    parser.add_option('--upstream-latency', type='float', default=0.05, help="Seconds each Domino's call takes")
+    parser.add_option('--write-window', type='float', default=storage.WRITE_WINDOW)
+    parser.add_option('--menu', type='string', default=None, help="Recorded Domino's menu to serve")
+    parser.add_option('--drain', type='float', default=60.0,
+                      help="Seconds to wait for the bot to catch up after the last update")
+    parser.add_option('--seed', type='int', default=1)
+    (opts, args) = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if opts.menu:
+        with open(opts.menu, 'r', encoding='utf-8') as f:
+            menu = json.load(f)
+    else:
+        menu = synthetic_menu()
+    apis = FakeApis(menu, opts.send_rate, opts.send_burst, opts.upstream_latency)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.apis = apis
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, 'config.yml')
+        with open(config_path, 'w') as f:
+            yaml.safe_dump(bot_config(base_url, directory, opts.write_window), f)
+
+        poll_bot = PollBot()
+        poll_bot.setup(config_path)
+        storage.ensure_schema(poll_bot.db)
+
+        generator = LoadGenerator(apis, opts.chats, opts.users, opts.orders, opts.edits, opts.rate, opts.seed)
+        recorder = Recorder(generator)
+        for name in HANDLERS:
+            setattr(poll_bot, name, recorder.wrap(name, getattr(poll_bot, name)))
+        poll_bot.error = recorder.wrap_error(poll_bot.error)
+
+        updater = Updater(TOKEN, base_url=base_url + '/bot')
+        poll_bot.register_handlers(updater.dispatcher)
+        updater.start_polling(poll_interval=0, timeout=1)
+
+        print("{} chats x {} users: {} updates at {:.0f}/s".format(opts.chats, opts.users, generator.total, opts.rate))
+        start = time.perf_counter()
+        generator.run()
+        sent = len(generator.sent)
+        deadline = time.perf_counter() + opts.drain
+        while (recorder.handled < sent or poll_bot.outbox.depth()) and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        duration = time.perf_counter() - start
+
+        updater.stop()
+        poll_bot.writes.barrier()
+        server.shutdown()
+
+    print()
+    print("Updates: {} sent, {} handled, {} confirmations never possible, {} errors".format(
+        sent, recorder.handled, generator.skipped, recorder.errors))
+    print("Throughput: {:.1f} updates/s over {:.1f}s".format(recorder.handled / duration, duration))
+    print()
+    print("{:<30} {:>6} {:>9} {:>9} {:>9} {:>9}".format('handler (ms)', 'count', 'p50', 'p90', 'p99', 'max'))
+    for name, values in sorted(recorder.latencies.items()):
+        print("{:<30} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            name, len(values), percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000,
+            percentile(values, 0.99) * 1000, max(values) * 1000))
+    print("{:<30} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+        'waiting before handled', len(recorder.delays), percentile(recorder.delays, 0.5) * 1000,
+        percentile(recorder.delays, 0.9) * 1000, percentile(recorder.delays, 0.99) * 1000,
+        max(recorder.delays or [0]) * 1000))
+    print()
+    print("Telegram calls: {}".format(", ".join(
+        "{} {}".format(k, v) for k, v in sorted(apis.calls.items()) if not k.startswith('dominos.'))))
+    print("Rate limited (429): {}".format(", ".join(
+        "{} {}".format(k, v) for k, v in sorted(apis.rate_limited.items())) or "none"))
+    print("Domino's calls: {}".format(", ".join(
+        "{} {}".format(k[len('dominos.'):], v) for k, v in sorted(apis.calls.items()) if k.startswith('dominos.'))))
+    stats = get_single_flight('dominos').stats
+    print("Domino's requests shared: {} of {}, {} failed, {} waits timed out".format(
+        stats['shared'], stats['calls'] + stats['shared'], stats['errors'], stats['timeouts']))
+    stats = poll_bot.writes.stats
+    print("Database: {} writes in {} transactions, {} waits for a commit taking {:.1f}ms on average".format(
+        stats['writes'], stats['transactions'], stats['waits'],
+        stats['wait_time'] / stats['waits'] * 1000 if stats['waits'] else 0.0))
+    stats = poll_bot.outbox.stats
+    print("Send queue: {} sent, {} edits merged, {} retried, {} failed, waiting {:.1f}ms on average "
+          "(at most {:.1f}ms), at most {} queued".format(
+              stats['sent'], stats['coalesced'], stats['retried'], stats['failed'],
+              stats['wait_time'] / stats['sent'] * 1000 if stats['sent'] else 0.0, stats['max_wait'] * 1000,
+              stats['max_depth']))
+
+
+if __name__ == '__main__':
+    main()
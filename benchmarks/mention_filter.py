@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the per-message cost of MentionFilter over a stream of group messages.
+
+Usage: python benchmarks/mention_filter.py [recorded_updates.jsonl]
+The optional file holds one Telegram update (as returned by getUpdates) per line. Without it, a synthetic
+stream of a chatty group is generated, in which only a few messages mention the bot.
+"""
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telegram import Update, Message, MessageEntity, Chat, User  # noqa: E402
+from mentions_handler import MentionFilter  # noqa: E402
+
+BOT_NAME = 'pentachoron_bot'
+WORDS = ['pizza', 'lunch', 'today', 'who', 'is', 'in', 'the', 'office', 'meeting', 'at', 'noon', 'große', 'hunger',
+         'ok', 'sounds', 'good', '🍕', '😂', 'thanks', 'sure']
+
+
+def legacy_filter(username, message):
+    """MentionFilter.filter as it was before the fast path."""
+    res = False
+    for entity in message.entities:
+        if entity.type == "mention":
+            unicode_text = message.text.encode('utf-16')
+            mentioned = unicode_text[(entity.offset + 2) * 2:(entity.offset + entity.length + 1) * 2]
+            if mentioned.decode('utf-16') == username:
+                res = True
+    return res
+
+
+def utf16_len(text):
+    return len(text.encode('utf-16-le')) // 2
+
+
+def synthetic_messages(count=20000, mention_ratio=0.03, other_mention_ratio=0.1, entity_ratio=0.2, seed=1):
+    rng = random.Random(seed)
+    chat = Chat(-1001, 'supergroup')
+    user = User(1, 'Herbert', False)
+    messages = []
+    for i in range(count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+        entities = []
+        roll = rng.random()
+        if roll < mention_ratio + other_mention_ratio:
+            name = BOT_NAME if roll < mention_ratio else 'someone_else'
+            position = rng.randint(0, len(words))
+            words.insert(position, '@' + name)
+            offset = utf16_len(' '.join(words[:position]) + (' ' if position else ''))
+            entities.append(MessageEntity('mention', offset, utf16_len(name) + 1))
+        elif roll < mention_ratio + other_mention_ratio + entity_ratio:
+            # Formatting, links and the like
+            entities.append(MessageEntity('bold', 0, utf16_len(words[0])))
+        messages.append(Message(i, None, chat, from_user=user, text=' '.join(words), entities=entities))
+    return messages
+
+
+def recorded_messages(path):
+    messages = []
+    with open(path) as f:
+        for line in f:
+            update = Update.de_json(json.loads(line), None)
+            message = update.effective_message
+            if message is not None and message.text is not None:
+                messages.append(message)
+    return messages
+
+
+def measure(func, messages, repeat=5):
+    best = None
+    matched = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        matched = sum(1 for m in messages if func(m))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(messages), matched
+
+
+def main():
+    messages = recorded_messages(sys.argv[1]) if len(sys.argv) > 1 else synthetic_messages()
+    mention_filter = MentionFilter(BOT_NAME)
+
+    legacy, legacy_matched = measure(lambda m: legacy_filter(BOT_NAME, m), messages)
+    current, matched = measure(mention_filter.filter, messages)
+    assert matched == legacy_matched
+
+    print("{} messages, {} mention the bot".format(len(messages), matched))
+    print("    legacy: {:6.2f} us/message".format(legacy * 1e6))
+    print("    filter: {:6.2f} us/message".format(current * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import time
+import json
+import socket
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+LRU_SIZE = 1024
+LOCAL_TTL = 60  # seconds an entry read from the shared cache is used before reading it again
+SQLITE_TIMEOUT = 5
+REDIS_TIMEOUT = 1
+PURGE_EVERY = 500  # writes between removing expired entries from the SQLite cache
+
+
+def _stats():
+    return {
+        'hits': 0,
+        'misses': 0,
+        'sets': 0,
+        'errors': 0,
+        'bytes_read': 0,
+        'bytes_written': 0,
+        'serialize_time': 0.0,
+        'deserialize_time': 0.0,
+    }
+
+
+class LRUCache:
+    """
+    In-process cache. Values are stored as they are, so callers must not modify what they put in or get out.
+
+    All caches share the same semantics: `set(key, value, ttl)` keeps the value for `ttl` seconds, after which `get`
+    returns None as if it had never been set. Whether a value is still fresh enough to use is up to the caller;
+    the ttl only says how long it is worth keeping (e.g. as a fallback while the upstream is down).
+    """
+
+    def __init__(self, maxsize=LRU_SIZE):
+        self.maxsize = maxsize
+        self.stats = _stats()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            self.stats['sets'] += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class _SharedCache:
+    """
+    Base of the caches shared between processes: values are stored as JSON along with their expiry time, so every
+    implementation expires them the same way. Failing to reach the cache, or finding something in it which isn't
+    ours, is logged and treated as a miss.
+
+    Only plain data (dicts, lists, strings, numbers) can be cached, and tuples come back as lists. Being JSON,
+    whoever can write to the shared cache can make the bot show wrong menus or prices, but not run code in it.
+    """
+
+    def get(self, key):
+        try:
+            data = self._get(key)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning("Could not read %s from the cache: %s", key, e)
+            return None
+        if data is None:
+            self.stats['misses'] += 1
+            return None
+
+        start = time.perf_counter()
+        try:
+            expires, value = json.loads(data.decode('utf-8'))
+        except (ValueError, TypeError) as e:
+            self.stats['errors'] += 1
+            logger.warning("Ignoring unreadable cache entry %s: %s", key, e)
+            return None
+        finally:
+            self.stats['deserialize_time'] += time.perf_counter() - start
+        self.stats['bytes_read'] += len(data)
+        if expires <= time.time():
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return value
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl
+        start = time.perf_counter()
+        data = json.dumps([expires, value], separators=(',', ':')).encode('utf-8')
+        self.stats['serialize_time'] += time.perf_counter() - start
+        try:
+            self._set(key, data, expires, ttl)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning("Could not write %s to the cache: %s", key, e)
+            return
+        self.stats['sets'] += 1
+        self.stats['bytes_written'] += len(data)
+
+    def delete(self, key):
+        try:
+            self._delete(key)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.warning("Could not remove %s from the cache: %s", key, e)
+
+
+class SQLiteCache(_SharedCache):
+    """Cache in a SQLite file, shared by all bot processes on the same machine."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = _stats()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=SQLITE_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        # Losing the last writes in a power cut is fine for a cache, waiting for the disk on every write isn't
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def _get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _set(self, key, data, expires, ttl):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                             (key, data, expires))
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                self._db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+
+    def _delete(self, key):
+        with self._lock:
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisCache(_SharedCache):
+    """
+    Cache in Redis (or anything speaking its protocol), shared by bot instances on any machine.
+    `url` looks like redis://[:password@]host[:port][/db]. Only GET, SET and DEL are used.
+    """
+
+    def __init__(self, url, timeout=REDIS_TIMEOUT):
+        parts = urlsplit(url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 6379
+        self.password = parts.password
+        self.db = int(parts.path.strip('/') or 0)
+        self.timeout = timeout
+        self.stats = _stats()
+        self._lock = threading.Lock()
+        self._socket = None
+        self._reader = None
+
+    def _connect(self):
+        self._socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._socket.makefile('rb')
+        if self.password:
+            self._call('AUTH', self.password)
+        if self.db:
+            self._call('SELECT', str(self.db))
+
+    def _close(self):
+        if self._socket is not None:
+            try:
+                self._reader.close()
+                self._socket.close()
+            except OSError:
+                pass
+        self._socket = None
+        self._reader = None
+
+    @staticmethod
+    def _encode(args):
+        out = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if isinstance(arg, str):
+                arg = arg.encode('utf-8')
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(out)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest
+        if kind == b'-':
+            raise RedisError(rest.decode('utf-8', errors='replace'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self._reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("connection closed")
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RedisError("unexpected reply {!r}".format(line))
+
+    def _call(self, *args):
+        self._socket.sendall(self._encode(args))
+        return self._read_reply()
+
+    def call(self, *args):
+        """Sends one command and returns its reply, reconnecting once if the connection was lost."""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    return self._call(*args)
+                except (OSError, ConnectionError):
+                    self._close()
+                    if attempt:
+                        raise
+
+    def _get(self, key):
+        return self.call('GET', key)
+
+    def _set(self, key, data, expires, ttl):
+        self.call('SET', key, data, 'PX', str(max(1, int(ttl * 1000))))
+
+    def _delete(self, key):
+        self.call('DEL', key)
+
+
+class TieredCache:
+    """
+    A shared cache with an in-process cache in front of it. Entries read from the shared cache are kept locally
+    for at most `local_ttl` seconds, so changes made by other instances show up after that.
+    """
+
+    def __init__(self, shared, local_ttl=LOCAL_TTL, maxsize=LRU_SIZE):
+        self.shared = shared
+        self.local = LRUCache(maxsize)
+        self.local_ttl = local_ttl
+        self.stats = shared.stats
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, self.local_ttl)
+        return value
+
+    def set(self, key, value, ttl):
+        self.local.set(key, value, min(ttl, self.local_ttl))
+        self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+
+def open_cache(config):
+    """
+    The cache described by a `cache` config section:
+    `backend` is lru (default), sqlite (with `path`) or redis (with `url`); `local_ttl` applies to the shared ones.
+    """
+    backend = config['backend'] if 'backend' in config else 'lru'
+    size = int(config['size']) if 'size' in config else LRU_SIZE
+    if backend == 'lru':
+        return LRUCache(size)
+    if backend == 'sqlite':
+        shared = SQLiteCache(config['path'])
+    elif backend == 'redis':
+        shared = RedisCache(config['url'], float(config['timeout']) if 'timeout' in config else REDIS_TIMEOUT)
+    else:
+        raise ValueError("Unknown cache backend {}".format(backend))
+    return TieredCache(shared, float(config['local_ttl']) if 'local_ttl' in config else LOCAL_TTL, size)
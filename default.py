@@ -1,20 +1,40 @@
 class Default:
+    # Class attributes, so the list of modes can be shown without setting up every backend
+    mode_selected_message = "This is the default mode. I will simply collect your orders, " \
+                            "but not do anything else."
+    short_description = "Just collect orders, nothing else."
+    # Set by the bot: called with a chat id and collection uuid when the chat's order message should be shown
+    # again without an update having come in, e.g. because prices that took too long are finally there
+    refresh_order_message = None
+
     def __init__(self, config):
         self.config = config
-        self.mode_selected_message = "This is the default mode. I will simply collect your orders, " \
-                                     "but not do anything else."
-        self.short_description = "Just collect orders, nothing else."
 
-    def get_orders_as_string(self, collection, orders):
+    def get_orders_as_string(self, snapshot):
         return ""
 
-    def get_confirmation_message(self, collection, orders):
+    def get_confirmation_message(self, snapshot):
         return "Uh oh - your selected mode does not support ordering. Either" \
                " select a different mode, or use the /close command instead.", "", True
 
-    def place_order(self, collection, orders, data):
+    def place_order(self, snapshot, data):
         return "Ordering is not supported", True
 
+    def warm_up_key(self, settings):
+        """What warm_up() would fetch for these settings (chats with equal keys are warmed up once), or None."""
+        return None
+
+    def warm_up(self, settings):
+        """Called at startup for every chat using this mode, to fetch whatever the backend will need."""
+        pass
+
+    def prefetch(self, settings):
+        """
+        Called when a chat selects this mode or changes its settings. Like warm_up(), but has to return right away
+        and do the fetching in the background.
+        """
+        pass
+
     def set(self, key, arg, settings):
         if key == 'store':
             return self.set_store(arg, settings)
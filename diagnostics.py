@@ -0,0 +1,181 @@
+import os
+import gzip
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+CAPTURE_SAMPLE = 1.0
+CAPTURE_MAX_BYTES = 10 * 1024 * 1024
+CAPTURE_FILES = 5
+CAPTURE_QUEUE_SIZE = 1000
+STATS_INTERVAL = 300  # seconds between logging the stats of the bot's queues and caches
+
+# Attributes every LogRecord has - anything else was passed in `extra` and goes into structured records
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """One JSON object per record, including whatever was passed to the logger as `extra`."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(config):
+    """
+    Makes logging asynchronous: log calls only put the record in a queue, and a background thread
+    does the formatting (apart from the message itself) and the writing.
+    With `log_format: json`, records are written as JSON lines.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    root = logging.getLogger()
+    handlers = root.handlers[:] or [logging.StreamHandler()]
+    formatter = StructuredFormatter() if 'log_format' in config and config['log_format'] == 'json' \
+        else logging.Formatter(LOG_FORMAT)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+        root.removeHandler(handler)
+
+    log_queue = queue.Queue()
+    root.addHandler(QueueHandler(log_queue))
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+class StatsReporter:
+    """
+    Logs the counters of the registered parts of the bot every `interval` seconds, from a background thread.
+    Each source is a function returning a dict of numbers; with `log_format: json` they are also logged as fields.
+    """
+
+    def __init__(self, interval=STATS_INTERVAL):
+        self.interval = interval
+        self._sources = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, name, source):
+        with self._lock:
+            self._sources.append((name, source))
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='stats', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        with self._lock:
+            sources = list(self._sources)
+        for name, source in sources:
+            try:
+                stats = dict(source())
+            except Exception:
+                logger.exception("Could not get the %s stats", name)
+                continue
+            logger.info("%s stats: %s", name, ", ".join(
+                "{} {}".format(key, round(value, 3) if isinstance(value, float) else value)
+                for key, value in stats.items()), extra={'stats': name, 'values': stats})
+
+
+class PayloadCapture:
+    """
+    Keeps a sample of the requests sent to an upstream and its responses, gzip compressed, in rotating files
+    (`payloads.jsonl.gz`, `payloads.jsonl.gz.1`...). Capturing only queues the raw bytes; decoding, compressing
+    and writing happens in a background thread. If that thread can't keep up, payloads are dropped.
+    """
+
+    def __init__(self, directory, sample=CAPTURE_SAMPLE, max_bytes=CAPTURE_MAX_BYTES, files=CAPTURE_FILES):
+        self.directory = directory
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.files = files
+        self.path = os.path.join(directory, 'payloads.jsonl.gz')
+        self.stats = {
+            'captured': 0,
+            'dropped': 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(CAPTURE_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name='payload-capture', daemon=True)
+        self._thread.start()
+
+    def capture(self, endpoint, request, response, **meta):
+        """`request` and `response` are the raw bodies (bytes) as sent and received."""
+        if self.sample < 1 and random.random() >= self.sample:
+            return
+        try:
+            self._queue.put_nowait((time.time(), endpoint, request, response, meta))
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                self._write(*item)
+                self.stats['captured'] += 1
+            except Exception as e:
+                logger.warning("Could not write captured payload: %s", e)
+
+    @staticmethod
+    def _decode(body):
+        if body is None:
+            return None
+        if isinstance(body, bytes):
+            # Domino's gets cp1252 from us, but answers in utf-8
+            for encoding in ('utf-8', 'cp1252'):
+                try:
+                    return json.loads(body.decode(encoding))
+                except ValueError:
+                    continue
+            return body.decode('utf-8', errors='replace')
+        return body
+
+    def _write(self, timestamp, endpoint, request, response, meta):
+        record = dict(meta, time=timestamp, endpoint=endpoint,
+                      request=self._decode(request), response=self._decode(response))
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+            self._rotate()
+        # Every record is a gzip member of its own; gzip readers see the file as one stream of lines
+        with open(self.path, 'ab') as f:
+            f.write(gzip.compress(line))
+
+    def _rotate(self):
+        for i in range(self.files - 1, 0, -1):
+            source = self.path if i == 1 else '{}.{}'.format(self.path, i - 1)
+            if os.path.exists(source):
+                os.replace(source, '{}.{}'.format(self.path, i))
+        if os.path.exists(self.path):
+            os.remove(self.path)
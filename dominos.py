@@ -4,9 +4,22 @@ import logging
 import datetime
 import json
 import re
+import hashlib
+import threading
+import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from urllib.parse import quote_plus
-from unicodedata import normalize
 from default import Default
+from menu_parser import parse_menu_chunks, MenuParseError
+from order_tokens import tokenize_order, SearchIndex
+from throttle import UpstreamUnavailable, get_limiter, get_breaker, get_single_flight
+from pricing import LocalPricer, assign_deals, partition_items
+from parse_pool import ParsePool, MIN_ORDERS
+from rendering import FragmentCache
+from menu_snapshots import MenuSnapshotStore, SNAPSHOT_MAX_BYTES
+from cache import open_cache, LRUCache
+from diagnostics import PayloadCapture, CAPTURE_SAMPLE, CAPTURE_MAX_BYTES, CAPTURE_FILES
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +45,10 @@ synonyms_large = [
 ]
 
 STANDARD, SMALL, LARGE = 30, 25, 35
+SIZE_WORDS = dict(
+    [(w, SMALL) for w in synonyms_small] +
+    [(w, LARGE) for w in synonyms_large]
+)
 PIZZA_CODE_PREFIX = 'HT'  # H = standard crust. Dunno what the T stands for but it's the only option.
 
 CUSTOMIZE_MARGHERITA = [
@@ -46,11 +63,56 @@ PLAIN_MARGHERITA = [
 
 PLAIN_MARGHERITA_CODE = "S_MRG"
 
+MENU_CHUNK_SIZE = 64 * 1024
+MENU_REFRESH_INTERVAL = 300  # seconds during which a downloaded menu is used without asking Domino's again
+DEAL_REFRESH_INTERVAL = 3600
+STORE_REFRESH_INTERVAL = 3600
+# Seconds cached menus, deals and store information are kept - past their refresh interval, they are still used
+# for conditional requests and while Domino's is down
+CACHE_TTL = 24 * 3600
+GEOCODE_TTL = 30 * 24 * 3600
+PARSED_CACHE_SIZE = 256  # collections whose parsed orders are kept
+MENU_OBJECTS = 128  # menus kept ready to use, along with their search indexes
+MAX_ORDER_ITEMS = 25  # bigger collections are split into several Domino's orders
+PRICING_PARALLELISM = 4  # parts of a split order validated and priced at the same time
+RENDER_BUDGET = 3  # seconds the order message waits for prices before showing the last ones that worked
+RENDER_THREADS = 4
+PREFETCH_THREADS = 2
+LAST_GOOD_TTL = 24 * 3600
+LAST_GOOD_TEXTS = 512  # collections whose last priced order message is kept
+
+# Requests per second we allow ourselves per kind of upstream call, shared by all chats. Overridable in the config.
+RATE_LIMITS = {
+    'store': 5,
+    'menu': 5,
+    'deals': 10,
+    'validate': 5,
+    'price': 5,
+    'place': 2,
+    'geocode': 5,
+}
+RATE_LIMIT_WAIT = 5  # seconds to wait for the rate limiter before giving up
+REQUEST_TIMEOUT = 15
+COALESCE_TIMEOUT = 30  # seconds to wait for someone else's download of the same menu, deal, ... before giving up
+BREAKER_FAILURES = 5  # consecutive failures after which we stop calling Domino's for a while
+BREAKER_RESET = 30
+
+PRICING_UNAVAILABLE = "Pricing is temporarily unavailable because Domino's is not responding. " \
+                      "I'm still collecting your orders."
+STALE_PRICING = "_Domino's is not responding right now. These prices are from {}, " \
+                "so they may not include the latest orders._"
+
 SAUCE_WORDS = [
     'sauce',
     'base',
 ]
 
+NO, EXTRA, SAUCE = 'no', 'extra', 'sauce'
+MODIFIER_WORDS = dict(
+    [('no', NO), ('extra', EXTRA)] +
+    [(w, SAUCE) for w in SAUCE_WORDS]
+)
+
 DEALS = [
     'NEWCT1',  # New Crazy Tuesday
     'MEGACC',  # Mega Week with coke
@@ -64,13 +126,9 @@ DEALS = [
 ]
 
 
-def commonprefix(a, b):
-    if a > b:
-        return commonprefix(b, a)
-    for i, c in enumerate(a):
-        if c != b[i]:
-            return a[:i]
-    return a
+def parsing_config(config):
+    """The config for a Dominos instance that only parses orders, e.g. in another process."""
+    return {k: v for k, v in config.items() if k not in ('parse_processes', 'snapshot_dir', 'capture_dir', 'cache')}
 
 
 def capitalize(s):
@@ -78,12 +136,99 @@ def capitalize(s):
 
 
 class Dominos(Default):
+    mode_selected_message = "You're using Domino's Pizza Mode. I will try to interpret your orders " \
+                            "as Domino's Pizza Menu Items, and when you submit it, I will order at " \
+                            "your configured Domino's Pizza Store."
+    short_description = "Order at Domino's Pizza stores in Switzerland"
+
     def __init__(self, config):
         Default.__init__(self, config)
-        self.mode_selected_message = "You're using Domino's Pizza Mode. I will try to interpret your orders " \
-                                     "as Domino's Pizza Menu Items, and when you submit it, I will order at " \
-                                     "your configured Domino's Pizza Store."
-        self.short_description = "Order at Domino's Pizza stores in Switzerland"
+        self.menu_refresh_interval = float(config['menu_refresh']) if 'menu_refresh' in config \
+            else MENU_REFRESH_INTERVAL
+        # Menus ({'menu', 'version', 'etag', 'last_modified', 'checked'}, with the projected menu JSON), deals
+        # ({'deal', 'checked'}), store information ({'info', 'checked'}) and coordinates, possibly shared with other
+        # instances of the bot
+        self.cache = open_cache(config['cache'] if 'cache' in config else {})
+        # menu version -> Menu, so the search indexes are only built once per menu
+        self._menus = OrderedDict()
+        self._menus_lock = threading.Lock()
+        # (snapshot hash, menu version) -> parsed orders
+        self._parsed = OrderedDict()
+        self._parsed_lock = threading.Lock()
+
+        self.currency = config['currency'] if 'currency' in config else 'CHF'
+        self.max_order_items = int(config['max_order_items']) if 'max_order_items' in config else MAX_ORDER_ITEMS
+        self.max_order_amount = float(config['max_order_amount']) if 'max_order_amount' in config else None
+        # The config is read with the BaseLoader, so this is a string
+        self.debug = 'debug' in config and str(config['debug']).lower() in ('true', 'yes', 'on', '1')
+        # Samples of what was sent to and received from Domino's, written in the background
+        self.capture = None
+        if 'capture_dir' in config:
+            self.capture = PayloadCapture(
+                config['capture_dir'],
+                float(config['capture_sample']) if 'capture_sample' in config else CAPTURE_SAMPLE,
+                int(float(config['capture_max_mb']) * 1024 * 1024) if 'capture_max_mb' in config
+                else CAPTURE_MAX_BYTES,
+                int(config['capture_files']) if 'capture_files' in config else CAPTURE_FILES,
+            )
+        self.fragments = FragmentCache()
+        # The order message is priced in the background, and only waited for up to `render_budget` seconds
+        self.render_budget = float(config['render_budget']) if 'render_budget' in config else RENDER_BUDGET
+        self._renderer = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix='render')
+        # collection uuid -> pricing still in progress
+        self._rendering = {}
+        # collection uuid -> latest snapshot that came in meanwhile, priced once the one in progress is done
+        self._pending = {}
+        # collections shown with old prices while pricing was in progress: their message gets refreshed after it
+        self._stale = set()
+        # collection uuid -> (snapshot hash, text) priced in the background, for the refresh of the message
+        self._repriced = {}
+        self._rendering_lock = threading.Lock()
+        # collection uuid -> last order message that could be priced. Kept apart from the cache, so busy chats don't
+        # push menus out of it.
+        self._last_good = LRUCache(LAST_GOOD_TEXTS)
+        # What chats which just chose this mode or a store will need is fetched in the background
+        self._prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix='prefetch')
+        # warm_up_key() of the prefetches queued or running
+        self._prefetching = set()
+        self._prefetching_lock = threading.Lock()
+
+        # Big collections can be parsed in other processes, so they don't hold up everything else
+        self.parse_pool = None
+        if 'parse_processes' in config and int(config['parse_processes']) > 0:
+            worker_config = parsing_config(config)
+            self.parse_pool = ParsePool(
+                worker_config,
+                int(config['parse_processes']),
+                int(config['parse_min_orders']) if 'parse_min_orders' in config else MIN_ORDERS,
+            )
+        self.pricer = LocalPricer(config['topping_prices'] if 'topping_prices' in config else None)
+
+        limits = dict(RATE_LIMITS)
+        if 'limits' in config:
+            limits.update({k: float(v) for k, v in config['limits'].items()})
+        self._limiters = {endpoint: get_limiter('dominos.' + endpoint, rate) for endpoint, rate in limits.items()}
+        self.limit_wait = float(config['limit_wait']) if 'limit_wait' in config else RATE_LIMIT_WAIT
+        self.request_timeout = float(config['timeout']) if 'timeout' in config else REQUEST_TIMEOUT
+        # Geocoding is a different service, so it gets its own circuit
+        self._breakers = {
+            'dominos': get_breaker('dominos', BREAKER_FAILURES, BREAKER_RESET),
+            'geocode': get_breaker('geocode', BREAKER_FAILURES, BREAKER_RESET),
+        }
+        # Chats asking for the same menu, deal, ... at the same time share one download of it
+        self._flights = get_single_flight('dominos')
+        self.coalesce_timeout = float(config['coalesce_timeout']) if 'coalesce_timeout' in config \
+            else COALESCE_TIMEOUT
+
+        # Menus saved to disk, so a restart doesn't mean downloading and parsing all of them again
+        self.snapshots = None
+        if 'snapshot_dir' in config:
+            self.snapshots = MenuSnapshotStore(
+                config['snapshot_dir'],
+                int(float(config['snapshot_max_mb']) * 1024 * 1024) if 'snapshot_max_mb' in config
+                else SNAPSHOT_MAX_BYTES,
+            )
+            self._load_snapshots()
 
     def get_stores_near(self, query):
         lat, lng = self._get_coordinates(query)
@@ -94,7 +239,7 @@ class Dominos(Default):
             lng=str(lng),
         )
 
-        response = requests.get(url, headers=self._get_headers(add_response_type=True)).json()
+        response = self._request_json('store', 'get', url, headers=self._get_headers(add_response_type=True))
         return response['Stores']
 
     def get_closest_store(self, query):
@@ -104,29 +249,249 @@ class Dominos(Default):
         return stores[0]
 
     def get_store_info(self, store_id):
+        key = 'store:{}'.format(store_id)
+        cached = self.cache.get(key)
+        if cached is not None and time.time() - cached['checked'] < STORE_REFRESH_INTERVAL:
+            return cached['info']
+
+        try:
+            return self._flights.do(('store', store_id), lambda: self._fetch_store_info(key, store_id),
+                                    self.coalesce_timeout)
+        except UpstreamUnavailable:
+            if cached is None:
+                raise
+            return cached['info']
+
+    def _fetch_store_info(self, key, store_id):
         url = self.config['store']['info'].format(
             storeID=store_id
         )
-        return requests.get(url, headers=self._get_headers(add_response_type=True)).json()
+        store_info = self._request_json('store', 'get', url, headers=self._get_headers(add_response_type=True))
+        self.cache.set(key, {
+            'info': store_info,
+            'checked': time.time(),
+        }, CACHE_TTL)
+        return store_info
+
+    def warm_up_key(self, settings):
+        if 'store_id' not in settings:
+            return None
+        return settings['store_id'], settings['service_method'] if 'service_method' in settings else 'Delivery'
+
+    def warm_up(self, settings):
+        """Fetches everything a chat with these settings is going to need, so its first message is quick."""
+        if 'store_id' not in settings:
+            return
+        menu = self.get_menu_from_store(settings['store_id'])
+        self.get_available_deals(
+            menu,
+            settings['store_id'],
+            settings['service_method'] if 'service_method' in settings else 'Delivery',
+        )
+        self.get_store_info(settings['store_id'])
+
+    def prefetch(self, settings):
+        key = self.warm_up_key(settings)
+        if key is None:
+            return
+        with self._prefetching_lock:
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+        self._prefetcher.submit(self._prefetch, key, dict(settings))
+
+    def _prefetch(self, key, settings):
+        try:
+            self.warm_up(settings)
+            # The search indexes are built when they are first needed, which would be the first order otherwise
+            menu = self.get_menu_from_store(settings['store_id'])
+            for kind in ('products', 'toppings', 'sides'):
+                menu.get_search_index(kind)
+        except Exception as e:
+            logger.warning("Could not prefetch what store %s needs: %s", settings['store_id'], e)
+        finally:
+            with self._prefetching_lock:
+                self._prefetching.discard(key)
+
+    def get_menu_from_store(self, store_id, refresh=False):
+        key = 'menu:{}:{}'.format(store_id, self.config['language'])
+        cached = self.cache.get(key)
+
+        if not refresh and cached is not None and time.time() - cached['checked'] < self.menu_refresh_interval:
+            return self._menu(cached['menu'], cached['version'])
 
-    def get_menu_from_store(self, store_id):
+        try:
+            return self._flights.do(('menu', store_id, self.config['language']),
+                                    lambda: self._fetch_menu(key, store_id, cached), self.coalesce_timeout)
+        except UpstreamUnavailable:
+            if cached is None:
+                raise
+            logger.warning("Could not refresh the menu of store %s, using the one we have", store_id)
+            return self._menu(cached['menu'], cached['version'])
+
+    def _menu(self, menu_json, version, menu=None):
+        """
+        The Menu object of this menu version, made from `menu_json` (or `menu`, if given) the first time it's needed.
+        """
+        with self._menus_lock:
+            if version in self._menus:
+                self._menus.move_to_end(version)
+                return self._menus[version]
+            menu = menu if menu is not None else Menu(menu_json, version)
+            self._menus[version] = menu
+            while len(self._menus) > MENU_OBJECTS:
+                self._menus.popitem(last=False)
+            return menu
+
+    def _fetch_menu(self, key, store_id, cached):
         url = self.config['store']['menu'].format(
             storeID=store_id,
             lang=self.config['language']
         )
-        response = requests.get(url).json()
-        return Menu(response)
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if cached is not None:
+            # Only download the menu again if it has changed
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        # The menu is streamed and only the sections we need are parsed - it's huge otherwise.
+        response = self._request('menu', 'get', url, headers=headers, stream=True)
+        try:
+            if response.status_code == 304 and cached is not None:
+                menu = self._menu(cached['menu'], cached['version'])
+            else:
+                digest = hashlib.sha1()
+
+                def chunks():
+                    for chunk in response.iter_content(chunk_size=MENU_CHUNK_SIZE):
+                        digest.update(chunk)
+                        yield chunk
+
+                try:
+                    menu_json = parse_menu_chunks(chunks())
+                except (MenuParseError, requests.RequestException) as e:
+                    # An error page instead of a menu, or the download broke off
+                    self._breakers['dominos'].record_failure()
+                    raise UpstreamUnavailable("Could not read the menu of store {}: {}".format(store_id, e), sent=True)
+                # Keeps the existing menu object if nothing changed, so anything derived from it stays valid
+                menu = self._menu(menu_json, digest.hexdigest())
+        finally:
+            response.close()
+
+        entry = {
+            'menu': menu.json,
+            'version': menu.version,
+            'etag': response.headers.get('ETag', cached['etag'] if cached else None),
+            'last_modified': response.headers.get('Last-Modified', cached['last_modified'] if cached else None),
+            'checked': time.time(),
+        }
+        self.cache.set(key, entry, CACHE_TTL)
+        if self.snapshots is not None and (cached is None or cached['version'] != menu.version):
+            threading.Thread(target=self._save_snapshot, args=(store_id, dict(entry, menu=menu)), daemon=True).start()
+        return menu
+
+    def _save_snapshot(self, store_id, entry):
+        try:
+            # Snapshots include the search indexes, so they don't have to be rebuilt after loading
+            for kind in ('products', 'toppings', 'sides'):
+                entry['menu'].get_search_index(kind)
+            self.snapshots.save(store_id, self.config['language'], entry)
+        except Exception as e:
+            logger.warning("Could not save the menu of store %s: %s", store_id, e)
+
+    def _load_snapshots(self):
+        """
+        Uses the menus saved on disk right away, and checks with Domino's in the background whether they are
+        still current.
+        """
+        start = time.monotonic()
+        snapshots = self.snapshots.load_all(self.config['language'])
+        for snapshot in snapshots:
+            # Snapshots come with their search indexes, so their Menu objects are used as they are
+            menu = self._menu(None, snapshot['menu'].version, snapshot['menu'])
+            self.cache.set('menu:{}:{}'.format(snapshot['store_id'], self.config['language']), {
+                'menu': menu.json,
+                'version': menu.version,
+                'etag': snapshot['etag'],
+                'last_modified': snapshot['last_modified'],
+                'checked': time.time(),
+            }, CACHE_TTL)
+        logger.info("Loaded %d menu snapshots in %.3fs", len(snapshots), time.monotonic() - start)
+        if snapshots:
+            threading.Thread(
+                target=self._revalidate_menus,
+                args=([snapshot['store_id'] for snapshot in snapshots],),
+                daemon=True,
+            ).start()
+
+    def _revalidate_menus(self, store_ids):
+        for store_id in store_ids:
+            try:
+                self.get_menu_from_store(store_id, refresh=True)
+            except UpstreamUnavailable as e:
+                logger.warning("Could not revalidate the menu of store %s: %s", store_id, e)
+
+    def parse_snapshot(self, snapshot, menu):
+        """
+        Parses the orders of a collection snapshot. The result is kept per snapshot and menu, so rendering the
+        order message and then ordering the same orders only parses them once.
+        Returns a copy the caller may modify.
+        """
+        key = (snapshot.hash, menu.version) if menu.version is not None else None
+        with self._parsed_lock:
+            parsed = self._parsed.get(key) if key is not None else None
+            if parsed is not None:
+                self._parsed.move_to_end(key)
+        if parsed is None:
+            parsed = self.parse_all_orders(self._orders_to_order_string(snapshot.orders), menu)
+            if key is not None:
+                with self._parsed_lock:
+                    self._parsed[key] = parsed
+                    while len(self._parsed) > PARSED_CACHE_SIZE:
+                        self._parsed.popitem(last=False)
+        return copy.deepcopy(parsed)
 
     def parse_all_orders(self, order, menu):
         orders = order.split(';')
+        if self.parse_pool is not None:
+            parsed = self.parse_pool.parse(orders, menu)
+            if parsed is not None:
+                return parsed
         return [self._parse_order(part.strip(), menu) for part in orders]
 
-    def optimize_deals(self, order_list, menu, store_id, service_method='Carryout'):
-        deals = menu.get_deals()
-
-        ordered_item_codes = [i['Code'] for i in order_list]
+    def get_deal_info(self, store_id, deal_id):
+        key = 'deal:{}:{}:{}'.format(store_id, self.config['language'], deal_id)
+        cached = self.cache.get(key)
+        if cached is not None and time.time() - cached['checked'] < DEAL_REFRESH_INTERVAL:
+            return cached['deal']
 
-        selected_deals = []
+        try:
+            return self._flights.do(('deals', store_id, self.config['language'], deal_id),
+                                    lambda: self._fetch_deal_info(key, store_id, deal_id), self.coalesce_timeout)
+        except UpstreamUnavailable:
+            if cached is None:
+                raise
+            return cached['deal']
+
+    def _fetch_deal_info(self, key, store_id, deal_id):
+        deal_url = self.config['store']['deals'].format(
+            storeID=store_id,
+            lang=self.config['language'],
+            dealID=deal_id
+        )
+        deal_info = self._request_json('deals', 'get', deal_url, headers=self._get_headers())
+        self.cache.set(key, {
+            'deal': deal_info,
+            'checked': time.time(),
+        }, CACHE_TTL)
+        return deal_info
+
+    def get_available_deals(self, menu, store_id, service_method='Carryout'):
+        """Returns (deal id, deal definition) of the deals which can be used right now, in order of preference."""
+        deals = menu.get_deals()
+        available = []
 
         for deal_id in DEALS:
             # Is the deal available right now?
@@ -147,39 +512,19 @@ class Dominos(Default):
                     and service_method not in deals[deal_id]['Tags']['ValidServiceMethods']:
                 continue
 
-            deal_url = self.config['store']['deals'].format(
-                storeID=store_id,
-                lang=self.config['language'],
-                dealID=deal_id
-            )
+            available.append((deal_id, self.get_deal_info(store_id, deal_id)))
 
-            deal_info = requests.get(deal_url, headers=self._get_headers()).json()
-
-            deal_complete = True
-            while deal_complete:
-                items_selected = []
-                for slot in deal_info['ProductGroups']:
-                    for i in range(slot['RequiredQty']):
-                        eligible = slot['ProductCodes']
-                        items_possible = [item in eligible for item in ordered_item_codes]
-                        if any(items_possible):
-                            selected_item = ordered_item_codes[items_possible.index(True)]
-                            items_selected.append(selected_item)
-                            ordered_item_codes.remove(selected_item)
-                        else:
-                            deal_complete = False
-                            break
-                if not deal_complete:
-                    # Could not complete deal: make items available again for other deals
-                    for item in items_selected:
-                        ordered_item_codes.append(item)
-                else:
-                    selected_deals.append({
-                        'Code': deal_id,
-                        'Qty': 1,
-                    })
+        return available
+
+    def optimize_deals(self, order_list, menu, store_id, service_method='Carryout'):
+        deals = self.get_available_deals(menu, store_id, service_method)
+
+        ordered_item_codes = [i['Code'] for i in order_list]
 
-        return selected_deals
+        return [{
+            'Code': deal_id,
+            'Qty': 1,
+        } for deal_id, _ in assign_deals(ordered_item_codes, deals)]
 
     def create_order(self, orders, menu, settings):
         store_id = settings['store_id'] if 'store_id' in settings else 'wat'
@@ -226,61 +571,243 @@ class Dominos(Default):
             date = today.strftime('%Y-%m-%d ')
             order['FutureOrderTime'] = date + settings['time'] + ":00"
 
+        products = []
         for i, item in enumerate(orders):
             if item is not None:
                 item['ID'] = i
                 item['isNew'] = False
-                order['Products'].append(item)
+                products.append(item)
+
+        parts = self.partition_products(products, menu, store_id, service_method)
+        if len(parts) == 1:
+            return self._price_order(dict(order, Products=products), menu)
+
+        # Too big for one order: the parts are validated and priced side by side, and shown as one order
+        logger.info("Splitting an order of %d items into %d orders", len(products), len(parts))
+        with ThreadPoolExecutor(max_workers=min(len(parts), PRICING_PARALLELISM)) as executor:
+            priced_orders = list(executor.map(
+                lambda part: self._price_order(dict(order, Products=[products[i] for i in part]), menu),
+                parts,
+            ))
+        return self._combine_orders(priced_orders)
+
+    def partition_products(self, products, menu, store_id, service_method):
+        """Indices of the products to put in each Domino's order - usually just one."""
+        if len(products) <= self.max_order_items and self.max_order_amount is None:
+            return [list(range(len(products)))]
+        deals = self.get_available_deals(menu, store_id, service_method)
+        estimate = self.pricer.estimate(products, menu, deals)
+        return partition_items(
+            [p['Code'] for p in products],
+            [p['Price'] for p in estimate['Products']],
+            deals,
+            self.max_order_items,
+            self.max_order_amount,
+        )
 
+    def _price_order(self, order, menu):
+        # Deals are picked from the parsed products up front, so the order only has to be validated once
+        order['Coupons'] = self.optimize_deals(order['Products'], menu, order['StoreID'], order['ServiceMethod'])
         data = {
             'Order': order,
         }
 
-        validate_url = self.config['order']['validate']
-        encoded = json.dumps(data, ensure_ascii=False).encode('cp1252')
-        validated_order = requests.post(validate_url, data=encoded, headers=self._get_headers()).json()
+        validated_order = self._post_order('validate', data)
+
+        if self._coupons_rejected(validated_order):
+            # Domino's may have swapped product codes while validating. Fall back to picking deals for the
+            # validated products, and validating again.
+            logger.info("Domino's rejected the deals picked in advance, retrying with the validated products")
+            validated_order['Order']['Coupons'] = self.optimize_deals(
+                validated_order['Order']['Products'],
+                menu,
+                validated_order['Order']['StoreID'],
+                validated_order['Order']['ServiceMethod'],
+            )
+            validated_order = self._post_order('validate', validated_order)
 
-        deals = self.optimize_deals(
-            validated_order['Order']['Products'],
-            menu,
-            validated_order['Order']['StoreID'],
-            validated_order['Order']['ServiceMethod'],
-        )
+        priced_order = self._post_order('price', validated_order)
 
-        validated_order['Order']['Coupons'] = deals
-        encoded = json.dumps(validated_order, ensure_ascii=False).encode('cp1252')
-        validated_order_with_deals = requests.post(validate_url, data=encoded, headers=self._get_headers()).json()
+        if self.debug:
+            logger.info("Priced order", extra={
+                'store': order['StoreID'],
+                'status': priced_order['Status'] if 'Status' in priced_order else None,
+                'products': len(order['Products']),
+                'coupons': [c['Code'] for c in order['Coupons']],
+            })
 
-        price_url = self.config['order']['price']
+        return priced_order
 
-        encoded = json.dumps(validated_order_with_deals, ensure_ascii=False).encode('cp1252')
-        priced_order = requests.post(price_url, data=encoded, headers=self._get_headers()).json()
+    @staticmethod
+    def _combine_orders(priced_orders):
+        """
+        Merges the priced parts of a split order into what looks like a single priced order, for the confirmation
+        message and the price comparison. The parts themselves are kept in 'Parts' - those are what gets placed.
+        """
+        first = priced_orders[0]['Order']
+        combined = {
+            'StoreID': first['StoreID'] if 'StoreID' in first else None,
+            'Currency': first['Currency'] if 'Currency' in first else '',
+            'Products': [],
+            'Coupons': [],
+        }
+        status = 0
+        status_items = []
+        total = 0.0
+        for priced_order in priced_orders:
+            order = priced_order['Order']
+            combined['Products'].extend(order['Products'])
+            combined['Coupons'].extend(order['Coupons'] if 'Coupons' in order else [])
+            status_items.extend(order['StatusItems'] if 'StatusItems' in order else [])
+            if priced_order['Status'] != 0 and (status == 0 or priced_order['Status'] < status):
+                status = priced_order['Status']
+            if total is not None and 'Amounts' in order:
+                total += float(order['Amounts']['Customer'])
+            else:
+                total = None
+        if total is not None:
+            combined['Amounts'] = {'Customer': round(total, 2)}
+        if status_items:
+            combined['StatusItems'] = status_items
+        return {
+            'Status': status,
+            'Order': combined,
+            'Parts': priced_orders,
+        }
 
-        if self.config['debug']:
-            import pprint
-            pprint.pprint(priced_order)
+    def _post_order(self, endpoint, data):
+        encoded = json.dumps(data, ensure_ascii=False).encode('cp1252')
+        response = self._request(endpoint, 'post', self.config['order'][endpoint], data=encoded,
+                                 headers=self._get_headers())
+        if self.capture is not None:
+            # Only the raw bytes are handed over, decoding and compressing them happens elsewhere
+            self.capture.capture(endpoint, encoded, response.content, status=response.status_code)
+        try:
+            return response.json()
+        except ValueError:
+            self._breakers['dominos'].record_failure()
+            raise UpstreamUnavailable("{} did not answer with JSON".format(endpoint), sent=True)
 
-        return priced_order
+    @staticmethod
+    def _coupons_rejected(validated_order):
+        if 'Order' not in validated_order or 'Coupons' not in validated_order['Order']:
+            return False
+        return any('Status' in c and c['Status'] != 0 for c in validated_order['Order']['Coupons'])
 
-    def get_orders_as_string(self, collection, orders):
+    def get_orders_as_string(self, snapshot):
         text = "=== Domino's Pizza Order ===\n"
-        if not ('settings' in collection and 'store_id' in collection['settings']):
+        if 'store_id' not in snapshot.settings:
             text += "You have not configured a Domino's Pizza store. Please do so using the /store command."
             return text
 
-        validated_orders, menu = self.order_list_to_validated(collection, orders)
-
-        text += self._orders_to_text(validated_orders, menu)
-
-        return text.strip()
+        # While Domino's is slow or failing, the last order message that could be priced is shown instead.
+        # A pricing attempt that runs out of time carries on in the background, and the bot is asked to refresh the
+        # message once it's done.
+        uuid = snapshot.collection['uuid']
+        with self._rendering_lock:
+            repriced = self._repriced.pop(uuid, None)
+            if repriced is not None and repriced[0] == snapshot.hash:
+                return (text + repriced[1]).strip()
+            future = self._rendering.get(uuid)
+            if future is None:
+                future = self._renderer.submit(self._price_order_message, snapshot)
+                self._rendering[uuid] = future
+            else:
+                # Still waiting for Domino's from the last update: don't pile up more requests behind it, only the
+                # latest snapshot is priced once it's done
+                self._pending[uuid] = snapshot
+                self._stale.add(uuid)
+                future = None
+        if future is not None:
+            future.add_done_callback(lambda f: self._render_done(uuid, snapshot, f))
+            try:
+                return (text + future.result(timeout=self.render_budget)).strip()
+            except TimeoutError:
+                with self._rendering_lock:
+                    running = self._rendering.get(uuid) is future
+                    if running:
+                        self._stale.add(uuid)
+                if not running and future.exception() is None:
+                    # Done right after the wait ran out
+                    return (text + future.result()).strip()
+                logger.warning("Pricing the order took more than %.1fs, showing the last prices", self.render_budget)
+            except UpstreamUnavailable as e:
+                logger.warning(e)
+            except Exception:
+                logger.exception("Could not price the order")
+        return text + self._last_good_order_message(uuid)
+
+    def _price_order_message(self, snapshot):
+        # The order message is priced locally - Domino's only gets asked when actually ordering.
+        settings = snapshot.settings
+        menu = self.get_menu_from_store(settings['store_id'])
+        parsed = [o for o in self.parse_snapshot(snapshot, menu) if o is not None]
+        deals = self.get_available_deals(
+            menu,
+            settings['store_id'],
+            settings['service_method'] if 'service_method' in settings else 'Delivery',
+        )
+        estimate = self.pricer.estimate(parsed, menu, deals)
+        text = self._estimate_to_text(estimate, menu)
+        self._last_good.set(snapshot.collection['uuid'], {
+            'text': text,
+            'time': time.time(),
+        }, LAST_GOOD_TTL)
+        return text
 
-    def get_confirmation_message(self, collection, orders):
+    def _render_done(self, uuid, snapshot, future):
+        """
+        Prices the snapshot that came in while `future` was in progress, if any. Otherwise, if old prices were shown
+        in the meantime, keeps the new text and asks the bot to refresh the order message.
+        """
+        successor = None
+        refresh = False
+        with self._rendering_lock:
+            if self._rendering.get(uuid) is not future:
+                return
+            pending = self._pending.pop(uuid, None)
+            if pending is not None and pending.hash != snapshot.hash:
+                # The collection changed while this was priced
+                snapshot = pending
+                successor = self._renderer.submit(self._price_order_message, snapshot)
+                self._rendering[uuid] = successor
+            else:
+                del self._rendering[uuid]
+                if uuid in self._stale:
+                    self._stale.discard(uuid)
+                    if future.exception() is None and self.refresh_order_message is not None:
+                        self._repriced[uuid] = (snapshot.hash, future.result())
+                        refresh = True
+        if successor is not None:
+            successor.add_done_callback(lambda f: self._render_done(uuid, snapshot, f))
+        elif refresh:
+            self.refresh_order_message(snapshot.collection['chat'], uuid)
+
+    def _last_good_order_message(self, uuid):
+        last = self._last_good.get(uuid)
+        if last is None:
+            return PRICING_UNAVAILABLE
+        minutes = int((time.time() - last['time']) / 60)
+        age = "just now" if minutes < 1 else "1 minute ago" if minutes == 1 else "{} minutes ago".format(minutes)
+        return "{}\n\n{}".format(last['text'], STALE_PRICING.format(age))
+
+    def get_confirmation_message(self, snapshot):
         text = ""
-        if not ('settings' in collection and 'store_id' in collection['settings']):
+        if 'store_id' not in snapshot.settings:
             text += "You have not configured a Domino's Pizza store. Please do so using the /store command."
             return text, "", True
 
-        validated_orders, menu = self.order_list_to_validated(collection, orders)
+        try:
+            validated_orders, menu = self.order_list_to_validated(snapshot)
+        except UpstreamUnavailable as e:
+            logger.warning(e)
+            text += "Domino's is not responding right now. Please try again in a minute."
+            return text, "", True
+        except (KeyError, ValueError):
+            # Domino's answered, but not with an order
+            logger.exception("Could not price the order")
+            text += "Domino's is not responding right now. Please try again in a minute."
+            return text, "", True
 
         if validated_orders['Status'] != 0:
             text += "There are some issues with your order:\n"
@@ -290,8 +817,15 @@ class Dominos(Default):
 
         text += "You wish to order the following:\n"
         text += self._orders_to_text(validated_orders, menu)
+        if 'Parts' in validated_orders:
+            text += "\nThis is too much for a single Domino's order, so it will be placed as {} separate orders " \
+                    "({}).\n".format(
+                        len(validated_orders['Parts']),
+                        ", ".join("{} {}".format(part['Order']['Amounts']['Customer'], part['Order']['Currency'])
+                                  for part in validated_orders['Parts']),
+                    )
 
-        store_info = self.get_store_info(collection['settings']['store_id'])
+        store_info = self.get_store_info(snapshot.settings['store_id'])
 
         text += "\n\nYou will order at the {} store at {} in {}\n".format(
             store_info['StoreName'].strip(),
@@ -299,9 +833,7 @@ class Dominos(Default):
             store_info['City'].strip(),
         )
 
-        settings = collection['settings']
-
-        text += self.settings_to_string(settings)
+        text += self.settings_to_string(snapshot.settings)
 
         text += "\nNote that, by clicking 'confirm', you automatically accept " \
                 "the Domino's Pizza Terms and Conditions and Privacy Policy. " \
@@ -309,7 +841,27 @@ class Dominos(Default):
 
         return text, validated_orders, False
 
-    def place_order(self, collection, orders, data):
+    def place_order(self, snapshot, data):
+        if 'Parts' not in data:
+            return self._place_single_order(snapshot, data)
+
+        # A split order: the parts are placed one after the other, stopping at the first one that fails
+        texts = []
+        for i, part in enumerate(data['Parts']):
+            text, error = self._place_single_order(snapshot, part)
+            if not error:
+                texts.append("*Order {} of {}*\n{}".format(i + 1, len(data['Parts']), text))
+                continue
+            if i == 0:
+                return text, True
+            # Some parts went through, so the order can't just be placed again
+            texts.append("*Order {} of {}*\n{}".format(i + 1, len(data['Parts']), text))
+            texts.append("Only the first {} of the {} orders were placed, the remaining ones were not. "
+                         "Please call the store or order the rest separately.".format(i, len(data['Parts'])))
+            return "\n\n".join(texts), False
+        return "\n\n".join(texts), False
+
+    def _place_single_order(self, snapshot, data):
         data['Order']['NewUser'] = False
         data['Order']['Payments'] = [{
             'Amount': data['Order']['Amounts']['Customer'],
@@ -330,17 +882,22 @@ class Dominos(Default):
             'isDomChat': 0,
         }
 
-        place_url = self.config['order']['place']
-        encoded = json.dumps(data, ensure_ascii=False).encode('cp1252')
-
         # Hoo boy
-        response = requests.post(place_url, data=encoded, headers=self._get_headers()).json()
-
-        if self.config['debug']:
-            logger.info("--------- PLACED ORDER RESPONSE -----------")
-            import pprint
-            pprint.pprint(response)
-            logger.info("--------- END PLACED ORDER RESPONSE -----------")
+        try:
+            response = self._post_order('place', data)
+        except UpstreamUnavailable as e:
+            logger.warning(e)
+            if e.sent:
+                return "Something went wrong while sending your order to Domino's, and I don't know whether " \
+                       "it went through. Please call the store before trying again.", True
+            return "I could not reach Domino's to place your order. Please try again in a minute.", True
+
+        if self.debug:
+            logger.info("Placed order", extra={
+                'store': data['Order']['StoreID'] if 'StoreID' in data['Order'] else None,
+                'status': response['Status'] if 'Status' in response else None,
+                'status_items': [s['Code'] for s in response['StatusItems']] if 'StatusItems' in response else [],
+            })
 
         status_code = response['StatusItems'][0]['Code']
 
@@ -351,7 +908,7 @@ class Dominos(Default):
                 text += "I have placed the following order:\n"
                 text += self._orders_to_text(response, menu)
                 text += "\n\nYour order has the following settings:\n"
-                text += self.settings_to_string(collection['settings'])
+                text += self.settings_to_string(snapshot.settings)
                 if status_code != "Success":
                     text += "\n\n Dominos reported an issue with your order:\n"
                     text += "{}:\n".format(status_code)
@@ -445,29 +1002,45 @@ class Dominos(Default):
 
         return message
 
-    def order_list_to_validated(self, collection, orders):
+    @staticmethod
+    def _orders_to_order_string(orders):
         order_string = ""
         for order in orders:
             order_string += "{};".format(order['order_text'].split('\n')[0])
         if order_string.endswith(";"):
             order_string = order_string[:-1]
+        return order_string
 
-        menu = self.get_menu_from_store(collection['settings']['store_id'])
+    def order_list_to_validated(self, snapshot):
+        settings = snapshot.settings
+        menu = self.get_menu_from_store(settings['store_id'])
 
-        orders = self.parse_all_orders(order_string, menu)
-        validated = self.create_order(orders, menu, collection['settings'])
+        orders = self.parse_snapshot(snapshot, menu)
+        estimate = self.pricer.estimate([o for o in orders if o is not None], menu, self.get_available_deals(
+            menu,
+            settings['store_id'],
+            settings['service_method'] if 'service_method' in settings else 'Delivery',
+        ))
+        validated = self.create_order(orders, menu, settings)
+        # Keep track of how good the order message estimates are
+        self.pricer.compare(estimate, validated)
         return validated, menu
 
     def set_store(self, query, settings):
         if len(query) <= 0:
             return "You need to provide an argument for this command. Which store do you " + \
                    "want to use? (Provide a location)"
-        store = self.get_closest_store(query)
+        try:
+            store = self.get_closest_store(query)
+        except UpstreamUnavailable as e:
+            logger.warning(e)
+            return "Domino's is not responding right now. Please try again in a minute."
 
         if store is None:
             return "Uh oh, I couldn't find a Domino's store at that location. Try another."
 
         settings['store_id'] = store['StoreID']
+        self.prefetch(settings)
         return "You will now order at the {} store ({}, {} {})".format(
             store['StoreName'],
             store['StreetName'],
@@ -503,6 +1076,9 @@ class Dominos(Default):
 
         try:
             lat, lng = self._get_coordinates(arg)
+        except UpstreamUnavailable as e:
+            logger.warning(e)
+            return "I can't look up addresses right now. Please try again in a minute."
         except ValueError:
             return "Sorry, I could not find this address. Did you misspell it?"
 
@@ -583,7 +1159,7 @@ class Dominos(Default):
             for k, v in validated_order['Options'].items():
                 if v == 0:
                     string += 'no '
-                if '1/1' in v:
+                elif '1/1' in v:
                     if v['1/1'] == "1.5":
                         string += 'extra '
                     elif v['1/1'] == "0" or v['1/1'] == "0.0":
@@ -593,9 +1169,15 @@ class Dominos(Default):
                     else:
                         string += '{} '.format(v['1/1'])
 
-                string += menu.get_toppings()[k]['Name']
-                if 'Sauce' in menu.get_toppings()[k]['Tags'] and menu.get_toppings()[k]['Tags']['Sauce']:
-                    string += " (base)"
+                toppings = menu.get_toppings()
+                if k in toppings:
+                    string += toppings[k]['Name']
+                    if 'Sauce' in toppings[k]['Tags'] and toppings[k]['Tags']['Sauce']:
+                        string += " (base)"
+                else:
+                    # Sides are options too
+                    sides = menu.get_sides()
+                    string += sides[k]['Name'] if k in sides else k
                 string += ', '
         else:
             for desc in validated_order['descriptions']:
@@ -607,9 +1189,10 @@ class Dominos(Default):
         return string
 
     def _parse_order(self, order, menu):
+        tokens = tokenize_order(order, SIZE_WORDS, STANDARD, MODIFIER_WORDS)
+
         # Step 1: Which product are we ordering?
-        products = menu.get_products()
-        matching_products = self._find_matches(order, products)
+        matching_products = self._find_matches(tokens, menu.get_search_index('products'))
         if len(matching_products) == 0:
             return None
         best_product = matching_products[0]['product']
@@ -617,36 +1200,15 @@ class Dominos(Default):
         dominos_order = {
             'Code': best_product['Variants'][0],
             'Qty': 1,
-            'Options': self._get_default_toppings(best_product),
+            'Options': menu.get_default_toppings(best_product),
         }
 
         # Step 2: Which size?
-        size = STANDARD
-        for word in order.replace(',', '').split(' '):
-            if word.strip().lower() in synonyms_small:
-                size = SMALL
-            if word.strip().lower() in synonyms_large:
-                size = LARGE
-
-        if best_product['ProductType'].lower() == 'pizza':
-            code_prefix = str(size) + PIZZA_CODE_PREFIX
-            for code in best_product['Variants']:
-                if code.startswith(code_prefix):
-                    dominos_order['Code'] = code
-        else:
-            variants = best_product['Variants']
-            if len(variants) == 2 and size == LARGE:
-                dominos_order['Code'] = variants[1]
-            if len(variants) >= 3:
-                if size == STANDARD:
-                    dominos_order['Code'] = variants[1]
-                if size == LARGE:
-                    dominos_order['Code'] = variants[2]
+        dominos_order['Code'] = menu.get_size_variants(best_product)[tokens.size]
 
         # Step 3: For pizza: which toppings?
         if best_product['ProductType'].lower() == 'pizza':
-            toppings = menu.get_toppings()
-            matching_toppings = self._find_matches(order, toppings)
+            matching_toppings = self._find_matches(tokens, menu.get_search_index('toppings'))
             # If it's a plain margherita, use the plain margherita menu item instead of the customizable margherita
             # because dominos is dumb
             if len(matching_toppings) == 0:
@@ -657,12 +1219,11 @@ class Dominos(Default):
 
             for match in matching_toppings:
                 keep = True
-                words = order.split(',')[match['part']].strip().split(' ')
-                last_word = words[match['word'] + match['len'] - 1].lower()
-                word_after = ""
-                if len(words) > match['word'] + match['len']:
-                    word_after = words[match['word'] + match['len']].lower()
-                if last_word in SAUCE_WORDS or word_after in SAUCE_WORDS:  # Sauce was ordered
+                part = tokens.parts[match['part']]
+                end = match['word'] + match['len']
+                sauce_ordered = part.markers[end - 1] == SAUCE or \
+                    (len(part.markers) > end and part.markers[end] == SAUCE)
+                if sauce_ordered:
                     if 'Sauce' not in match['product']['Tags'] or not match['product']['Tags']['Sauce']:
                         # This isn't sauce
                         keep = False
@@ -672,12 +1233,11 @@ class Dominos(Default):
                         keep = False
                 if keep:
                     quantity = 1
-                    if match['word'] > 0:
-                        word_before = words[match['word'] - 1].lower()
-                        if word_before == 'no':
-                            quantity = 0
-                        if word_before == 'extra':
-                            quantity = 1.5
+                    modifier = part.marker_before(match['word'])
+                    if modifier == NO:
+                        quantity = 0
+                    if modifier == EXTRA:
+                        quantity = 1.5
                     if quantity > 0:
                         dominos_order['Options'][match['product']['Code']] = {
                             '1/1': str(quantity)
@@ -687,14 +1247,14 @@ class Dominos(Default):
 
         # Step 3: Which sides?
         if best_product["AvailableSides"]:
-            sides = menu.get_sides()
-            matching_sides = self._find_matches(order, sides, min_words=1)
+            matching_sides = self._find_matches(tokens, menu.get_search_index('sides'), min_words=1)
             for match in matching_sides:
                 quantity = 1
                 if match['word'] > 0:
-                    word_before = order.split(',')[match['part']].strip().split(' ')[match['word'] - 1].lower()
-                    if word_before == 'no':
+                    part = tokens.parts[match['part']]
+                    if part.marker_before(match['word']) == NO:
                         quantity = 0
+                    word_before = part.raw_words[match['word'] - 1]
                     if word_before.isdigit():
                         quantity = int(word_before)
                 if match['product']['Code'] in best_product['AvailableSides']:
@@ -702,105 +1262,163 @@ class Dominos(Default):
 
         return dominos_order
 
+    def _estimate_to_text(self, estimate, menu):
+        fragments = []
+        for deal in estimate['Coupons']:
+            fragments.append(self._deal_fragment(deal['Code'], menu))
+
+        for item in estimate['Products']:
+            fragments.append(self.fragments.get(
+                self._fragment_key('estimate', item, menu, self.currency),
+                lambda: self._estimate_item_to_text(item, menu),
+            ))
+
+        if estimate['Total'] is not None:
+            fragments.append("*Estimated total*: {:.2f} {}\n".format(estimate['Total'], self.currency))
+        return "".join(fragments).strip()
+
+    def _estimate_item_to_text(self, item, menu):
+        text = "*{}* {} {}".format(
+            item['Name'],
+            "{:.2f}".format(item['Price']) if item['Price'] is not None else "--",
+            self.currency
+        )
+        # Only mention what differs from the menu item
+        defaults = menu.get_default_toppings(menu.get_products()[item['ProductCode']]) \
+            if 'ProductCode' in item and item['ProductCode'] in menu.get_products() else {}
+        changes = {k: v for k, v in item['Options'].items() if k not in defaults or defaults[k] != v}
+        if changes:
+            text += " - "
+            text += self.get_customization_string({'CategoryCode': item['ProductType'], 'Options': changes}, menu)
+        return text + '\n'
+
     def _orders_to_text(self, validated_orders, dominos_menu):
-        text = ""
+        fragments = []
         currency = validated_orders['Order']['Currency']
 
         for item in validated_orders['Order']['Coupons']:
-            text += "- {}\n".format(dominos_menu.get_deals()[item['Code']]['Name'].split('-')[0])
+            fragments.append(self._deal_fragment(item['Code'], dominos_menu))
 
         for item in validated_orders['Order']['Products']:
             if 'AutoRemove' in item and item['AutoRemove']:
                 continue
-            text += "*{}* {} {}".format(
-                item['Name'] if 'Name' in item else item['Code'],
-                item['Price'] if 'Price' in item else "--",
-                currency
-            )
-            if 'Options' in item:
-                text += " - "
-                text += self.get_customization_string(item, dominos_menu)
-            text += '\n'
-            if 'StatusItems' in item:
-                for status_item in item['StatusItems']:
-                    text += status_item['Code']
-                    text += " "
-                text += '\n'
+            fragments.append(self.fragments.get(
+                self._fragment_key('priced', item, dominos_menu, currency),
+                lambda: self._priced_item_to_text(item, dominos_menu, currency),
+            ))
 
         if 'Amounts' in validated_orders['Order']:
-            text += "*Total*: {} {}\n".format(validated_orders['Order']['Amounts']['Customer'], currency)
+            fragments.append("*Total*: {} {}\n".format(validated_orders['Order']['Amounts']['Customer'], currency))
         if 'StatusItems' in validated_orders['Order']:
-            text += '\nDominos reports the following issues with your order:\n'
+            fragments.append('\nDominos reports the following issues with your order:\n')
             for status_item in validated_orders['Order']['StatusItems']:
+                fragments.append(status_item['Code'])
+                fragments.append(" ")
+            fragments.append('\n')
+            logger.warning("Domino's reported issues with an order: %s",
+                           [s['Code'] for s in validated_orders['Order']['StatusItems']])
+
+        return "".join(fragments).strip()
+
+    def _priced_item_to_text(self, item, dominos_menu, currency):
+        text = "*{}* {} {}".format(
+            item['Name'] if 'Name' in item else item['Code'],
+            item['Price'] if 'Price' in item else "--",
+            currency
+        )
+        if 'Options' in item:
+            text += " - "
+            text += self.get_customization_string(item, dominos_menu)
+        text += '\n'
+        if 'StatusItems' in item:
+            for status_item in item['StatusItems']:
                 text += status_item['Code']
                 text += " "
             text += '\n'
-            logger.warning(validated_orders['Order']['StatusItems'])
+        return text
 
-        return text.strip()
+    def _deal_fragment(self, code, menu):
+        return self.fragments.get(
+            # The deal's name doesn't depend on the currency
+            self._fragment_key('deal', code, menu, None),
+            lambda: "- {}\n".format(menu.get_deals()[code]['Name'].split('-')[0]),
+        )
 
     @staticmethod
-    def _get_default_toppings(product):
-        options = {}
-        if product['DefaultToppings']:
-            for topping in product['DefaultToppings'].split(','):
-                values = topping.split('=')
-                options[values[0]] = {
-                    '1/1': values[1]
-                }
-        return options
+    def _fragment_key(kind, item, menu, currency):
+        """A rendered item depends on nothing but the item itself, the menu and the currency."""
+        if menu.version is None:
+            return None
+        return kind, menu.version, currency, json.dumps(item, sort_keys=True)
 
     @staticmethod
-    def _find_matches(order, products, min_words=2, min_chars_first_word=3, min_chars_subseq_words=2,
-                      min_chars_total=5):
-        matches_found = []
-        order_parts = normalize('NFD', order).encode('ascii', 'ignore').decode('ascii').split(',')
-        for part_index, part in enumerate(order_parts):
-            order_words = part.strip().lower().split(' ')
-            for p in products.values():
-                name_words = normalize('NFD', p['Name'].lower()).encode('ascii', 'ignore').decode('ascii').split(' ')
-                for o, order_word in enumerate(order_words):
-                    for n, name_word in enumerate(name_words):
-                        match = len(commonprefix(order_word, name_word))
-                        # Heuristic. Start scan from X matching characters onward.
-                        if match >= min(min_chars_first_word, len(name_word)):
-                            matches = []
-                            for nn, next_name_word in enumerate(name_words[n:]):
-                                if o + nn < len(order_words):
-                                    match = len(commonprefix(next_name_word, order_words[o + nn]))
-                                    # Heuristic. Consider it a match if at least X characters match
-                                    if match >= min(min_chars_subseq_words, len(next_name_word)):
-                                        matches.append(match)
-                            # Heuristic. If the product has multiple words, at least X must match.
-                            if len(matches) >= min(min_words, len(name_words)):
-                                # Heuristic. In total, at least X characters must match (if the product has that many).
-                                if sum(matches) >= min(sum([len(w) for w in name_words]), min_chars_total):
-                                    matches_found.append({
-                                        'len': len(matches),
-                                        'sum': sum(matches),
-                                        'part': part_index,
-                                        'word': o,
-                                        'product': p,
-                                    })
+    def _find_matches(tokens, index, min_words=2):
+        matches_found = index.find_matches(tokens, min_words=min_words)
         # Cheat: sides are always last
         matches_found.sort(key=lambda m: (
         'ProductType' not in m['product'] or m['product']['ProductType'] != 'Sides', m['len'], m['sum']), reverse=True)
         return matches_found
 
     def _get_coordinates(self, query):
+        key = 'geocode:{}'.format(' '.join(query.lower().split()))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        return self._flights.do(('geocode', key), lambda: self._fetch_coordinates(key, query), self.coalesce_timeout)
+
+    def _fetch_coordinates(self, key, query):
         url = self.config['geocode']['url'].format(
             query=quote_plus(query),
             key=self.config['geocode']['key']
         )
 
-        result = requests.get(url).json()
+        result = self._request_json('geocode', 'get', url)
 
         if len(result['results'][0]['locations']) <= 0:
             raise ValueError('no such location')
 
         else:
-            return result['results'][0]['locations'][0]['latLng']['lat'], \
-                   result['results'][0]['locations'][0]['latLng']['lng']
+            coordinates = result['results'][0]['locations'][0]['latLng']['lat'], \
+                          result['results'][0]['locations'][0]['latLng']['lng']
+            self.cache.set(key, coordinates, GEOCODE_TTL)
+            return coordinates
+
+    def _request(self, endpoint, method, url, **kwargs):
+        """
+        Every call to Domino's (or the geocoder) goes through here: it is rate limited per kind of endpoint,
+        and refused right away while the upstream is failing.
+        """
+        breaker = self._breakers['geocode' if endpoint == 'geocode' else 'dominos']
+        # Only claim the breaker's trial call once we can make it right away - giving up waiting for the rate
+        # limiter would leave the trial unfinished
+        if not breaker.is_healthy():
+            raise UpstreamUnavailable("{} is failing, not calling it for now".format(endpoint))
+        if not self._limiters[endpoint].acquire(timeout=self.limit_wait):
+            raise UpstreamUnavailable("Rate limit for {} exceeded".format(endpoint))
+        if not breaker.allow():
+            raise UpstreamUnavailable("{} is failing, not calling it for now".format(endpoint))
+
+        try:
+            response = requests.request(method, url, timeout=self.request_timeout, **kwargs)
+        except requests.RequestException as e:
+            breaker.record_failure()
+            raise UpstreamUnavailable("{} request failed: {}".format(endpoint, e), sent=True)
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+            response.close()
+            raise UpstreamUnavailable("{} answered with HTTP {}".format(endpoint, response.status_code), sent=True)
+        breaker.record_success()
+        return response
+
+    def _request_json(self, endpoint, method, url, **kwargs):
+        """_request() for calls answered with JSON. Anything else (e.g. an error page) counts as a failed call."""
+        response = self._request(endpoint, method, url, **kwargs)
+        try:
+            return response.json()
+        except ValueError:
+            self._breakers['geocode' if endpoint == 'geocode' else 'dominos'].record_failure()
+            raise UpstreamUnavailable("{} did not answer with JSON".format(endpoint), sent=True)
 
     def _get_headers(self, add_response_type=False):
         headers = {
@@ -814,8 +1432,19 @@ class Dominos(Default):
 
 
 class Menu:
-    def __init__(self, json):
+    def __init__(self, json, version=None):
         self.json = json
+        self.version = version
+        # Lookup structures derived from the menu, built on first use
+        self._search_indexes = {}
+        self._size_variants = {}
+
+    def __getstate__(self):
+        # Other threads may add lookup structures while the menu is being saved
+        state = dict(self.__dict__)
+        state['_search_indexes'] = dict(self._search_indexes)
+        state['_size_variants'] = dict(self._size_variants)
+        return state
 
     def get_products(self):
         return self.json['Products']
@@ -831,3 +1460,52 @@ class Menu:
 
     def get_deals(self):
         return self.json['Coupons']
+
+    def get_variants(self):
+        return self.json['Variants'] if 'Variants' in self.json else {}
+
+    @staticmethod
+    def get_default_toppings(product):
+        options = {}
+        if product['DefaultToppings']:
+            for topping in product['DefaultToppings'].split(','):
+                values = topping.split('=')
+                options[values[0]] = {
+                    '1/1': values[1]
+                }
+        return options
+
+    def get_search_index(self, kind):
+        if kind not in self._search_indexes:
+            if kind == 'products':
+                items = self.get_products()
+            elif kind == 'toppings':
+                items = self.get_toppings()
+            else:
+                items = self.get_sides()
+            self._search_indexes[kind] = SearchIndex(items)
+        return self._search_indexes[kind]
+
+    def get_size_variants(self, product):
+        """Returns a dict mapping each size to the variant code to order for that size."""
+        code = product['Code']
+        if code not in self._size_variants:
+            variants = product['Variants']
+            table = {}
+            for size in (SMALL, STANDARD, LARGE):
+                table[size] = variants[0]
+                if product['ProductType'].lower() == 'pizza':
+                    code_prefix = str(size) + PIZZA_CODE_PREFIX
+                    for variant in variants:
+                        if variant.startswith(code_prefix):
+                            table[size] = variant
+                else:
+                    if len(variants) == 2 and size == LARGE:
+                        table[size] = variants[1]
+                    if len(variants) >= 3:
+                        if size == STANDARD:
+                            table[size] = variants[1]
+                        if size == LARGE:
+                            table[size] = variants[2]
+            self._size_variants[code] = table
+        return self._size_variants[code]
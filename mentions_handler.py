@@ -13,18 +13,31 @@ class MentionFilter(MessageFilter):
 
     def __init__(self, username: str):
         self.username = username
+        self._tag = "@{}".format(username)
 
     def filter(self, message: Message) -> bool:
-        res = False
-        for entity in message.entities:
-            if entity.type == "mention":
-                 unicode_text = message.text.encode('utf-16')
-                 # Multiply all offsets by 2 because we're still counting 8-bit units although
-                 # the string is utf-16.
-                 # Add 2 to first offset - one to consume the BOM, one to consume the @ character of the mention
-                 # Add only 1 to the last offset, for the BOM
-                 mentioned = unicode_text[(entity.offset + 2) * 2:(entity.offset + entity.length + 1) * 2]
-                 if mentioned.decode('utf-16') == self.username:
-                     res = True
-        return res
+        # Cheap checks first - most group messages don't mention us at all
+        if not message.entities:
+            return False
+        text = message.text
+        if not text or self._tag not in text:
+            return False
+        mentions = [entity for entity in message.entities if entity.type == "mention"]
+        if not mentions:
+            return False
 
+        if text.isascii():
+            # Entity offsets count UTF-16 code units, which are plain characters for ASCII text
+            for entity in mentions:
+                if text[entity.offset + 1:entity.offset + entity.length] == self.username:
+                    return True
+            return False
+
+        unicode_text = text.encode('utf-16-le')
+        for entity in mentions:
+            # Multiply all offsets by 2 because we're counting 8-bit units although the string is utf-16.
+            # Add 1 to the first offset to skip the @ character of the mention
+            mentioned = unicode_text[(entity.offset + 1) * 2:(entity.offset + entity.length) * 2]
+            if mentioned.decode('utf-16-le', errors='ignore') == self.username:
+                return True
+        return False
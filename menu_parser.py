@@ -0,0 +1,263 @@
+import codecs
+import json
+import json.scanner
+import re
+
+# Only these parts of the Domino's menu are ever read by the bot. Everything else in the
+# (rather large) menu response is thrown away item by item while streaming.
+PRODUCT_FIELDS = ('Code', 'Name', 'ProductType', 'Variants', 'DefaultToppings', 'AvailableSides')
+TOPPING_FIELDS = ('Code', 'Name', 'Tags')
+SIDE_FIELDS = ('Code', 'Name')
+COUPON_FIELDS = ('Code', 'Name', 'Tags')
+VARIANT_FIELDS = ('Code', 'Name', 'Price', 'ProductCode')
+
+
+def _project_item(item, fields):
+    return {f: item[f] for f in fields if f in item}
+
+
+def _project_product(key, product):
+    return _project_item(product, PRODUCT_FIELDS)
+
+
+def _project_toppings(key, toppings):
+    if key != 'Pizza':
+        return None
+    return {code: _project_item(topping, TOPPING_FIELDS) for code, topping in toppings.items()}
+
+
+def _project_sides(key, sides):
+    return {code: _project_item(side, SIDE_FIELDS) for code, side in sides.items()}
+
+
+def _project_coupon(key, coupon):
+    return _project_item(coupon, COUPON_FIELDS)
+
+
+def _project_variant(key, variant):
+    return _project_item(variant, VARIANT_FIELDS)
+
+
+# Top-level menu section -> function projecting each entry of that section (returns None to drop the entry)
+MENU_SECTIONS = {
+    'Products': _project_product,
+    'Toppings': _project_toppings,
+    'Sides': _project_sides,
+    'Coupons': _project_coupon,
+    'Variants': _project_variant,
+}
+
+_WHITESPACE = re.compile(r'\s*')
+_KEY = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"\s*:')
+_VALUE_TERMINATORS = ' \t\r\n,}]'
+_ITEM_START = re.compile(r'\s*,?\s*')
+_KEYED_ENTRY = re.compile(r'\s*,?\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*:\s*')
+_COMPLETE_ENDS = '}]"'  # values ending with one of these can't continue in the next chunk
+
+START, SECTION_KEY, SECTION, ITEM, SECTION_END, DONE = range(6)
+
+
+class MenuParseError(ValueError):
+    pass
+
+
+class StreamingMenuParser:
+    """
+    Incremental parser for the Domino's menu response.
+    Feed it text chunks as they arrive. The menu is decoded one section entry (i.e. one product, one coupon...)
+    at a time; entries of sections listed in `sections` are projected to the fields the bot uses,
+    everything else is discarded right away. This way, the full menu never exists as python objects.
+    """
+
+    def __init__(self, sections=None):
+        self.sections = MENU_SECTIONS if sections is None else sections
+        self.result = {}
+        self._scan = json.scanner.make_scanner(json.JSONDecoder())
+        self._buf = ""
+        self._state = START
+        self._section = None
+        self._closing = None
+
+    def feed(self, text, final=False):
+        self._buf += text
+        pos = self._run(final)
+        self._buf = self._buf[pos:]
+
+    def close(self):
+        self.feed("", final=True)
+        if self._state != DONE:
+            raise MenuParseError("Menu response ended prematurely")
+        return self.result
+
+    def _decode_value(self, buf, pos, final):
+        """Returns (value, end) or None if the value is not complete yet."""
+        try:
+            value, end = self._scan(buf, pos)
+        except (StopIteration, json.JSONDecodeError):
+            if final:
+                raise MenuParseError("Invalid JSON in menu response")
+            return None
+        # A number at the very end of the buffer might continue in the next chunk
+        if not final and (end >= len(buf) or buf[end] not in _VALUE_TERMINATORS):
+            return None
+        return value, end
+
+    def _read_key(self, buf, pos):
+        m = _KEY.match(buf, pos)
+        if m is None:
+            if buf[pos] != '"':
+                raise MenuParseError("Unexpected character in menu response: {}".format(buf[pos]))
+            # The key continues in the next chunk
+            return None
+        key = m.group(1)
+        if '\\' in key:
+            key = json.loads('"{}"'.format(key))
+        return key, m.end()
+
+    def _run(self, final):
+        buf = self._buf
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                return pos
+            c = buf[pos]
+
+            if self._state == START:
+                if c != '{':
+                    raise MenuParseError("Menu response is not a JSON object")
+                self._state = SECTION_KEY
+                pos += 1
+
+            elif self._state == SECTION_KEY:
+                if c == '}':
+                    self._state = DONE
+                    pos += 1
+                    continue
+                key = self._read_key(buf, pos)
+                if key is None:
+                    return pos
+                self._section, pos = key
+                self._state = SECTION
+
+            elif self._state == SECTION:
+                if c == '{' or c == '[':
+                    # Walk through the section entry by entry
+                    self._closing = '}' if c == '{' else ']'
+                    if self._section in self.sections:
+                        self.result[self._section] = {} if c == '{' else []
+                    self._state = ITEM
+                    pos += 1
+                else:
+                    decoded = self._decode_value(buf, pos, final)
+                    if decoded is None:
+                        return pos
+                    value, pos = decoded
+                    if self._section in self.sections:
+                        self.result[self._section] = value
+                    self._state = SECTION_END
+
+            elif self._state == ITEM:
+                pos, finished = self._run_items(buf, pos, final)
+                if not finished:
+                    return pos
+                self._state = SECTION_END
+
+            elif self._state == SECTION_END:
+                if c == ',':
+                    self._state = SECTION_KEY
+                elif c == '}':
+                    self._state = DONE
+                else:
+                    raise MenuParseError("Unexpected character in menu response: {}".format(c))
+                pos += 1
+
+            else:
+                return len(buf)
+
+    def _run_items(self, buf, pos, final):
+        """
+        Tight loop over the entries of the current section - this is where nearly all of the time is spent,
+        so it does as little as possible per entry: one regex match for the separator (and key), one call of
+        the C scanner for the value.
+        Returns (pos, True) once the section is closed, or (pos, False) if more input is needed.
+        """
+        project = self.sections[self._section] if self._section in self.sections else None
+        section = self.result[self._section] if project is not None else None
+        keyed = self._closing == '}'
+        entry = _KEYED_ENTRY if keyed else _ITEM_START
+        scan = self._scan
+        size = len(buf)
+        key = None
+        while True:
+            m = entry.match(buf, pos)
+            if m is None or m.end() >= size or buf[m.end()] == self._closing:
+                # The end of the section, or an entry that continues in the next chunk
+                end = _ITEM_START.match(buf, pos).end()
+                if end >= size:
+                    return pos, False
+                if buf[end] == self._closing:
+                    return end + 1, True
+                if buf[end] != '"':
+                    raise MenuParseError("Unexpected character in menu response: {}".format(buf[end]))
+                return pos, False
+            if keyed:
+                key = m.group(1)
+                if '\\' in key:
+                    key = json.loads('"{}"'.format(key))
+            try:
+                value, end = scan(buf, m.end())
+            except (StopIteration, json.JSONDecodeError):
+                if final:
+                    raise MenuParseError("Invalid JSON in menu response")
+                return pos, False
+            # A number at the very end of the buffer might continue in the next chunk
+            if buf[end - 1] not in _COMPLETE_ENDS and not final \
+                    and (end >= size or buf[end] not in _VALUE_TERMINATORS):
+                return pos, False
+            pos = end
+            if project is not None:
+                value = project(key, value)
+                if value is not None:
+                    if keyed:
+                        section[key] = value
+                    else:
+                        section.append(value)
+
+
+def parse_menu_chunks(chunks, sections=None, encoding='utf-8'):
+    """
+    Parses an iterable of byte chunks containing a Domino's menu.
+    Returns the projected menu dictionary.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    parser = StreamingMenuParser(sections)
+    for chunk in chunks:
+        if chunk:
+            parser.feed(decoder.decode(chunk))
+    parser.feed(decoder.decode(b'', final=True))
+    return parser.close()
+
+
+def parse_menu_file(path, chunk_size=65536, sections=None):
+    with open(path, 'rb') as f:
+        return parse_menu_chunks(iter(lambda: f.read(chunk_size), b''), sections)
+
+
+def project_menu(menu_json, sections=None):
+    """Projects an already decoded menu to the parts the bot uses."""
+    sections = MENU_SECTIONS if sections is None else sections
+    projected = {}
+    for section, project in sections.items():
+        if section not in menu_json:
+            continue
+        value = menu_json[section]
+        if isinstance(value, dict):
+            entries = ((k, project(k, v)) for k, v in value.items())
+            projected[section] = {k: v for k, v in entries if v is not None}
+        elif isinstance(value, list):
+            entries = (project(None, v) for v in value)
+            projected[section] = [v for v in entries if v is not None]
+        else:
+            projected[section] = value
+    return projected
@@ -0,0 +1,128 @@
+import os
+import re
+import zlib
+import pickle
+import struct
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAX_BYTES = 50 * 1024 * 1024
+
+# magic, format version, payload length, sha1 of the payload
+_HEADER = struct.Struct('>8sHQ20s')
+_MAGIC = b'OBMENU\r\n'
+_FORMAT = 1
+_SUFFIX = '.snap'
+_UNSAFE = re.compile(r'[^A-Za-z0-9_-]')
+
+
+class MenuSnapshotStore:
+    """
+    Keeps the parsed menus on disk, so they survive restarts.
+    A snapshot holds the Menu object as the bot uses it - the projected menu along with its search indexes - and
+    the caching headers it was downloaded with. There is one snapshot per store and language; its file name also
+    contains the menu's content hash. Each file carries a checksum, and a snapshot that fails it is deleted rather
+    than used. Once all snapshots together take up more than `max_bytes`, the least recently used ones are removed.
+
+    Snapshots are pickles, so the directory has to be as trusted as the bot's code.
+    """
+
+    def __init__(self, directory, max_bytes=SNAPSHOT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _prefix(store_id, language):
+        return '{}.{}.'.format(_UNSAFE.sub('_', str(store_id)), _UNSAFE.sub('_', language))
+
+    def _paths(self, store_id, language):
+        prefix = self._prefix(store_id, language)
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith(prefix) and name.endswith(_SUFFIX)]
+
+    def save(self, store_id, language, entry):
+        """Stores a menu cache entry ({'menu', 'etag', 'last_modified'}) and drops older snapshots of that store."""
+        menu = entry['menu']
+        payload = zlib.compress(pickle.dumps({
+            'store_id': store_id,
+            'language': language,
+            'menu': menu,
+            'etag': entry['etag'],
+            'last_modified': entry['last_modified'],
+        }, protocol=pickle.HIGHEST_PROTOCOL))
+        header = _HEADER.pack(_MAGIC, _FORMAT, len(payload), hashlib.sha1(payload).digest())
+
+        path = os.path.join(self.directory, self._prefix(store_id, language) + '{}{}'.format(menu.version, _SUFFIX))
+        with self._lock:
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+            # Readers (possibly in other processes) either see the old file or the complete new one
+            os.replace(temp_path, path)
+            for old in self._paths(store_id, language):
+                if old != path:
+                    self._remove(old)
+            self._evict()
+
+    def load(self, path):
+        """Returns the snapshot stored in `path`, or None if it is damaged (in which case it is deleted)."""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(_HEADER.size)
+                payload = f.read()
+            magic, version, length, checksum = _HEADER.unpack(header)
+            if magic != _MAGIC or version != _FORMAT:
+                raise ValueError("not a menu snapshot")
+            if length != len(payload) or hashlib.sha1(payload).digest() != checksum:
+                raise ValueError("checksum mismatch")
+            snapshot = pickle.loads(zlib.decompress(payload))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Discarding damaged menu snapshot %s: %s", path, e)
+            self._remove(path)
+            return None
+        # Recently used snapshots are the last to be evicted
+        os.utime(path)
+        return snapshot
+
+    def load_all(self, language):
+        """All intact snapshots for `language`."""
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_SUFFIX):
+                continue
+            snapshot = self.load(os.path.join(self.directory, name))
+            if snapshot is not None and snapshot['language'] == language:
+                snapshots.append(snapshot)
+        return snapshots
+
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(_SUFFIX):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,79 @@
+import json
+import hashlib
+from types import MappingProxyType
+
+
+def freeze(value):
+    """Read-only version of a (nested) dict/list structure."""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """Plain, modifiable dicts and lists from a frozen structure."""
+    if isinstance(value, MappingProxyType) or isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+class CollectionSnapshot:
+    """
+    An order collection and its orders, as read from the database at one point in time.
+    Read once per update and handed to everything that renders or places the order, so they all see the same
+    orders. It can't be changed; changes made by the update itself produce a new snapshot.
+    `hash` covers everything the order list depends on (collection, settings, orders), so it can be used as a
+    cache key.
+    """
+    __slots__ = ('_collection', '_orders', '_hash')
+
+    def __init__(self, collection, orders):
+        self._collection = freeze(dict(collection))
+        self._orders = tuple(freeze(dict(order)) for order in orders)
+        content = json.dumps({
+            'uuid': collection['uuid'] if 'uuid' in collection else None,
+            'settings': thaw(self._collection['settings']) if 'settings' in self._collection else None,
+            'orders': [[o['user_id'], o['user_name'], o['order_text']] for o in self._orders],
+        }, sort_keys=True, default=str)
+        self._hash = hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    @property
+    def collection(self):
+        return self._collection
+
+    @property
+    def settings(self):
+        return self._collection['settings'] if 'settings' in self._collection else MappingProxyType({})
+
+    @property
+    def orders(self):
+        return self._orders
+
+    @property
+    def hash(self):
+        return self._hash
+
+    def to_collection(self):
+        """A modifiable copy of the collection, e.g. to store changes to it."""
+        return thaw(self._collection)
+
+    def with_collection(self, collection):
+        return CollectionSnapshot(collection, self._orders)
+
+    def with_order(self, order):
+        """The snapshot after `order` replaced the order of its user (or was added)."""
+        orders = list(self._orders)
+        for i, existing in enumerate(orders):
+            if existing['user_id'] == order['user_id']:
+                orders[i] = dict(existing, **order)
+                break
+        else:
+            orders.append(order)
+        return CollectionSnapshot(self._collection, orders)
+
+    def without_order(self, user_id):
+        return CollectionSnapshot(self._collection, [o for o in self._orders if o['user_id'] != user_id])
@@ -0,0 +1,135 @@
+from unicodedata import normalize
+
+# Number of leading characters of a menu word an order word has to share before it is considered a match
+FIRST_WORD_PREFIX = 3
+
+
+def to_ascii(text):
+    return normalize('NFD', text).encode('ascii', 'ignore').decode('ascii')
+
+
+def prefix_len(a, b):
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class OrderPart:
+    """
+    One comma separated part of an order.
+    `words` are ascii-folded and lower case and are used to find menu items,
+    `raw_words` are the lower case words as they were written and are used to look at modifiers.
+    """
+    __slots__ = ('words', 'raw_words', 'markers')
+
+    def __init__(self, words, raw_words, markers):
+        self.words = words
+        self.raw_words = raw_words
+        self.markers = markers
+
+    def marker_before(self, index):
+        if index <= 0:
+            return None
+        return self.markers[index - 1]
+
+
+class OrderTokens:
+    """
+    Token stream of a single order, computed once and shared by all parsing steps.
+    """
+    __slots__ = ('text', 'parts', 'size')
+
+    def __init__(self, text, parts, size):
+        self.text = text
+        self.parts = parts
+        self.size = size
+
+
+def tokenize_order(order, size_words, default_size, markers):
+    """
+    Splits an order into parts and words.
+    :param size_words: dict of word -> size. The last size word in the order determines its size.
+    :param markers: dict of word -> marker (e.g. 'no', 'extra'). Stored for each word so modifiers are a lookup.
+    """
+    size = default_size
+    for word in order.replace(',', '').split(' '):
+        word = word.strip().lower()
+        if word in size_words:
+            size = size_words[word]
+
+    parts = []
+    for part, raw_part in zip(to_ascii(order).split(','), order.split(',')):
+        raw_words = [w.lower() for w in raw_part.strip().split(' ')]
+        parts.append(OrderPart(
+            part.strip().lower().split(' '),
+            raw_words,
+            [markers.get(w) for w in raw_words],
+        ))
+    return OrderTokens(order, parts, size)
+
+
+class SearchIndex:
+    """
+    Menu items with their names split into words, indexed by the beginning of each word.
+    Built once per menu, so an order word only has to be compared against menu items which can possibly match it.
+    """
+
+    def __init__(self, items):
+        self.entries = []
+        # first FIRST_WORD_PREFIX characters of a name word -> [(entry index, word index)]
+        self._long = {}
+        # shorter name words, in full -> [(entry index, word index)]
+        self._short = {}
+
+        for e, item in enumerate(items.values()):
+            name_words = to_ascii(item['Name'].lower()).split(' ')
+            self.entries.append((item, name_words, sum(len(w) for w in name_words)))
+            for n, word in enumerate(name_words):
+                if len(word) >= FIRST_WORD_PREFIX:
+                    self._long.setdefault(word[:FIRST_WORD_PREFIX], []).append((e, n))
+                else:
+                    self._short.setdefault(word, []).append((e, n))
+
+    def candidates(self, word):
+        """(entry index, word index) of all name words sharing enough of a prefix with `word`."""
+        found = []
+        if len(word) >= FIRST_WORD_PREFIX:
+            found.extend(self._long.get(word[:FIRST_WORD_PREFIX], ()))
+        for k in range(min(len(word), FIRST_WORD_PREFIX - 1) + 1):
+            found.extend(self._short.get(word[:k], ()))
+        return found
+
+    def find_matches(self, tokens, min_words=2, min_chars_subseq_words=2, min_chars_total=5):
+        matches_found = []
+        for part_index, part in enumerate(tokens.parts):
+            order_words = part.words
+            candidates = []
+            for o, order_word in enumerate(order_words):
+                for e, n in self.candidates(order_word):
+                    candidates.append((e, o, n))
+            # Same order as scanning all menu items word by word, so ties are resolved the same way
+            candidates.sort()
+
+            for e, o, n in candidates:
+                item, name_words, name_len = self.entries[e]
+                matches = []
+                for nn, next_name_word in enumerate(name_words[n:]):
+                    if o + nn < len(order_words):
+                        match = prefix_len(next_name_word, order_words[o + nn])
+                        # Heuristic. Consider it a match if at least X characters match
+                        if match >= min(min_chars_subseq_words, len(next_name_word)):
+                            matches.append(match)
+                # Heuristic. If the product has multiple words, at least X must match.
+                if len(matches) >= min(min_words, len(name_words)):
+                    # Heuristic. In total, at least X characters must match (if the product has that many).
+                    if sum(matches) >= min(name_len, min_chars_total):
+                        matches_found.append({
+                            'len': len(matches),
+                            'sum': sum(matches),
+                            'part': part_index,
+                            'word': o,
+                            'product': item,
+                        })
+        return matches_found
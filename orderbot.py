@@ -3,17 +3,25 @@
 import random
 import yaml
 import logging
-import dataset
 import re
 import json
+import threading
 
 from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from telegram import TelegramError, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler
 from mentions_handler import MentionFilter
-from dominos import Dominos
-from default import Default
+from backends import BackendRegistry
+from sharding import ShardedRunner
+from rendering import FragmentCache, split_message
+from order_snapshot import CollectionSnapshot
+import storage
+import warmup
+import outbox
+import throttle
+import diagnostics
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -21,6 +29,10 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 
+NEWLINE_WHITESPACE = re.compile(r'\n\s*')
+
+REFRESH_THREADS = 2  # order messages refreshed at the same time on behalf of the backends
+
 AFFIRMATIONS = [
     "Cool",
     "Nice",
@@ -35,74 +47,101 @@ AFFIRMATIONS = [
 class PollBot:
     def __init__(self):
         self.db = None
+        self.writes = None
+        self.outbox = None
+        self.compress_payloads = True
         self.config = None
-        self.backends = {}
+        self.backends = None
+        self.stats = None
+        self.fragments = FragmentCache()
+        # chat -> (collection uuid, message parts last shown for it)
+        self.sent_parts = {}
+        # chat -> (collection uuid, ids of the messages the order list is shown in, or Futures of those still being
+        # sent), so handlers don't have to wait for Telegram to learn the ids
+        self.message_ids = {}
+        self._message_ids_lock = threading.Lock()
+        # Order messages are also refreshed from outside the dispatcher, when a backend asks for it
+        self.bot = None
+        self._refresher = ThreadPoolExecutor(max_workers=REFRESH_THREADS, thread_name_prefix='refresh')
+        # chat -> lock held while its order message is updated. Per chat, as rendering may wait for the backend.
+        self._updating = {}
+        self._updating_lock = threading.Lock()
 
     def start(self, update, context):
         """Send a message when the command /start is issued."""
-        defaults = self.db['defaults']
+        defaults = self.table('defaults')
         default_settings = defaults.find_one(chat=update.message.chat.id)
 
         new_collection = {
             'chat': update.message.chat.id,
             'uuid': str(uuid4()),
             'active': True,
-            'settings': {}
+            'settings': {},
+            # Further messages the order list is continued in, once it is too long for one
+            'continuations': '[]',
         }
 
         if default_settings:
             new_collection['settings'] = self.deserialize(default_settings)['settings']
 
-        msg = update.message.reply_text('{}! I will now start collecting your orders! '
-                                        'Send a message that @mentions me and I '
-                                        'will add it to the list.'.format(self.get_affirmation()),
-                                        quote=False)
+        sent = self.reply(update.message, '{}! I will now start collecting your orders! '
+                                          'Send a message that @mentions me and I '
+                                          'will add it to the list.'.format(self.get_affirmation()),
+                          quote=False)
 
-        new_collection['message'] = msg.message_id
-        self.store_collection(new_collection)
+        # The message id is stored once Telegram has it
+        new_collection['message'] = None
+        chat_id, uuid = new_collection['chat'], new_collection['uuid']
+        with self._message_ids_lock:
+            self.message_ids[chat_id] = (uuid, [sent])
+            self.store_collection(new_collection)
+        sent.add_done_callback(lambda f: self._message_sent(chat_id, uuid))
 
     def mention(self, update, context):
         msg = update.message if update.message is not None else update.edited_message
-        collection = self.get_collection(msg.chat.id)
+        snapshot = self.get_snapshot(msg.chat.id)
 
         order_text = msg.text.replace("@{}".format(self.config['bot_name']), "")
         if len(order_text) > 400:
             order_text = order_text[:400] + "..."
-        order_text = re.sub(r'\n\s*', "\n", order_text)
+        order_text = NEWLINE_WHITESPACE.sub("\n", order_text)
         order_text.strip()
-        if collection is not None and collection['active']:
-            orders = self.db['orders']
+        if snapshot is not None and snapshot.collection['active']:
             new_order = {
-                'collection_uuid': collection['uuid'],
+                'collection_uuid': snapshot.collection['uuid'],
                 'chat': msg.chat.id,
                 'user_id': msg.from_user.id,
                 'user_name': msg.from_user.first_name,
                 'order_text': order_text,
             }
-            orders.upsert(new_order, ['chat', 'user_id'])
+            self.writes.upsert('orders', new_order, ['chat', 'user_id'])
 
-            self.update_order_message(context.bot, collection)
+            self.update_order_message(context.bot, snapshot.with_order(new_order))
 
         else:
-            msg.reply_text("Uh oh - there is no ongoing order in this chat. Please /start me first.")
+            self.reply(msg, "Uh oh - there is no ongoing order in this chat. Please /start me first.")
 
     def button(self, update, context):
         query = update.callback_query
         if query.data == 'cancel':
-            context.bot.edit_message_text(
-                text="Alright, I cancelled the order. You can keep making changes and try again, or /close it.",
-                message_id=query.message.message_id,
-                chat_id=query.message.chat.id
+            collection = self.get_collection(query.message.chat.id)
+            if collection is not None:
+                self.writes.delete('confirmations', collection_uuid=collection['uuid'])
+            self.edit_message(
+                context.bot, query.message.chat.id, query.message.message_id,
+                "Alright, I cancelled the order. You can keep making changes and try again, or /close it.",
             )
 
         elif query.data == 'confirm':
-            collection = self.get_collection(query.message.chat.id)
-            if 'data' not in collection:
+            snapshot = self.get_snapshot(query.message.chat.id)
+            collection = snapshot.collection if snapshot is not None else {}
+            confirmation = self.table('confirmations').find_one(collection_uuid=collection['uuid']) \
+                if 'uuid' in collection else None
+            if confirmation is None or not confirmation['data']:
                 # uhm?
-                context.bot.edit_message_text(
-                    text="There was an error of sorts, it seems... Please just try again.",
-                    message_id=query.message.message_id,
-                    chat_id=query.message.chat.id
+                self.edit_message(
+                    context.bot, query.message.chat.id, query.message.message_id,
+                    "There was an error of sorts, it seems... Please just try again.",
                 )
                 return
 
@@ -111,70 +150,70 @@ class PollBot:
                     update.callback_query.answer("Only the person who started the order can confirm it.")
                     return
 
-            data = json.loads(collection['data'])
-
-            table = self.db['orders']
-            orders = table.find(collection_uuid=collection['uuid'])
-            orders = list(orders)
+            data = storage.decode_payload(confirmation['data'], confirmation['encoding'])
 
-            message, error = self.get_backend(collection).place_order(collection, orders, data)
+            message, error = self.get_backend(collection).place_order(snapshot, data)
 
-            context.bot.edit_message_text(
-                text=message,
-                message_id=query.message.message_id,
-                chat_id=query.message.chat.id,
-                parse_mode='markdown'
-            )
+            parts = split_message(message)
+            self.edit_message(context.bot, query.message.chat.id, query.message.message_id, parts[0],
+                              parse_mode='markdown')
+            for part in parts[1:]:
+                self.send_message(context.bot, query.message.chat.id, part, parse_mode='markdown')
 
             if not error:
+                collection = snapshot.to_collection()
                 collection['active'] = False
-                self.store_collection(collection)
+                self.writes.delete('confirmations', collection_uuid=collection['uuid'])
+                self.store_collection(collection, strict=True, fields=('active',))
 
     def delete(self, update, context):
-        collection = self.get_collection(update.message.chat.id)
-        if not collection:
+        snapshot = self.get_snapshot(update.message.chat.id)
+        if not snapshot:
             return
-        orders = self.db['orders']
-
-        orders.delete(collection_uuid=collection['uuid'], user_id=update.message.from_user.id)
+        self.writes.delete('orders', collection_uuid=snapshot.collection['uuid'], user_id=update.message.from_user.id)
 
-        self.update_order_message(context.bot, collection)
+        self.update_order_message(context.bot, snapshot.without_order(update.message.from_user.id))
 
     def set_mode(self, update, context):
         arg = self.get_command_arg(update.message.text)
 
         modes = ""
         for i in self.backends.keys():
-            modes += "*{}*: {}\n".format(i, self.backends[i].short_description)
+            modes += "*{}*: {}\n".format(i, self.backends.backend_class(i).short_description)
 
         if not arg:
-            update.message.reply_text("Please provide an argument for this command. "
-                                      "Available modes are:\n{}".format(modes),
-                                      parse_mode='markdown')
+            self.reply(update.message, "Please provide an argument for this command. "
+                                       "Available modes are:\n{}".format(modes),
+                       parse_mode='markdown')
             return
 
         if arg not in self.backends:
-            update.message.reply_text("Invalid mode. Available modes are:\n{}".format(modes),
-                                      parse_mode='markdown')
+            self.reply(update.message, "Invalid mode. Available modes are:\n{}".format(modes),
+                       parse_mode='markdown')
             return
 
         def setter(settings):
             settings['mode'] = arg
-            return self.backends[arg].mode_selected_message
+            backend = self.backends[arg]
+            # Orders usually follow right after choosing a mode
+            backend.prefetch(settings)
+            return backend.mode_selected_message
 
-        reply_string = self.configure_settings(context.bot, update.message.chat.id, setter)
-        update.message.reply_text(reply_string)
+        reply_string = self.configure_settings(context.bot, update.message.chat.id, setter,
+                                               self.get_snapshot(update.message.chat.id))
+        self.reply(update.message, reply_string)
 
     def set_backend_specific_setting(self, setting_key, bot, update):
         query = self.get_command_arg(update.message.text)
 
-        settings, _ = self.get_settings(update.message.chat.id)
+        # Read once: the backend is picked from the same settings it changes
+        snapshot = self.get_snapshot(update.message.chat.id)
 
-        def setter(_settings):
-            return self.get_backend_from_settings(settings).set(setting_key, query, _settings)
+        def setter(settings):
+            return self.get_backend_from_settings(settings).set(setting_key, query, settings)
 
-        reply_string = self.configure_settings(bot, update.message.chat.id, setter)
-        update.message.reply_text(reply_string)
+        reply_string = self.configure_settings(bot, update.message.chat.id, setter, snapshot)
+        self.reply(update.message, reply_string)
 
     def print_settings(self, update, context):
         settings, is_global = self.get_settings(update.message.chat.id)
@@ -183,61 +222,68 @@ class PollBot:
         else:
             msg = "Collection settings:\n"
         if not settings:
-            update.message.reply_text("This chat has no settings configured.")
+            self.reply(update.message, "This chat has no settings configured.")
         else:
             for k, v in settings.items():
                 msg += "{}: {}\n".format(k, v)
-            update.message.reply_text(msg)
+            self.reply(update.message, msg)
 
     def close_order(self, update, context):
         collection = self.get_collection(update.message.chat.id)
 
         if collection is not None:
             collection['active'] = False
-            self.store_collection(collection)
-        update.message.reply_text("I closed your ongoing order. You can always /reopen it.")
+            self.store_collection(collection, fields=('active',))
+        self.reply(update.message, "I closed your ongoing order. You can always /reopen it.")
 
     def reopen_order(self, update, context):
         collection = self.get_collection(update.message.chat.id)
 
         if collection is not None:
             collection['active'] = True
-            update.message.reply_text("I reopened your ongoing order. You can now order stuff again.")
-            self.store_collection(collection)
+            self.reply(update.message, "I reopened your ongoing order. You can now order stuff again.")
+            self.store_collection(collection, fields=('active',))
         else:
-            update.message.reply_text("Uh oh, there is no order in this chat that I could reopen.")
+            self.reply(update.message, "Uh oh, there is no order in this chat that I could reopen.")
 
     def place_order(self, update, context):
-        collection = self.get_collection(update.message.chat.id)
-        if collection is None \
-                or 'active' not in collection \
-                or not collection['active']:
-            update.message.reply_text("Uh oh, looks like there is no ongoing order in this chat. "
-                                      "Please /start me first.")
+        snapshot = self.get_snapshot(update.message.chat.id)
+        if snapshot is None \
+                or 'active' not in snapshot.collection \
+                or not snapshot.collection['active']:
+            self.reply(update.message, "Uh oh, looks like there is no ongoing order in this chat. "
+                                       "Please /start me first.")
             return
 
-        table = self.db['orders']
-        orders = table.find(collection_uuid=collection['uuid'])
-        orders = list(orders)
-
-        message, data, error = self.get_backend(collection).get_confirmation_message(collection, orders)
+        message, data, error = self.get_backend(snapshot.collection).get_confirmation_message(snapshot)
 
         if error:
-            update.message.reply_text(message)
+            self.reply(update.message, message)
             return
 
-        data_string = json.dumps(data, separators=(',', ':'))
+        payload, encoding = storage.encode_payload(data, self.compress_payloads)
 
-        collection['data'] = data_string
+        collection = snapshot.to_collection()
         collection['issuer_id'] = update.message.from_user.id
-        self.store_collection(collection)
+        self.store_collection(collection, fields=('issuer_id',))
+        # The confirm button reads this right back
+        self.writes.upsert('confirmations', {
+            'collection_uuid': collection['uuid'],
+            'chat': collection['chat'],
+            'data': payload,
+            'encoding': encoding,
+        }, ['collection_uuid'], strict=True)
 
         inline_keyboard_items = [
             [InlineKeyboardButton("Confirm", callback_data="confirm")],
             [InlineKeyboardButton("Cancel", callback_data="cancel")],
         ]
         inline_keyboard = InlineKeyboardMarkup(inline_keyboard_items)
-        update.message.reply_text(message, reply_markup=inline_keyboard, parse_mode='markdown')
+        # The buttons go below the last part, so they are below the whole order
+        parts = split_message(message)
+        for part in parts[:-1]:
+            self.reply(update.message, part, parse_mode='markdown')
+        self.reply(update.message, parts[-1], reply_markup=inline_keyboard, parse_mode='markdown')
 
     # Help command handler
     def send_help(self, update, context):
@@ -250,7 +296,7 @@ class PollBot:
             "I support various modes. By default, I merely collect your orders, but I can " \
             "also order at Domino's Pizza, for example. Check out the /mode command to learn more.\n\n" \
             "Protip: Pin the message with the orders so you don't lose it.".format(self.config['bot_name'])
-        update.message.reply_text(helptext)
+        self.reply(update.message, helptext)
 
     # Error handler
     def error(self, update, context):
@@ -259,19 +305,20 @@ class PollBot:
         import traceback
         traceback.print_exception(type(context.error), context.error, context.error.__traceback__)
 
-    def configure_settings(self, bot, chat_id, setter_func):
-        collection = self.get_collection(chat_id)
-        if collection is not None and 'active' in collection and collection['active']:
+    def configure_settings(self, bot, chat_id, setter_func, snapshot):
+        """Changes the settings of the chat's open collection (as read in `snapshot`), or else its defaults."""
+        if snapshot is not None and 'active' in snapshot.collection and snapshot.collection['active']:
+            collection = snapshot.to_collection()
             message = setter_func(collection['settings'])
-            self.store_collection(collection)
+            self.store_collection(collection, fields=('settings',))
             reply_string = "I tried to configure your ongoing order.\n{}".format(message)
             try:
-                self.update_order_message(bot, collection)
+                self.update_order_message(bot, snapshot.with_collection(collection))
             except TelegramError as e:
                 logger.warning(e)
 
         else:
-            defaults = self.db['defaults']
+            defaults = self.table('defaults')
             default_settings = defaults.find_one(chat=chat_id)
             if default_settings is None:
                 default_settings = {
@@ -281,7 +328,7 @@ class PollBot:
             else:
                 default_settings = self.deserialize(default_settings)
             message = setter_func(default_settings['settings'])
-            defaults.upsert(self.serialize(default_settings), ['chat'])
+            self.writes.upsert('defaults', self.serialize(default_settings), ['chat'])
             reply_string = "I tried to configure the global settings for this chat.\n{}".format(message)
         return reply_string
 
@@ -290,7 +337,7 @@ class PollBot:
         if collection is not None and 'active' in collection and collection['active']:
             return collection['settings'], False
         else:
-            defaults = self.db['defaults']
+            defaults = self.table('defaults')
             default_settings = defaults.find_one(chat=chat_id)
             if default_settings is None:
                 return {}, True
@@ -299,46 +346,167 @@ class PollBot:
                 return default_settings['settings'], True
 
     def get_collection(self, chat_id):
-        collections = self.db['order_collections']
+        collections = self.table('order_collections')
         collection = collections.find_one(chat=chat_id)
         if collection is not None:
-            return self.deserialize(collection)
+            collection = self.deserialize(collection)
+            # Left over from before confirmations had their own table
+            collection.pop('data', None)
+            return collection
         else:
             return None
 
-    def store_collection(self, collection):
-        collections = self.db['order_collections']
-        collections.upsert(self.serialize(collection), ['chat'])
+    def get_snapshot(self, chat_id):
+        """The chat's collection along with its orders, read once for the whole update."""
+        collection = self.get_collection(chat_id)
+        if collection is None:
+            return None
+        # Pending writes were committed before reading the collection already
+        orders = self.db['orders'].find(collection_uuid=collection['uuid'])
+        return CollectionSnapshot(collection, orders)
+
+    def store_collection(self, collection, strict=False, fields=None):
+        """Writes the collection, or only the given fields of it."""
+        if fields is not None:
+            collection = {k: collection[k] for k in ('chat',) + tuple(fields)}
+        self.writes.upsert('order_collections', self.serialize(collection), ['chat'], strict=strict)
+
+    def table(self, name):
+        """Returns a table to read from, once all pending writes are committed."""
+        self.writes.barrier()
+        return self.db[name]
+
+    def update_order_message(self, bot, snapshot):
+        """
+        Shows the order message, continued in further messages if it is too long for one.
+        Only the messages whose text changed are edited.
+        """
+        with self._updating_lock:
+            lock = self._updating.setdefault(snapshot.collection['chat'], threading.Lock())
+        with lock:
+            self._update_order_message(bot, snapshot)
+
+    def _update_order_message(self, bot, snapshot):
+        collection = snapshot.collection
+        parts = split_message(self.get_updated_message(snapshot))
+        chat_id = collection['chat']
+        uuid = collection['uuid']
+        shown = []
+        if chat_id in self.sent_parts and self.sent_parts[chat_id][0] == uuid:
+            shown = self.sent_parts[chat_id][1]
+        continuations = json.loads(collection['continuations']) \
+            if 'continuations' in collection and collection['continuations'] else []
+        stored = [collection['message']] + continuations
+        with self._message_ids_lock:
+            message_ids = list(self.message_ids[chat_id][1]) \
+                if chat_id in self.message_ids and self.message_ids[chat_id][0] == uuid else list(stored)
+
+        for i, part in enumerate(parts):
+            message_id = message_ids[i] if i < len(message_ids) else None
+            if isinstance(message_id, Future) and message_id.done() and message_id.exception() is not None:
+                message_id = None
+            if i < len(shown) and shown[i] == part and message_id is not None:
+                continue
+            if message_id is not None:
+                # Also when it's still being sent: the edit is queued behind it
+                self.edit_message(bot, chat_id, message_id, part, outbox.REFRESH, parse_mode="markdown")
+                continue
+            sent = self.send_message(bot, chat_id, part, outbox.REFRESH, parse_mode="markdown")
+            sent.add_done_callback(lambda f: self._message_sent(chat_id, uuid))
+            if i < len(message_ids):
+                message_ids[i] = sent
+            else:
+                message_ids.append(sent)
+
+        # The collection got shorter: remove the continuations that are no longer needed
+        for message_id in message_ids[len(parts):]:
+            if message_id is not None:
+                self.outbox.send(chat_id, lambda message_id=message_id: bot.delete_message(
+                    chat_id, self._message_id(message_id)), outbox.REFRESH)
+        self.sent_parts[chat_id] = (uuid, parts)
+
+        with self._message_ids_lock:
+            self.message_ids[chat_id] = (uuid, message_ids[:len(parts)])
+            self._store_message_ids(chat_id, uuid, stored)
+
+    def _message_sent(self, chat_id, uuid):
+        """Stores the ids of the order list messages once the last one being sent has one."""
+        with self._message_ids_lock:
+            self._store_message_ids(chat_id, uuid)
+
+    def _store_message_ids(self, chat_id, uuid, stored=None):
+        # Called with _message_ids_lock held, so the writes go out in the order the ids changed
+        if chat_id not in self.message_ids or self.message_ids[chat_id][0] != uuid:
+            return
+        message_ids = []
+        for message_id in self.message_ids[chat_id][1]:
+            if isinstance(message_id, Future):
+                if not message_id.done():
+                    return
+                # Failed ones are sent again by the next update
+                message_id = message_id.result().message_id if message_id.exception() is None else None
+            message_ids.append(message_id)
+        self.message_ids[chat_id] = (uuid, message_ids)
+        if message_ids != stored:
+            self.store_collection({
+                'chat': chat_id,
+                'message': message_ids[0],
+                'continuations': json.dumps(message_ids[1:]),
+            }, fields=('message', 'continuations'))
 
-    def update_order_message(self, bot, collection):
-        bot.edit_message_text(
-            self.get_updated_message(collection),
-            chat_id=collection['chat'],
-            message_id=collection['message'],
-            parse_mode="markdown"
+    @staticmethod
+    def _message_id(message):
+        """The id of a message, given as one or as the Future of the message being sent."""
+        return message.result().message_id if isinstance(message, Future) else message
+
+    def refresh_order_message(self, chat_id, uuid):
+        """Called by backends, from any thread, when the order message of a chat should be shown again."""
+        self._refresher.submit(self._refresh_order_message, chat_id, uuid)
+
+    def _refresh_order_message(self, chat_id, uuid):
+        try:
+            snapshot = self.get_snapshot(chat_id)
+            # Only if the collection is still the one the backend meant
+            if snapshot is not None and snapshot.collection['uuid'] == uuid and self.bot is not None:
+                self.update_order_message(self.bot, snapshot)
+        except Exception:
+            logger.exception("Could not refresh the order message of chat %s", chat_id)
+
+    def reply(self, message, text, **kwargs):
+        """Replies to `message` through the send queue. Returns a Future of the sent message."""
+        return self.outbox.send(message.chat.id, lambda: message.reply_text(text, **kwargs))
+
+    def send_message(self, bot, chat_id, text, priority=outbox.REPLY, **kwargs):
+        return self.outbox.send(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+    def edit_message(self, bot, chat_id, message_id, text, priority=outbox.REPLY, **kwargs):
+        """
+        Edits a message through the send queue. Of several queued edits of a message, only the last is sent.
+        `message_id` may also be the Future of a message queued before, whose id is only known once it's sent.
+        """
+        return self.outbox.send(
+            chat_id,
+            lambda: bot.edit_message_text(text, chat_id=chat_id, message_id=self._message_id(message_id), **kwargs),
+            priority,
+            key=('edit', chat_id, message_id),
         )
 
-    def get_updated_message(self, collection):
-        text = "=== Your Orders ==="
-        order_text = ""
+    def get_updated_message(self, snapshot):
+        orders = snapshot.orders
 
-        table = self.db['orders']
-        orders = table.find(collection_uuid=collection['uuid'])
-        orders = list(orders)
+        if not orders:
+            return "=== Your Orders ===\nThere are currently no orders."
 
+        fragments = ["=== Your Orders ==="]
         for order in orders:
-            order_text += "\n*{}*: {}\n".format(order['user_name'], order['order_text'][:403])
-
-        text += order_text
-        text.strip()
-        if not order_text:
-            text += "\nThere are currently no orders."
-            return text
+            fragments.append(self.fragments.get(
+                ('order', order['user_name'], order['order_text']),
+                lambda: "\n*{}*: {}\n".format(order['user_name'], order['order_text'][:403]),
+            ))
+        fragments.append("\n")
+        fragments.append(self.get_backend(snapshot.collection).get_orders_as_string(snapshot))
 
-        text += "\n"
-        text += self.get_backend(collection).get_orders_as_string(collection, orders)
-
-        return text
+        return "".join(fragments)
 
     @staticmethod
     def get_affirmation():
@@ -381,21 +549,70 @@ class PollBot:
         else:
             return splits[1].strip().lower()
 
-    def run(self, opts):
-        with open(opts.config, 'r') as configfile:
+    def setup(self, config_path, shards=1):
+        with open(config_path, 'r') as configfile:
             self.config = yaml.load(configfile, Loader=yaml.BaseLoader)
+        diagnostics.setup_logging(self.config)
 
-        self.db = dataset.connect('sqlite:///{}'.format(self.config['db']))
-
-        self.backends['dominos'] = Dominos(self.config['dominos'])
-        self.backends['default'] = Default(None)
-
-        # Create the EventHandler and pass it your bot's token.
-        updater = Updater(self.config['token'])
+        # Chats spread over several processes share Telegram's limit for the whole bot
+        self.outbox = outbox.SendQueue(
+            float(self.config['send_rate']) / shards if 'send_rate' in self.config else outbox.SEND_RATE / shards,
+            float(self.config['chat_send_rate']) if 'chat_send_rate' in self.config else outbox.CHAT_SEND_RATE,
+            float(self.config['group_send_rate']) if 'group_send_rate' in self.config else outbox.GROUP_SEND_RATE,
+        )
 
-        # Get the dispatcher to register handlers
-        dp = updater.dispatcher
+        self.db = storage.connect(self.config['db'])
+        self.compress_payloads = 'compress_payloads' not in self.config \
+            or self.config['compress_payloads'].lower() in ('true', 'yes', 'on', '1')
+        self.writes = storage.WriteBatcher(
+            self.db,
+            float(self.config['write_window']) if 'write_window' in self.config else storage.WRITE_WINDOW,
+        )
 
+        # Backends are only imported and set up once a chat uses them
+        self.backends = BackendRegistry(self.config, self.refresh_order_message)
+
+        self.stats = diagnostics.StatsReporter(
+            float(self.config['stats_interval']) if 'stats_interval' in self.config else diagnostics.STATS_INTERVAL)
+        self.stats.add('send queue', self.outbox.report)
+        self.stats.add('shared upstream requests', throttle.single_flight_stats)
+
+    def warm_up(self, shard=None, shards=1):
+        """Lets the backends fetch what the chats which are likely to order soon will need."""
+        warmup.warm_up(
+            self.get_warm_up_targets(shard, shards),
+            int(self.config['warmup_parallelism']) if 'warmup_parallelism' in self.config
+            else warmup.WARMUP_PARALLELISM,
+            float(self.config['warmup_timeout']) if 'warmup_timeout' in self.config else warmup.WARMUP_TIMEOUT,
+        )
+        self.backends.report()
+
+    def get_warm_up_targets(self, shard=None, shards=1):
+        """
+        (mode, backend, settings) for the open collections and the chat defaults, once per thing to fetch.
+        With `shard` given, only chats handled by that worker are considered.
+        """
+        chat_settings = []
+        for collection in self.table('order_collections').find(active=True):
+            chat_settings.append((collection['chat'], self.deserialize(collection)['settings']))
+        for default_settings in self.table('defaults').find():
+            chat_settings.append((default_settings['chat'], self.deserialize(default_settings)['settings']))
+
+        targets = {}
+        for chat, settings in chat_settings:
+            if shard is not None and chat % shards != shard:
+                continue
+            mode = settings['mode'] if 'mode' in settings and settings['mode'] in self.backends else 'default'
+            backend = self.backends[mode]
+            key = backend.warm_up_key(settings)
+            if key is not None and (mode, key) not in targets:
+                targets[(mode, key)] = (mode, backend, settings)
+        return list(targets.values())
+
+    def register_handlers(self, dp):
+        self.bot = dp.bot
+        # Only the processes handling updates have anything to report
+        self.stats.start()
         # General commands
         # dp.add_handler(MentionsHandler(self.config['bot_name'], self.mention, edited_updates=True))
         dp.add_handler(MessageHandler(MentionFilter(self.config['bot_name']), self.mention, edited_updates=True))
@@ -437,6 +654,25 @@ class PollBot:
         # log all errors
         dp.add_error_handler(self.error)
 
+    def run(self, opts):
+        self.setup(opts.config)
+        storage.ensure_schema(self.db)
+
+        workers = int(opts.workers or self.config.get('workers', 1))
+        if workers > 1:
+            # Chats are spread over several processes
+            ShardedRunner(opts.config, self.config['token'], workers).run()
+            return
+
+        # Don't make the first message of every chat wait for Domino's
+        self.warm_up()
+
+        # Create the EventHandler and pass it your bot's token.
+        updater = Updater(self.config['token'])
+
+        # Get the dispatcher to register handlers
+        self.register_handlers(updater.dispatcher)
+
         # Start the Bot
         updater.start_polling()
 
@@ -454,5 +690,7 @@ if __name__ == '__main__':
     from optparse import OptionParser
     parser = OptionParser()
     parser.add_option('-c', '--config', dest='config', default='config.yml', type='string', help="Path of configuration file")
+    parser.add_option('-w', '--workers', dest='workers', default=None, type='int',
+                      help="Number of worker processes to spread chats over")
     (opts, args) = parser.parse_args()
     main(opts)
@@ -0,0 +1,230 @@
+import time
+import heapq
+import logging
+import threading
+from itertools import count
+from concurrent.futures import Future
+
+from telegram.error import RetryAfter
+
+from throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Priorities: lower goes first
+REPLY = 0  # answers to something a user just did
+REFRESH = 1  # updates of the order list
+
+SEND_RATE = 30  # messages per second Telegram accepts from a bot overall
+CHAT_SEND_RATE = 1  # ... in a private chat
+GROUP_SEND_RATE = 20 / 60  # ... in a group
+CHAT_BURST = 3
+SEND_THREADS = 4
+SEND_RETRIES = 5  # times a message is sent again after Telegram asked us to slow down
+
+
+class _Send:
+    __slots__ = ('seq', 'priority', 'chat_id', 'key', 'call', 'futures', 'queued', 'retries')
+
+    def __init__(self, seq, priority, chat_id, key, call):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.key = key
+        self.call = call
+        self.futures = [Future()]
+        self.queued = time.monotonic()
+        self.retries = 0
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendQueue:
+    """
+    Every message the bot sends or edits goes through here, so it stays within Telegram's limits: `rate` messages
+    per second overall, and `chat_rate` (`group_rate` for groups) per chat, with short bursts allowed.
+    Replies to users go before order list refreshes. A chat's messages of the same priority are sent in order, one
+    at a time. A pending edit given the same `key` as a newer one is dropped in favour of the newer one, which goes
+    out with the higher priority of the two.
+    When Telegram answers with RetryAfter, the chat is paused for as long as asked and the message sent again.
+    """
+
+    def __init__(self, rate=SEND_RATE, chat_rate=CHAT_SEND_RATE, group_rate=GROUP_SEND_RATE, threads=SEND_THREADS):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.stats = {
+            'queued': 0,
+            'sent': 0,
+            'failed': 0,
+            'retried': 0,
+            'coalesced': 0,
+            'wait_time': 0.0,
+            'max_wait': 0.0,
+            'max_depth': 0,
+        }
+        self._global = TokenBucket(rate)
+        self._chats = {}
+        self._paused = {}  # chat -> time until which Telegram asked us not to send there
+        self._busy = set()  # chats a message is being sent to right now
+        self._queues = {}  # chat -> heap of its messages waiting to be sent
+        # Heap of (priority, seq, chat) of the first message of every chat with some waiting, unless the chat is busy.
+        # Entries left behind when a chat's first message changed are skipped.
+        self._heads = []
+        self._depth = 0
+        self._by_key = {}
+        self._seq = count()
+        self._cond = threading.Condition()
+        for i in range(threads):
+            threading.Thread(target=self._run, name='send-{}'.format(i), daemon=True).start()
+
+    def depth(self):
+        """Number of messages waiting to be sent."""
+        with self._cond:
+            return self._depth
+
+    def report(self):
+        """The stats, along with the number of messages waiting right now."""
+        with self._cond:
+            return dict(self.stats, depth=self._depth)
+
+    def send(self, chat_id, call, priority=REPLY, key=None):
+        """
+        Queues `call()`, which sends something to `chat_id`.
+        Returns a Future of its result - the sent message, usually.
+        """
+        with self._cond:
+            if key is not None and key in self._by_key:
+                item = self._by_key[key]
+                item.call = call
+                future = Future()
+                item.futures.append(future)
+                self.stats['coalesced'] += 1
+                if priority < item.priority:
+                    item.priority = priority
+                    heapq.heapify(self._queues[item.chat_id])
+                    self._push_head(item.chat_id)
+                    self._cond.notify()
+                return future
+            item = _Send(next(self._seq), priority, chat_id, key, call)
+            self._queue(item)
+            if key is not None:
+                self._by_key[key] = item
+            self.stats['queued'] += 1
+            self.stats['max_depth'] = max(self.stats['max_depth'], self._depth)
+            self._cond.notify()
+        return item.futures[0]
+
+    def _queue(self, item):
+        heapq.heappush(self._queues.setdefault(item.chat_id, []), item)
+        self._depth += 1
+        self._push_head(item.chat_id)
+
+    def _push_head(self, chat_id):
+        queue = self._queues.get(chat_id)
+        if queue and chat_id not in self._busy:
+            heapq.heappush(self._heads, (queue[0].priority, queue[0].seq, chat_id))
+
+    def _bucket(self, chat_id):
+        if chat_id not in self._chats:
+            # Group chats have negative ids
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            self._chats[chat_id] = TokenBucket(rate, max(CHAT_BURST, rate))
+        return self._chats[chat_id]
+
+    def _next(self):
+        """The first message that may be sent now, or (None, seconds until one might be)."""
+        now = time.monotonic()
+        seen = set()
+        deferred = []
+        found = None
+        wait = None
+        while self._heads:
+            head = heapq.heappop(self._heads)
+            priority, seq, chat_id = head
+            queue = self._queues.get(chat_id)
+            if chat_id in seen or chat_id in self._busy or not queue \
+                    or (queue[0].priority, queue[0].seq) != (priority, seq):
+                continue
+            seen.add(chat_id)
+            delay = 0
+            if chat_id in self._paused:
+                delay = self._paused[chat_id] - now
+                if delay <= 0:
+                    del self._paused[chat_id]
+            if delay <= 0:
+                delay = self._bucket(chat_id).wait_time()
+            if delay <= 0 and self._bucket(chat_id).acquire(timeout=0):
+                found = heapq.heappop(queue)
+                if not queue:
+                    del self._queues[chat_id]
+                self._depth -= 1
+                break
+            # Whatever else is queued for this chat has to wait for this one
+            deferred.append(head)
+            wait = delay if wait is None else min(wait, delay)
+        for head in deferred:
+            heapq.heappush(self._heads, head)
+        return found, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                item, wait = self._next()
+                while item is None:
+                    self._cond.wait(wait)
+                    item, wait = self._next()
+                if item.key is not None and self._by_key.get(item.key) is item:
+                    del self._by_key[item.key]
+                self._busy.add(item.chat_id)
+
+            self._global.acquire()
+            try:
+                self._send(item)
+            finally:
+                with self._cond:
+                    self._busy.discard(item.chat_id)
+                    self._push_head(item.chat_id)
+                    self._cond.notify_all()
+
+    def _send(self, item):
+        waited = time.monotonic() - item.queued
+        try:
+            result = item.call()
+        except RetryAfter as e:
+            item.retries += 1
+            if item.retries <= SEND_RETRIES:
+                self._retry(item, e.retry_after)
+                return
+            self._fail(item, e)
+            return
+        except Exception as e:
+            self._fail(item, e)
+            return
+        with self._cond:
+            self.stats['sent'] += 1
+            self.stats['wait_time'] += waited
+            self.stats['max_wait'] = max(self.stats['max_wait'], waited)
+        for future in item.futures:
+            future.set_result(result)
+
+    def _retry(self, item, retry_after):
+        logger.info("Telegram asked to wait %ss before sending to chat %s", retry_after, item.chat_id)
+        with self._cond:
+            self.stats['retried'] += 1
+            self._paused[item.chat_id] = time.monotonic() + float(retry_after)
+            newer = self._by_key.get(item.key) if item.key is not None else None
+            if newer is not None:
+                # The message was edited again meanwhile: only the latest text needs sending
+                newer.futures.extend(item.futures)
+                return
+            self._queue(item)
+            if item.key is not None:
+                self._by_key[item.key] = item
+
+    def _fail(self, item, error):
+        logger.warning("Could not send to chat %s: %s", item.chat_id, error)
+        with self._cond:
+            self.stats['failed'] += 1
+        for future in item.futures:
+            future.set_exception(error)
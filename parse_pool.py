@@ -0,0 +1,101 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+MIN_ORDERS = 20  # Below this, sending the work to another process costs more than it saves
+MENUS_PER_WORKER = 4
+
+# State of each pool worker process
+_backend = None
+_menus = OrderedDict()
+
+
+def _init_worker(config):
+    global _backend
+    from dominos import Dominos
+    _backend = Dominos(config)
+
+
+def _parse(version, menu_json, orders):
+    """
+    Runs in a pool worker. Menus are only sent along if the worker doesn't have them yet, so the result is either
+    (True, parsed orders) or (False, None) if the worker does not have this menu version after all.
+    """
+    from dominos import Menu
+    if menu_json is not None:
+        _menus[version] = Menu(menu_json, version)
+        while len(_menus) > MENUS_PER_WORKER:
+            _menus.popitem(last=False)
+    if version not in _menus:
+        return False, None
+    _menus.move_to_end(version)
+    menu = _menus[version]
+    return True, [_backend._parse_order(order.strip(), menu) for order in orders]
+
+
+class ParsePool:
+    """
+    Parses big order collections in a few worker processes, which keep their own copies of the menus.
+    Every worker is an executor of its own, so we know which menus each of them has: a menu is sent to a worker
+    along with the first orders it gets for that menu, and then never again while the worker keeps it.
+    """
+
+    def __init__(self, config, processes, min_orders=MIN_ORDERS):
+        self.processes = processes
+        self.min_orders = min_orders
+        # Spawn rather than fork: the bot process runs several threads
+        context = multiprocessing.get_context('spawn')
+        self._workers = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=_init_worker, initargs=(config,))
+            for _ in range(processes)
+        ]
+        # Menu versions each worker has, least recently used first - kept the same way as in the worker itself
+        self._menus = [OrderedDict() for _ in range(processes)]
+        self._lock = threading.Lock()
+
+    def _submit(self, worker, menu, orders):
+        # A worker runs its calls in the order they were submitted, so it has the menu by the time it gets to
+        # any later call which relies on it
+        with self._lock:
+            menus = self._menus[worker]
+            menu_json = None
+            if menu.version not in menus:
+                menus[menu.version] = True
+                menu_json = menu.json
+                while len(menus) > MENUS_PER_WORKER:
+                    menus.popitem(last=False)
+            menus.move_to_end(menu.version)
+            return self._workers[worker].submit(_parse, menu.version, menu_json, orders)
+
+    def parse(self, orders, menu):
+        """
+        Parses a list of orders, or returns None if they should rather be parsed in this process.
+        """
+        if len(orders) < self.min_orders or menu.version is None:
+            return None
+
+        batch_size = -(-len(orders) // self.processes)
+        batches = [orders[i:i + batch_size] for i in range(0, len(orders), batch_size)]
+        try:
+            futures = [self._submit(worker, menu, batch) for worker, batch in enumerate(batches)]
+            parsed = []
+            for worker, (batch, future) in enumerate(zip(batches, futures)):
+                found, result = future.result()
+                if not found:
+                    # Shouldn't happen, but sending the menu again is cheap compared to getting it wrong
+                    logger.warning("Parse worker %d did not have menu %s", worker, menu.version)
+                    found, result = self._workers[worker].submit(_parse, menu.version, menu.json, batch).result()
+                parsed.extend(result)
+            return parsed
+        except BrokenProcessPool as e:
+            logger.warning("Parse pool is broken, parsing in process: %s", e)
+            return None
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.shutdown(wait=False)
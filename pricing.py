@@ -0,0 +1,213 @@
+import json
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PRICE_TOLERANCE = 0.05  # Estimates closer than this to Domino's price are considered accurate
+
+
+def assign_deals(item_codes, deals):
+    """
+    Greedily fills deals with ordered items.
+    :param item_codes: product codes of the ordered items
+    :param deals: list of (deal id, deal definition) in order of preference
+    :return: list of (deal id, indices of the items used for this deal)
+    """
+    remaining = list(enumerate(item_codes))
+    assigned = []
+
+    for deal_id, deal_info in deals:
+        deal_complete = True
+        while deal_complete:
+            items_selected = []
+            for slot in deal_info['ProductGroups']:
+                for i in range(slot['RequiredQty']):
+                    eligible = slot['ProductCodes']
+                    selected = next((item for item in remaining if item[1] in eligible), None)
+                    if selected is not None:
+                        items_selected.append(selected)
+                        remaining.remove(selected)
+                    else:
+                        deal_complete = False
+                        break
+            if not deal_complete:
+                # Could not complete deal: make items available again for other deals
+                remaining.extend(items_selected)
+            else:
+                assigned.append((deal_id, [index for index, _ in items_selected]))
+
+    return assigned
+
+
+def partition_items(item_codes, prices, deals, max_items, max_amount=None):
+    """
+    Splits ordered items into groups small enough to be placed as separate orders, without splitting up deals.
+    Items that fill a deal together stay in the same group; groups are filled biggest bundle first.
+    :param prices: estimated price of each item (None if unknown, counted as free)
+    :param max_amount: highest estimated total of a group, or None for no limit
+    :return: list of lists of item indices
+    """
+    deal_prices = {deal_id: _to_price(deal_info['Price']) if 'Price' in deal_info else None
+                   for deal_id, deal_info in deals}
+    bundles = []
+    in_deal = set()
+    for deal_id, indices in assign_deals(item_codes, deals):
+        amount = deal_prices[deal_id]
+        if amount is None:
+            amount = sum(prices[i] or 0.0 for i in indices)
+        bundles.append((indices, amount))
+        in_deal.update(indices)
+    bundles.extend(([i], prices[i] or 0.0) for i in range(len(item_codes)) if i not in in_deal)
+
+    groups = []
+    for indices, amount in sorted(bundles, key=lambda bundle: (len(bundle[0]), bundle[1]), reverse=True):
+        for group in groups:
+            if len(group[0]) + len(indices) <= max_items and \
+                    (max_amount is None or group[1] + amount <= max_amount):
+                group[0].extend(indices)
+                group[1] += amount
+                break
+        else:
+            # Bundles exceeding the limits on their own get a group of their own
+            groups.append([list(indices), amount])
+    return [sorted(indices) for indices, _ in groups]
+
+
+def _to_price(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LocalPricer:
+    """
+    Estimates order prices from the menu, without asking Domino's.
+    Items are priced by their variant price plus a surcharge per added topping. Whenever Domino's prices an order,
+    the actual item prices are remembered and used for identical items later on, and the accuracy of the estimate
+    is recorded.
+    """
+
+    def __init__(self, topping_prices=None, tolerance=PRICE_TOLERANCE):
+        # size (as in the first two characters of the variant code) -> price per added topping
+        self.topping_prices = {str(k): float(v) for k, v in (topping_prices or {}).items()}
+        self.tolerance = tolerance
+        self.stats = {
+            'compared': 0,
+            'diverged': 0,
+            'total_error': 0.0,
+        }
+        self._known_prices = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _item_key(item):
+        return item['Code'], json.dumps(item['Options'] if 'Options' in item else {}, sort_keys=True)
+
+    def _surcharge(self, item, default_toppings):
+        surcharge = self.topping_prices.get(item['Code'][:2], 0.0)
+        if not surcharge or 'Options' not in item:
+            return 0.0
+        added = 0.0
+        for code, amount in item['Options'].items():
+            if amount == 0:
+                continue
+            amount = _to_price(amount['1/1']) if '1/1' in amount else 1.0
+            default = _to_price(default_toppings[code]['1/1']) if code in default_toppings else 0.0
+            if amount is not None and default is not None and amount > default:
+                added += amount - default
+        return added * surcharge
+
+    def price_item(self, item, menu, default_toppings):
+        with self._lock:
+            known = self._known_prices.get(self._item_key(item))
+        if known is not None:
+            return known
+        variants = menu.get_variants()
+        if item['Code'] not in variants:
+            return None
+        base = _to_price(variants[item['Code']]['Price'] if 'Price' in variants[item['Code']] else None)
+        if base is None:
+            return None
+        return round(base + self._surcharge(item, default_toppings), 2)
+
+    def estimate(self, order_list, menu, deals):
+        """
+        :param order_list: parsed items (as produced by the backend, without None entries)
+        :param deals: list of (deal id, deal definition) which may be applied
+        :return: dict with 'Products', 'Coupons' and 'Total' ('Total' is None if some item could not be priced)
+        """
+        products = []
+        for item in order_list:
+            variants = menu.get_variants()
+            variant = variants[item['Code']] if item['Code'] in variants else {}
+            product = menu.get_products().get(variant['ProductCode']) if 'ProductCode' in variant else None
+            default_toppings = menu.get_default_toppings(product) if product else {}
+            products.append({
+                'Code': item['Code'],
+                'ProductCode': variant['ProductCode'] if 'ProductCode' in variant else None,
+                'Name': variant['Name'] if 'Name' in variant else item['Code'],
+                'ProductType': product['ProductType'] if product else '',
+                'Options': item['Options'] if 'Options' in item else {},
+                'Price': self.price_item(item, menu, default_toppings),
+            })
+
+        coupons = []
+        in_deal = set()
+        for deal_id, indices in assign_deals([p['Code'] for p in products], deals):
+            deal_info = dict(deals)[deal_id]
+            coupons.append({
+                'Code': deal_id,
+                'Price': _to_price(deal_info['Price']) if 'Price' in deal_info else None,
+                'Items': indices,
+            })
+            # Without a known deal price, the items are simply charged normally
+            if coupons[-1]['Price'] is not None:
+                in_deal.update(indices)
+
+        total = 0.0
+        for i, product in enumerate(products):
+            if i in in_deal:
+                continue
+            if product['Price'] is None:
+                total = None
+                break
+            total += product['Price']
+        if total is not None:
+            total = round(total + sum(c['Price'] for c in coupons if c['Price'] is not None), 2)
+
+        return {
+            'Products': products,
+            'Coupons': coupons,
+            'Total': total,
+        }
+
+    def learn(self, priced_order):
+        """Remembers the item prices of an order priced by Domino's."""
+        with self._lock:
+            for item in priced_order['Order']['Products']:
+                price = _to_price(item['Price'] if 'Price' in item else None)
+                if price is not None and 'Code' in item:
+                    self._known_prices[self._item_key(item)] = price
+
+    def compare(self, estimate, priced_order):
+        """Records how far off an estimate was from the price Domino's computed, and learns from it."""
+        order = priced_order['Order'] if 'Order' in priced_order else {}
+        if 'Amounts' not in order:
+            return None
+        actual = _to_price(order['Amounts']['Customer'])
+        if actual is None or estimate['Total'] is None:
+            return None
+
+        error = round(estimate['Total'] - actual, 2)
+        with self._lock:
+            self.stats['compared'] += 1
+            self.stats['total_error'] += abs(error)
+            if abs(error) > self.tolerance:
+                self.stats['diverged'] += 1
+        if abs(error) > self.tolerance:
+            logger.warning("Local price estimate %.2f diverged from Domino's price %.2f (%d of %d estimates off)",
+                           estimate['Total'], actual, self.stats['diverged'], self.stats['compared'])
+        self.learn(priced_order)
+        return error
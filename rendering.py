@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+
+MESSAGE_LIMIT = 4096  # characters Telegram accepts in one message
+FRAGMENT_CACHE_SIZE = 4096
+
+
+class FragmentCache:
+    """
+    LRU cache of rendered pieces of text.
+    Keys must contain everything the fragment's text depends on, so a cached fragment never needs invalidating.
+    """
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render):
+        """Returns the fragment for `key`, calling `render()` if it isn't cached. A key of None is never cached."""
+        if key is None:
+            return render()
+        with self._lock:
+            if key in self._fragments:
+                self._fragments.move_to_end(key)
+                self.stats['hits'] += 1
+                return self._fragments[key]
+            self.stats['misses'] += 1
+        fragment = render()
+        with self._lock:
+            self._fragments[key] = fragment
+            if len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return fragment
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    Splits text into parts of at most `limit` characters.
+    Parts end at line breaks, so markdown formatting (which never spans lines here) stays intact.
+    Only a single line longer than `limit` is cut in the middle.
+    """
+    if len(text) <= limit:
+        return [text]
+
+    parts = []
+    current = ""
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += '\n' + line
+        else:
+            parts.append(current)
+            current = line
+    if current.strip():
+        parts.append(current)
+    return parts
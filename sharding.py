@@ -0,0 +1,96 @@
+import json
+import time
+import logging
+import multiprocessing
+from queue import Queue
+
+from telegram import Bot, Update, TelegramError
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 30
+
+
+def shard_for(update, shards):
+    """All updates of a chat go to the same worker, so they are handled in order."""
+    chat = update.effective_chat
+    if chat is None:
+        return 0
+    return chat.id % shards
+
+
+def _worker(config_path, updates, shard, shards):
+    # Imported here so the worker sets itself up from scratch, regardless of how the process was started
+    from orderbot import PollBot
+
+    poll_bot = PollBot()
+    poll_bot.setup(config_path, shards)
+    # Updates for this worker's chats queue up meanwhile
+    poll_bot.warm_up(shard, shards)
+    bot = Bot(poll_bot.config['token'])
+    dispatcher = Dispatcher(bot, Queue())
+    poll_bot.register_handlers(dispatcher)
+
+    while True:
+        data = updates.get()
+        if data is None:
+            break
+        dispatcher.process_update(Update.de_json(json.loads(data), bot))
+
+
+class ShardedRunner:
+    """
+    Polls Telegram in this process and hands each update to one of several worker processes,
+    chosen by chat. Every worker runs the full set of handlers for its chats.
+    """
+
+    def __init__(self, config_path, token, shards):
+        self.config_path = config_path
+        self.token = token
+        self.shards = shards
+        # Spawn rather than fork: by now this process runs the logging, send queue and database threads, and a
+        # forked worker would inherit their state (e.g. a log queue no one reads, or locks held at the time)
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(shards)]
+        self.processes = [None] * shards
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=_worker,
+            args=(self.config_path, self.queues[index], index, self.shards),
+            name='orderbot-worker-{}'.format(index),
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def run(self):
+        for i in range(self.shards):
+            self._start_worker(i)
+        logger.info("Started %d worker processes", self.shards)
+
+        bot = Bot(self.token)
+        offset = None
+        try:
+            while True:
+                for i, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        logger.warning("Worker %d died, restarting it", i)
+                        self._start_worker(i)
+                try:
+                    updates = bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+                except TelegramError as e:
+                    logger.warning(e)
+                    time.sleep(1)
+                    continue
+                for update in updates:
+                    self.queues[shard_for(update, self.shards)].put(update.to_json())
+                    offset = update.update_id + 1
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for queue in self.queues:
+                queue.put(None)
+            for process in self.processes:
+                process.join(timeout=POLL_TIMEOUT)
@@ -0,0 +1,217 @@
+import json
+import time
+import zlib
+import base64
+import logging
+import threading
+
+import dataset
+
+logger = logging.getLogger(__name__)
+
+DB_TIMEOUT = 30  # seconds to wait for a lock held by another process before giving up
+
+# Every column the bot uses. Creating them up front means several processes sharing the database
+# never race each other creating tables or columns on the fly.
+SCHEMA = {
+    'order_collections': [
+        ('chat', 'bigint'),
+        ('uuid', 'text'),
+        ('active', 'boolean'),
+        ('settings', 'text'),
+        ('message', 'bigint'),
+        ('issuer_id', 'bigint'),
+        ('continuations', 'text'),
+    ],
+    'orders': [
+        ('collection_uuid', 'text'),
+        ('chat', 'bigint'),
+        ('user_id', 'bigint'),
+        ('user_name', 'text'),
+        ('order_text', 'text'),
+    ],
+    # What the confirm button places, as priced when the order was requested. Only read when it's pressed.
+    'confirmations': [
+        ('collection_uuid', 'text'),
+        ('chat', 'bigint'),
+        ('data', 'text'),
+        ('encoding', 'text'),
+    ],
+    'defaults': [
+        ('chat', 'bigint'),
+        ('settings', 'text'),
+    ],
+}
+
+# Columns rows are looked up and upserted by. dataset would otherwise create these indexes on the first write,
+# inside a write transaction.
+INDEXES = {
+    'order_collections': [('chat',)],
+    'orders': [('chat', 'user_id'), ('collection_uuid',)],
+    'confirmations': [('collection_uuid',)],
+    'defaults': [('chat',)],
+}
+
+
+def connect(path, threads=None):
+    """
+    Connects to the SQLite database in a way that is safe to share between processes.
+    Every thread using the database holds a connection of its own: with more than a handful of them, pass their
+    number as `threads` so the connection pool is big enough.
+    """
+    engine_kwargs = {'connect_args': {'timeout': DB_TIMEOUT}}
+    if threads is not None:
+        engine_kwargs['pool_size'] = threads
+    db = dataset.connect('sqlite:///{}'.format(path), engine_kwargs=engine_kwargs)
+    # Readers don't block the writer and vice versa
+    db.query('PRAGMA journal_mode=WAL')
+    return db
+
+
+def ensure_schema(db):
+    for name, columns in SCHEMA.items():
+        table = db.create_table(name)
+        for column, type_name in columns:
+            if not table.has_column(column):
+                table.create_column(column, getattr(db.types, type_name))
+    for name, indexes in INDEXES.items():
+        for columns in indexes:
+            # IF NOT EXISTS, as other processes may be creating the same index right now
+            db.query('CREATE INDEX IF NOT EXISTS ix_{}_{} ON {} ({})'.format(
+                name, '_'.join(columns), name, ', '.join(columns)))
+    # Confirmations used to be stored with the collection, and copied along with every change to it
+    if db['order_collections'].has_column('data'):
+        db.query('UPDATE order_collections SET data = NULL WHERE data IS NOT NULL')
+
+
+COMPRESS_MIN = 1024  # characters below which compressing a payload isn't worth it
+
+
+def encode_payload(data, compress=True):
+    """Returns (text, encoding) to store `data` as: JSON, possibly zlib compressed and base64 encoded."""
+    text = json.dumps(data, separators=(',', ':'))
+    if compress and len(text) >= COMPRESS_MIN:
+        return base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii'), 'zlib'
+    return text, 'json'
+
+
+def decode_payload(text, encoding):
+    if encoding == 'zlib':
+        text = zlib.decompress(base64.b64decode(text)).decode('utf-8')
+    return json.loads(text)
+
+
+WRITE_WINDOW = 0.02  # seconds a write nobody waits for may wait for others to share its transaction
+
+
+class _Write:
+    __slots__ = ('table', 'method', 'args', 'kwargs', 'done', 'error')
+
+    def __init__(self, table, method, args, kwargs):
+        self.table = table
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.done = threading.Event()
+        self.error = None
+
+
+class WriteBatcher:
+    """
+    Group commit for database writes: a background thread commits whatever is pending in a single transaction,
+    so writes arriving while a commit is running share the next one.
+    Normal writes return right away and are committed at most `window` seconds later, or as soon as something
+    waits for them in barrier(). Strict writes are committed immediately (along with anything pending) and only
+    return once they are.
+    """
+
+    def __init__(self, db, window=WRITE_WINDOW):
+        self.db = db
+        self.window = window
+        self.stats = {
+            'writes': 0,
+            'transactions': 0,
+            # How often and how long callers were held up waiting for a commit
+            'waits': 0,
+            'wait_time': 0.0,
+        }
+        self._pending = []
+        self._last = None
+        self._urgent = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='write-batcher', daemon=True)
+        self._thread.start()
+
+    def upsert(self, table, row, keys, strict=False):
+        self._submit(_Write(table, 'upsert', (row, keys), {}), strict)
+
+    def update(self, table, row, keys, strict=False):
+        self._submit(_Write(table, 'update', (row, keys), {}), strict)
+
+    def delete(self, table, strict=False, **filters):
+        self._submit(_Write(table, 'delete', (), filters), strict)
+
+    def barrier(self):
+        """
+        Waits until everything written so far is committed, so it can be read back. Whatever is pending is
+        committed right away instead of waiting out the window.
+        """
+        with self._cond:
+            write = self._last
+            if write is not None and not write.done.is_set():
+                self._urgent = True
+                self._cond.notify()
+        if write is not None and not write.done.is_set():
+            self._wait(write)
+
+    def _submit(self, write, strict):
+        with self._cond:
+            self._pending.append(write)
+            self._last = write
+            if strict:
+                self._urgent = True
+            self._cond.notify()
+        if strict:
+            self._wait(write)
+            if write.error is not None:
+                raise write.error
+
+    def _wait(self, write):
+        start = time.perf_counter()
+        write.done.wait()
+        with self._cond:
+            self.stats['waits'] += 1
+            self.stats['wait_time'] += time.perf_counter() - start
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                if not self._urgent:
+                    # Give concurrent writers a moment to join this transaction
+                    self._cond.wait_for(lambda: self._urgent, timeout=self.window)
+                batch, self._pending = self._pending, []
+                self._urgent = False
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with self.db as tx:
+                for write in batch:
+                    getattr(tx[write.table], write.method)(*write.args, **write.kwargs)
+            self.stats['transactions'] += 1
+        except Exception:
+            logger.exception("Batched write failed, retrying the writes one by one")
+            # Don't let one bad write take the others down with it
+            for write in batch:
+                try:
+                    with self.db as tx:
+                        getattr(tx[write.table], write.method)(*write.args, **write.kwargs)
+                    self.stats['transactions'] += 1
+                except Exception as e:
+                    logger.exception("Write to %s failed", write.table)
+                    write.error = e
+        self.stats['writes'] += len(batch)
+        for write in batch:
+            write.done.set()
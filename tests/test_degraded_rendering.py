@@ -0,0 +1,101 @@
+import time
+import threading
+
+from dominos import Dominos, LAST_GOOD_TTL, PRICING_UNAVAILABLE
+from order_snapshot import CollectionSnapshot
+
+COLLECTION = {'chat': 1, 'uuid': 'u1', 'active': True, 'settings': {'store_id': '1'}}
+
+
+def snapshot(*order_texts):
+    return CollectionSnapshot(COLLECTION, [{'user_id': i, 'user_name': 'User {}'.format(i), 'order_text': text}
+                                           for i, text in enumerate(order_texts)])
+
+
+class SlowPricing:
+    """Stands in for Domino's: prices the order texts, after `release` is set while `slow`."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.priced = []
+        self.slow = False
+        self.release = threading.Event()
+        backend._price_order_message = self
+
+    def __call__(self, snapshot):
+        if self.slow:
+            self.release.wait(5)
+        text = 'priced {}'.format(', '.join(order['order_text'] for order in snapshot.orders))
+        self.priced.append(text)
+        self.backend._last_good.set(snapshot.collection['uuid'], {'text': text, 'time': time.time()}, LAST_GOOD_TTL)
+        return text
+
+
+def backend_with_slow_pricing():
+    backend = Dominos({'render_budget': '0.05'})
+    return backend, SlowPricing(backend)
+
+
+def wait_until(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_timeout_shows_the_last_good_text():
+    backend, pricing = backend_with_slow_pricing()
+    pricing.slow = True
+    assert backend.get_orders_as_string(snapshot('small hawaii')).endswith(PRICING_UNAVAILABLE)
+    pricing.release.set()
+    wait_until(lambda: not backend._rendering)
+    pricing.slow = False
+    assert backend.get_orders_as_string(snapshot('large hawaii')).endswith('priced large hawaii')
+
+    pricing.slow = True
+    pricing.release.clear()
+    text = backend.get_orders_as_string(snapshot('large hawaii', 'coke'))
+    assert 'priced large hawaii\n' in text
+    assert "Domino's is not responding right now" in text
+    pricing.release.set()
+
+
+def test_only_the_latest_snapshot_is_priced_after_a_slow_one():
+    backend, pricing = backend_with_slow_pricing()
+    pricing.slow = True
+    backend.get_orders_as_string(snapshot('a'))
+    # Pricing 'a' is still in progress: these don't start pricing of their own
+    backend.get_orders_as_string(snapshot('a', 'b'))
+    backend.get_orders_as_string(snapshot('a', 'b', 'c'))
+    assert pricing.priced == []
+    assert backend._pending['u1'].hash == snapshot('a', 'b', 'c').hash
+
+    pricing.release.set()
+    wait_until(lambda: not backend._rendering)
+    assert pricing.priced == ['priced a', 'priced a, b, c']
+    assert not backend._pending and not backend._stale
+
+
+def test_message_is_refreshed_after_slow_pricing():
+    backend, pricing = backend_with_slow_pricing()
+    refreshed = []
+    backend.refresh_order_message = lambda chat, uuid: refreshed.append((chat, uuid))
+    pricing.slow = True
+    backend.get_orders_as_string(snapshot('a'))
+    backend.get_orders_as_string(snapshot('a', 'b'))
+
+    pricing.release.set()
+    wait_until(lambda: refreshed)
+    assert refreshed == [(1, 'u1')]
+    # The refresh shows what was priced in the background, without pricing it again
+    assert backend.get_orders_as_string(snapshot('a', 'b')).endswith('priced a, b')
+    assert pricing.priced == ['priced a', 'priced a, b']
+
+
+def test_no_refresh_when_pricing_was_in_time():
+    backend, pricing = backend_with_slow_pricing()
+    refreshed = []
+    backend.refresh_order_message = lambda chat, uuid: refreshed.append((chat, uuid))
+    assert backend.get_orders_as_string(snapshot('a')).endswith('priced a')
+    wait_until(lambda: not backend._rendering)
+    assert refreshed == []
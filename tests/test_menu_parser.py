@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from menu_parser import parse_menu_chunks, project_menu, StreamingMenuParser, MenuParseError
+
+MENU = {
+    'Status': 0,
+    'Categorization': {'Food': {'Categories': [{'Code': 'Pizza', 'Products': ['S_HAW', 'S_MRG']}]}},
+    'Products': {
+        'S_HAW': {'Code': 'S_HAW', 'Name': 'Hawaii', 'ProductType': 'Pizza', 'Variants': ['25HTHAW', '30HTHAW'],
+                  'DefaultToppings': 'X=1,H=1', 'AvailableSides': '', 'Description': 'Ham, "pineapple" & {more}'},
+        'S_MRG': {'Code': 'S_MRG', 'Name': 'Margherita', 'ProductType': 'Pizza', 'Variants': ['30HTMRG'],
+                  'DefaultToppings': 'X=1', 'AvailableSides': 'GARDIP', 'Tags': {'Vegetarian': True}},
+    },
+    'Variants': {
+        '25HTHAW': {'Code': '25HTHAW', 'Name': 'Small Hawaii', 'Price': '15.90', 'ProductCode': 'S_HAW',
+                    'Weight': 123.25, 'Local': False},
+        '30HTHAW': {'Code': '30HTHAW', 'Name': 'Medium Hawaii', 'Price': '19.90', 'ProductCode': 'S_HAW',
+                    'Weight': 1e3, 'Local': None},
+        '30HTMRG': {'Code': '30HTMRG', 'Name': 'Medium Marghérita', 'Price': '17.90', 'ProductCode': 'S_MRG'},
+    },
+    'Toppings': {
+        'Pizza': {'X': {'Code': 'X', 'Name': 'Tomato Sauce', 'Tags': {'Sauce': True}},
+                  'H': {'Code': 'H', 'Name': 'Ham', 'Tags': {}}},
+        'Pasta': {'P': {'Code': 'P', 'Name': 'Pesto', 'Tags': {}}},
+    },
+    'Sides': {'Pizza': {'GARDIP': {'Code': 'GARDIP', 'Name': 'Garlic Dip', 'Price': '1.50'}}},
+    'Coupons': {'N\\051': {'Code': 'N051', 'Name': 'Double Deal M', 'Tags': {'Days': ['Mo', 'Tu']}, 'Price': 30}},
+    'Flavors': [[1, 2, [3]], {'a': [{}]}, 12, "x]}"],
+    'Version': 1234567,
+}
+
+
+def test_projects_the_used_sections():
+    parsed = parse_menu_chunks([json.dumps(MENU).encode('utf-8')])
+    assert set(parsed) == {'Products', 'Variants', 'Toppings', 'Sides', 'Coupons'}
+    assert parsed['Products']['S_HAW'] == {
+        'Code': 'S_HAW', 'Name': 'Hawaii', 'ProductType': 'Pizza', 'Variants': ['25HTHAW', '30HTHAW'],
+        'DefaultToppings': 'X=1,H=1', 'AvailableSides': ''}
+    assert list(parsed['Toppings']) == ['Pizza']
+    assert 'N\\051' in parsed['Coupons']
+
+
+@pytest.mark.parametrize('indent', [None, 2])
+def test_same_result_for_any_chunk_size(indent):
+    data = json.dumps(MENU, indent=indent, ensure_ascii=False).encode('utf-8')
+    expected = project_menu(json.loads(data.decode('utf-8')))
+    for size in (1, 2, 3, 5, 7, 16, 100, len(data)):
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        assert parse_menu_chunks(chunks) == expected, size
+
+
+def test_number_cut_at_chunk_end():
+    parser = StreamingMenuParser({'Version': lambda key, value: value})
+    parser.feed('{"Version": 12')
+    parser.feed('34, "Products": {}}')
+    assert parser.close() == {'Version': 1234}
+
+
+def test_truncated_menu():
+    data = json.dumps(MENU).encode('utf-8')
+    with pytest.raises(MenuParseError):
+        parse_menu_chunks([data[:len(data) // 2]])
+
+
+def test_not_a_menu():
+    with pytest.raises(MenuParseError):
+        parse_menu_chunks([b'<html>503 Service Unavailable</html>'])
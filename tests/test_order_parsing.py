@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Order parsing against recorded results.
+tests/data/parsed_orders.json holds random menus and orders with what _parse_order made of them before orders were
+tokenized once and matched through a SearchIndex. Parsing has to give exactly the same items.
+Run this file directly to record the results of the current code again - only do so for an intended change.
+"""
+import os
+import sys
+import json
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dominos import Dominos, Menu, SIZE_WORDS, MODIFIER_WORDS, STANDARD  # noqa: E402
+from order_tokens import tokenize_order, SearchIndex  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'parsed_orders.json')
+MENUS = 25
+ORDERS_PER_MENU = 40
+
+NAME_WORDS = ['pizza', 'hawaii', 'bbq', 'meat', 'lovers', 'veggie', 'dream', 'cheese', 'mushrooms', 'mushroom',
+              'chéese', 'feta', 'corn', 'sweet', 'ham', 'tomato', 'sauce', 'base', 'ranch', 'dip', 'coke', 'cola',
+              'garlic', 'bread', 'a', 'ab', 'x', 'sm', 'margherita', 'créme', 'fraîche', 'herbes', 'de', 'provence',
+              '']
+ORDER_WORDS = NAME_WORDS + ['small', 'large', 's', 'l', 'xl', 'big', 'no', 'extra', '2', '3', 'with', 'and',
+                            '35cm', '25cm', ',', ',', 'Large', 'NO', 'Extra', '€']
+
+
+def random_name(r):
+    return ' '.join(r.choice(NAME_WORDS) for _ in range(r.randint(1, 3)))
+
+
+def random_menu(r):
+    products = {}
+    for i in range(r.randint(3, 25)):
+        product_type = r.choice(['Pizza', 'Pizza', 'Sides', 'Drinks', 'Pasta'])
+        if product_type == 'Pizza':
+            variants = ['{}HTP{}'.format(s, i) for s in r.sample([25, 30, 35], r.randint(1, 3))]
+            if r.random() < .3:
+                variants.append('25HTX{}'.format(i))
+            if r.random() < .2:
+                variants = ['25HTMRG', '30HTMRG']
+        else:
+            variants = ['V{}_{}'.format(i, k) for k in range(r.randint(1, 4))]
+        products['P{}'.format(i)] = {
+            'Code': 'P{}'.format(i),
+            'Name': random_name(r),
+            'ProductType': product_type,
+            'Variants': variants,
+            'DefaultToppings': r.choice(['', 'X=1,C=1', 'C=1']),
+            'AvailableSides': r.choice(['', 'S1,S2', 'S3']),
+        }
+    if r.random() < .5:
+        products['S_MRG'] = {'Code': 'S_MRG', 'Name': 'plain', 'ProductType': 'Pizza', 'Variants': ['25HTSMRG'],
+                             'DefaultToppings': '', 'AvailableSides': ''}
+    toppings = {'T{}'.format(i): {'Code': 'T{}'.format(i), 'Name': random_name(r),
+                                  'Tags': {'Sauce': r.random() < .3} if r.random() < .9 else {}}
+                for i in range(r.randint(0, 15))}
+    sides = {
+        'A': {'S{}'.format(i): {'Code': 'S{}'.format(i), 'Name': random_name(r)} for i in range(r.randint(0, 5))},
+        'B': {'S9': {'Code': 'S9', 'Name': random_name(r)}},
+    }
+    return {'Products': products, 'Toppings': {'Pizza': toppings}, 'Sides': sides, 'Coupons': {}}
+
+
+def random_order(r):
+    words = [r.choice(ORDER_WORDS) for _ in range(r.randint(1, 9))]
+    return ' '.join(words).replace(' , ', r.choice([', ', ',', ' , '])).strip()
+
+
+def parse(backend, order, menu):
+    try:
+        return backend._parse_order(order, menu)
+    except Exception as e:
+        # The old parser failed on some odd orders - the new one has to fail on the same ones
+        return {'error': type(e).__name__}
+
+
+def record():
+    r = random.Random(1)
+    backend = Dominos({})
+    cases = []
+    for _ in range(MENUS):
+        menu_json = random_menu(r)
+        menu = Menu(json.loads(json.dumps(menu_json)))
+        orders = [random_order(r) for _ in range(ORDERS_PER_MENU)]
+        cases.append({'menu': menu_json, 'orders': [[order, parse(backend, order, menu)] for order in orders]})
+    # Ties between equally good matches go to the item first in the menu, so the key order has to be kept
+    with open(FIXTURE, 'w', encoding='utf-8') as f:
+        json.dump(cases, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def test_same_items_as_recorded():
+    with open(FIXTURE, 'r', encoding='utf-8') as f:
+        cases = json.load(f)
+    backend = Dominos({})
+    for case in cases:
+        menu = Menu(case['menu'])
+        for order, expected in case['orders']:
+            # Through JSON, so tuples and lists compare the same way as in the recording
+            assert json.loads(json.dumps(parse(backend, order, menu))) == expected, order
+
+
+def test_tokenize_order():
+    tokens = tokenize_order("Large Hawaii extra Chéese, no ham", SIZE_WORDS, STANDARD, MODIFIER_WORDS)
+    assert tokens.size == 35
+    assert [part.words for part in tokens.parts] == [['large', 'hawaii', 'extra', 'cheese'], ['no', 'ham']]
+    assert tokens.parts[0].raw_words[3] == 'chéese'
+    assert tokens.parts[0].marker_before(3) == 'extra'
+    assert tokens.parts[1].marker_before(1) == 'no'
+    assert tokens.parts[1].marker_before(0) is None
+
+
+def test_search_index_prefers_longer_matches():
+    items = {
+        'A': {'Code': 'A', 'Name': 'Hawaii'},
+        'B': {'Code': 'B', 'Name': 'Hawaii Special'},
+        'C': {'Code': 'C', 'Name': 'Margherita'},
+    }
+    index = SearchIndex(items)
+    tokens = tokenize_order("hawaii special", SIZE_WORDS, STANDARD, MODIFIER_WORDS)
+    found = index.find_matches(tokens, min_words=1)
+    assert found
+    best = max(found, key=lambda m: (m['len'], m['sum']))
+    assert best['product']['Code'] == 'B'
+    assert not any(m['product']['Code'] == 'C' for m in found)
+
+
+if __name__ == '__main__':
+    record()
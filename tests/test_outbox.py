@@ -0,0 +1,90 @@
+import time
+import threading
+
+from telegram.error import RetryAfter
+
+import outbox
+from outbox import SendQueue
+
+FAST = 1000  # messages per second, so the limits never get in the way
+
+
+def fast_queue():
+    # A single thread, so the order messages go out in is the queue's
+    return SendQueue(FAST, FAST, FAST, threads=1)
+
+
+def hold(queue):
+    """Keeps the queue's thread busy until the returned event is set."""
+    release = threading.Event()
+    started = threading.Event()
+    queue.send(1, lambda: started.set() or release.wait(5))
+    started.wait(5)
+    return release
+
+
+def test_chat_messages_go_out_in_order():
+    queue = SendQueue(FAST, FAST, FAST, threads=4)
+    sent = []
+    futures = [queue.send(2, lambda i=i: sent.append(i) or i, outbox.REFRESH) for i in range(20)]
+    assert [future.result(5) for future in futures] == list(range(20))
+    assert sent == list(range(20))
+
+
+def test_replies_go_before_refreshes():
+    queue = fast_queue()
+    sent = []
+    release = hold(queue)
+    queue.send(2, lambda: sent.append('refresh'), outbox.REFRESH)
+    last = queue.send(2, lambda: sent.append('reply'), outbox.REPLY)
+    assert queue.depth() == 2
+    release.set()
+    queue.send(2, lambda: None, outbox.REFRESH).result(5)
+    assert last.done()
+    assert sent == ['reply', 'refresh']
+    assert queue.depth() == 0
+
+
+def test_edits_are_coalesced_with_the_higher_priority():
+    queue = fast_queue()
+    sent = []
+    release = hold(queue)
+    queue.send(2, lambda: sent.append('other refresh'), outbox.REFRESH)
+    first = queue.send(2, lambda: sent.append('old text') or 'old', outbox.REFRESH, key=('edit', 2, 5))
+    second = queue.send(2, lambda: sent.append('new text') or 'new', outbox.REPLY, key=('edit', 2, 5))
+    release.set()
+    assert first.result(5) == second.result(5) == 'new'
+    queue.send(2, lambda: None, outbox.REFRESH).result(5)
+    assert sent == ['new text', 'other refresh']
+    assert queue.stats['coalesced'] == 1
+
+
+def test_retry_after_pauses_the_chat():
+    queue = fast_queue()
+    attempts = []
+
+    def send():
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise RetryAfter(0.2)
+        return 'sent'
+
+    assert queue.send(2, send).result(5) == 'sent'
+    assert attempts[1] - attempts[0] >= 0.2
+    assert queue.stats['retried'] == 1
+    assert queue.stats['failed'] == 0
+
+
+def test_gives_up_after_too_many_retries():
+    queue = fast_queue()
+    attempts = []
+
+    def send():
+        attempts.append(1)
+        raise RetryAfter(0)
+
+    future = queue.send(2, send)
+    assert isinstance(future.exception(5), RetryAfter)
+    assert len(attempts) == outbox.SEND_RETRIES + 1
+    assert queue.stats['retried'] == outbox.SEND_RETRIES
+    assert queue.stats['failed'] == 1
@@ -0,0 +1,31 @@
+from pricing import assign_deals, partition_items
+
+DOUBLE_DEAL = ('N051', {'Price': '30.00', 'ProductGroups': [{'RequiredQty': 2, 'ProductCodes': ['30HTHAW', '30HTMRG']}]})
+DRINK_DEAL = ('D1', {'ProductGroups': [{'RequiredQty': 1, 'ProductCodes': ['30HTHAW']},
+                                       {'RequiredQty': 1, 'ProductCodes': ['COKE']}]})
+
+
+def test_assign_deals():
+    items = ['30HTHAW', 'COKE', '30HTMRG', '30HTHAW', '30HTHAW']
+    assert assign_deals(items, [DOUBLE_DEAL, DRINK_DEAL]) == [('N051', [0, 2]), ('N051', [3, 4])]
+    # The drink deal can't be filled a second time, so the pizza it had picked goes back at the end
+    assert assign_deals(items, [DRINK_DEAL, DOUBLE_DEAL]) == [('D1', [0, 1]), ('N051', [2, 4])]
+
+
+def test_partition_keeps_deals_together():
+    items = ['30HTHAW', 'COKE', '30HTMRG', 'COKE', '30HTHAW']
+    prices = [19.9, 3.5, 17.9, 3.5, 19.9]
+    groups = partition_items(items, prices, [DOUBLE_DEAL], max_items=2)
+    # The deal first, then the biggest amounts
+    assert sorted(groups) == [[0, 2], [1, 4], [3]]
+
+
+def test_partition_by_amount():
+    items = ['A', 'B', 'C', 'D']
+    groups = partition_items(items, [40.0, 30.0, 20.0, None], [], max_items=10, max_amount=50)
+    assert sorted(groups) == [[0, 3], [1, 2]]
+
+
+def test_partition_oversized_item():
+    groups = partition_items(['A', 'B'], [120.0, 10.0], [], max_items=10, max_amount=100)
+    assert sorted(groups) == [[0], [1]]
@@ -0,0 +1,33 @@
+from rendering import FragmentCache, split_message
+
+
+def test_short_message_is_one_part():
+    assert split_message("hello\nworld", limit=20) == ["hello\nworld"]
+
+
+def test_split_at_line_breaks():
+    lines = ["line {}".format(i) for i in range(10)]
+    parts = split_message("\n".join(lines), limit=20)
+    assert all(len(part) <= 20 for part in parts)
+    assert "\n".join(parts).split("\n") == lines
+
+
+def test_long_line_is_cut():
+    parts = split_message("short\n" + "x" * 25 + "\nend", limit=10)
+    assert parts == ["short", "x" * 10, "x" * 10, "x" * 5 + "\nend"]
+
+
+def test_fragment_cache():
+    cache = FragmentCache(maxsize=1)
+    renders = []
+
+    def render(text):
+        renders.append(text)
+        return text
+
+    assert cache.get('a', lambda: render('A')) == 'A'
+    assert cache.get('a', lambda: render('B')) == 'A'
+    cache.get('b', lambda: render('B'))
+    assert cache.get('a', lambda: render('C')) == 'C'
+    assert cache.get(None, lambda: render('D')) == 'D'
+    assert renders == ['A', 'B', 'C', 'D']
@@ -0,0 +1,119 @@
+import time
+import threading
+
+import pytest
+
+from throttle import TokenBucket, CircuitBreaker, SingleFlight, UpstreamUnavailable
+
+
+def test_token_bucket_burst():
+    bucket = TokenBucket(10, burst=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+    assert 0 < bucket.wait_time() <= 0.1
+    assert bucket.acquire(timeout=0.5)
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert not breaker.is_healthy()
+
+    time.sleep(0.06)
+    assert breaker.is_healthy()
+    # Only one trial call
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_gives_up_on_a_lost_trial_call():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    # The trial call never reports back
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.is_healthy()
+    assert breaker.allow()
+
+
+def run_concurrently(count, target):
+    results = [None] * count
+
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.005)
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_single_flight_shares_the_result():
+    flights = SingleFlight()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        time.sleep(0.2)
+        return object()
+
+    results = run_concurrently(5, lambda: flights.do('menu', fetch, timeout=5))
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert flights.stats['calls'] == 1
+    assert flights.stats['shared'] == 4
+
+    # Once done, the next call is made again
+    flights.do('menu', fetch)
+    assert len(calls) == 2
+
+
+def test_single_flight_shares_the_error():
+    flights = SingleFlight()
+
+    def fetch():
+        time.sleep(0.2)
+        raise ValueError("no such store")
+
+    results = run_concurrently(3, lambda: flights.do('store', fetch, timeout=5))
+    assert all(isinstance(result, ValueError) for result in results)
+    assert flights.stats['errors'] == 1
+
+
+def test_single_flight_timeout():
+    flights = SingleFlight()
+    started = threading.Event()
+
+    def fetch():
+        started.set()
+        time.sleep(0.3)
+        return 'menu'
+
+    leader = threading.Thread(target=flights.do, args=('menu', fetch))
+    leader.start()
+    started.wait()
+    with pytest.raises(UpstreamUnavailable):
+        flights.do('menu', fetch, timeout=0.05)
+    leader.join()
+    assert flights.stats['timeouts'] == 1
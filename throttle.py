@@ -0,0 +1,192 @@
+import time
+import threading
+from concurrent.futures import Future, TimeoutError
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised instead of calling an upstream service which is known to be unhealthy or overloaded,
+    or when a call to it failed. `sent` tells whether the request may have reached the upstream.
+    """
+
+    def __init__(self, message, sent=False):
+        Exception.__init__(self, message)
+        self.sent = sent
+
+
+class TokenBucket:
+    """
+    Classic token bucket: allows `rate` calls per second on average, with bursts of up to `burst` calls.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        """Seconds until a token will be available, 0 if there is one right now."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        """
+        Takes a token, waiting for one to become available if necessary.
+        Returns False if no token could be acquired within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if deadline is not None:
+                if now + wait > deadline:
+                    return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an upstream after `failure_threshold` consecutive failures.
+    After `reset_timeout` seconds, a single trial call is let through: if it succeeds, the circuit closes again.
+    A trial call which doesn't report back within `reset_timeout` seconds is given up on, and another one allowed.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened >= self.reset_timeout:
+                # Open for long enough, or the last trial call never reported back
+                self.state = self.HALF_OPEN
+                self._opened = now
+                return True
+            # Open, or the trial call is still in progress
+            return False
+
+    def is_healthy(self):
+        """Like allow(), but without claiming the trial call."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            return time.monotonic() - self._opened >= self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened = time.monotonic()
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same thing share one call: the first caller with a key makes it, the
+    others wait up to `timeout` seconds for its result - or its exception, which is raised in all of them.
+    """
+
+    def __init__(self):
+        self.stats = {
+            'calls': 0,
+            'shared': 0,
+            'errors': 0,
+            'timeouts': 0,
+        }
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def report(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.stats['calls'] += 1
+            else:
+                self.stats['shared'] += 1
+
+        if leader:
+            try:
+                result = func()
+            except BaseException as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                    del self._calls[key]
+                call.set_exception(e)
+                raise
+            with self._lock:
+                del self._calls[key]
+            call.set_result(result)
+            return result
+
+        try:
+            return call.result(timeout)
+        except TimeoutError:
+            with self._lock:
+                self.stats['timeouts'] += 1
+            raise UpstreamUnavailable("Gave up waiting for {} after {}s".format(key, timeout))
+
+
+# Shared by every backend instance (and every chat) in this process
+_limiters = {}
+_breakers = {}
+_flights = {}
+_registry_lock = threading.Lock()
+
+
+def get_limiter(name, rate, burst=None):
+    with _registry_lock:
+        if name not in _limiters:
+            _limiters[name] = TokenBucket(rate, burst)
+        return _limiters[name]
+
+
+def get_breaker(name, failure_threshold=5, reset_timeout=30):
+    with _registry_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(failure_threshold, reset_timeout)
+        return _breakers[name]
+
+
+def get_single_flight(name):
+    with _registry_lock:
+        if name not in _flights:
+            _flights[name] = SingleFlight()
+        return _flights[name]
+
+
+def single_flight_stats():
+    """The stats of every shared SingleFlight, as {'<name> <counter>': value}."""
+    with _registry_lock:
+        flights = list(_flights.items())
+    return {'{} {}'.format(name, key): value for name, flight in flights for key, value in flight.report().items()}
@@ -0,0 +1,48 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+WARMUP_PARALLELISM = 4  # chats warmed up at the same time
+WARMUP_TIMEOUT = 30  # seconds after which the bot starts anyway
+
+
+def warm_up(targets, parallelism=WARMUP_PARALLELISM, timeout=WARMUP_TIMEOUT):
+    """
+    Calls backend.warm_up(settings) for every (mode, backend, settings) in `targets`, a few at a time.
+    Returns once all of them are done, or after `timeout` seconds - whatever is still running then just carries on
+    in the background, and whatever didn't start yet is dropped.
+    """
+    stats = {
+        'targets': len(targets),
+        'done': 0,
+        'failed': 0,
+        'unfinished': 0,
+    }
+    if not targets:
+        return stats
+
+    def run(mode, backend, settings):
+        try:
+            backend.warm_up(settings)
+        except Exception as e:
+            logger.warning("Warm-up for %s failed: %s", mode, e)
+            return False
+        return True
+
+    start = time.monotonic()
+    executor = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix='warmup')
+    futures = [executor.submit(run, mode, backend, settings) for mode, backend, settings in targets]
+    done, not_done = wait(futures, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    for future in done:
+        if future.result():
+            stats['done'] += 1
+        else:
+            stats['failed'] += 1
+    stats['unfinished'] = len(not_done)
+    logger.info("Warm-up took %.1fs: %d done, %d failed, %d unfinished",
+                time.monotonic() - start, stats['done'], stats['failed'], stats['unfinished'])
+    return stats